@@ -0,0 +1,542 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+from buildbot.process.buildstep import BuildStep
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import SUCCESS, WARNINGS
+from twisted.internet import task, threads
+from twisted.python import log
+
+#
+# Build artifact cache.
+#
+# The packages built for a (revision, platform, kernel, configuration) are
+# kept on the master so later builds of the same inputs (retries, nightly
+# builds, the shards of a sharded builder) can download and install them
+# rather than building them again.  The slave computes the cache key and
+# looks it up over HTTP, see bb-artifact-cache.sh, and after a miss uploads
+# the packages it built.  Each build uploads to its own file, the shards of a
+# sharded builder miss on the same key at once, and the first complete and
+# valid upload becomes the entry.  The cache is limited in size, evicting the
+# least recently used entries.  The last use of an entry is its modification
+# time.
+#
+class ArtifactCache(object):
+    key_pattern = re.compile(r'^[0-9a-f]{40}$')
+    upload_pattern = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+    def __init__(self, path, max_bytes=20*1024*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def entry(self, key):
+        if not self.key_pattern.match(key):
+            raise ValueError("Invalid artifact cache key '%s'" % key)
+
+        return os.path.join(self.path, key + ".tar")
+
+    def upload_path(self, key, upload):
+        """
+        Returns the path the packages of the upload, named for the build, are
+        uploaded to relative to the master.  Uploads are renamed in to place
+        by add() once complete.
+        """
+        if not self.upload_pattern.match(upload):
+            raise ValueError("Invalid artifact cache upload '%s'" % upload)
+
+        return "%s.%s.tmp" % (self.entry(key), upload)
+
+    @staticmethod
+    def verify(path):
+        """
+        Returns True when the upload is a complete, readable tar archive.
+        """
+        try:
+            if os.path.getsize(path) == 0:
+                return False
+
+            with tarfile.open(path, 'r') as tar:
+                return len(tar.getmembers()) > 0
+        except (OSError, IOError, tarfile.TarError, EOFError):
+            return False
+
+    def touch(self, key):
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            os.utime(entry, None)
+
+    def add(self, key, upload):
+        """
+        Renames the upload in to place, returning "stored", or "exists" when
+        another build stored the entry first, "invalid" when the upload is
+        not a readable archive, or "miss" when nothing was uploaded.
+        """
+        path = self.upload_path(key, upload)
+        if not os.path.exists(path):
+            return "miss"
+
+        if os.path.exists(self.entry(key)):
+            os.remove(path)
+            return "exists"
+
+        if not self.verify(path):
+            log.msg("Artifact cache discarded invalid upload %s" % path)
+            os.remove(path)
+            return "invalid"
+
+        os.rename(path, self.entry(key))
+        return "stored"
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within
+        its size limit.  Returns the number of bytes removed.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry)
+            except OSError:
+                continue
+
+            # Skip uploads which are still in progress, but remove any
+            # which were abandoned.
+            if not name.endswith(".tar"):
+                if time.time() - st.st_mtime > 86400:
+                    os.remove(entry)
+                continue
+
+            entries.append((st.st_mtime, st.st_size, entry))
+            total += st.st_size
+
+        removed = 0
+        entries.sort()
+        while total > self.max_bytes and entries:
+            mtime, size, entry = entries.pop(0)
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+
+            total -= size
+            removed += size
+            self.evictions += 1
+
+        return removed
+
+    def update(self, state, key, upload):
+        """
+        Records the result of a lookup, runs in a thread.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        if state == 'hit':
+            self.hits += 1
+            self.touch(key)
+            return "hit"
+
+        self.misses += 1
+        result = self.add(key, upload)
+        if result != "stored":
+            return result
+
+        removed = self.evict()
+        if removed:
+            log.msg("Artifact cache evicted %d bytes" % removed)
+
+        return "stored"
+
+    def stats(self):
+        return "Artifact cache: %d hits, %d misses, %d evictions" % (
+            self.hits, self.misses, self.evictions)
+
+#
+# Build step which updates the artifact cache on the master after the slave
+# has looked up, and possibly uploaded, the packages for the build.  The
+# artifact_cache property is set by the lookup to hit, miss, or disabled.
+#
+class ArtifactCacheUpdate(BuildStep):
+    name = "artifact cache"
+    description = ["updating artifact cache"]
+    descriptionDone = ["artifact cache"]
+    renderables = ['upload']
+
+    def __init__(self, cache, upload, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.cache = cache
+        self.upload = upload
+
+    def start(self):
+        props = self.build.getProperties()
+        state = props.getProperty('artifact_cache', 'disabled')
+        key = props.getProperty('artifact_key', '')
+        if state not in ('hit', 'miss') or not key:
+            self.step_status.setText(["artifact cache", state])
+            return self.finished(SUCCESS)
+
+        d = threads.deferToThread(self.cache.update, state, key, self.upload)
+        d.addCallback(self.updated)
+        d.addErrback(self.update_failed)
+
+    def updated(self, result):
+        log.msg(self.cache.stats())
+        self.step_status.setText(["artifact cache", result])
+        self.finished(SUCCESS)
+
+    def update_failed(self, failure):
+        log.err(failure, "Failed to update the artifact cache")
+        self.step_status.setText(["artifact cache", "failed"])
+        self.finished(WARNINGS)
+
+#
+# Deduplicated artifact store.
+#
+# Many of the files uploaded to public_html by the builders (coverage
+# reports, ztest cores, test results) are identical across builders and
+# retries.  Each file is stored once in the store, named by its SHA-256, and
+# hard linked in to public_html so the existing URLs continue to work.
+#
+# Before uploading, the slave sends a manifest of the hash, size and path of
+# every file it would upload.  Files already in the store are linked in to
+# the build's incoming directory on the master and the slave removes them
+# from the upload, so they are never transferred.  The upload is made to the
+# same incoming directory, never to public_html, since the builders of a
+# platform (and the shards of a sharded builder) share a destination there.
+# After the upload the remaining files are hashed and moved in to the store,
+# and every file is then linked in to public_html by renaming a new link over
+# the old one.  The manifest of each build is kept as the index of the files
+# it uploaded.
+#
+# Uploaded artifacts are removed after pr_days for pull requests and
+# branch_days for branches, and store objects no longer linked from
+# public_html are removed with them, by the ArtifactExpiry service below.
+# An object is briefly unlinked while it is stored or linked, so storing,
+# linking and removing objects are serialized by the lock, which is shared
+# by every store since the running builds keep the store of the config they
+# started with.
+#
+class ArtifactStore(object):
+    hash_pattern = re.compile(r'^[0-9a-f]{64}$')
+    chunk_size = 1024*1024
+    lock = threading.Lock()
+
+    def __init__(self, path, public_html="public_html", pr_days=30,
+                 branch_days=180):
+        self.path = path
+        self.public_html = public_html
+        self.pr_days = pr_days
+        self.branch_days = branch_days
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.path, "manifests", name)
+
+    def incoming_path(self, name):
+        return os.path.join(self.path, "incoming", name)
+
+    @staticmethod
+    def makedirs(path):
+        # Builds sharing a destination may create the same directories.
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def read_manifest(path):
+        """
+        Returns a list of (digest, size, path) read from a slave manifest.
+        """
+        entries = []
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.rstrip("\n").split(" ", 2)
+                if len(fields) != 3 or not ArtifactStore.hash_pattern.match(
+                        fields[0]):
+                    continue
+
+                name = os.path.normpath(fields[2])
+                if name.startswith("..") or os.path.isabs(name):
+                    continue
+
+                entries.append((fields[0], int(fields[1]), name))
+
+        return entries
+
+    @staticmethod
+    def list_files(path):
+        """
+        Returns a list of (None, size, path) of the files under path, for
+        uploads made without a manifest.
+        """
+        entries = []
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                file = os.path.join(root, name)
+                entries.append((None, os.path.getsize(file),
+                    os.path.relpath(file, path)))
+
+        return entries
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def link(self, manifest, incoming, present):
+        """
+        Links the files in the manifest which are already stored in to the
+        incoming directory of the build, and writes their paths to present.
+        Runs in a thread.
+        """
+        if os.path.isdir(incoming):
+            shutil.rmtree(incoming)
+
+        found = []
+        for digest, size, name in self.read_manifest(manifest):
+            obj = self.object_path(digest)
+            target = os.path.join(incoming, name)
+            with self.lock:
+                if not os.path.exists(obj) or os.path.exists(target):
+                    continue
+
+                self.makedirs(os.path.dirname(target))
+                os.link(obj, target)
+                found.append((size, name))
+
+        with open(present, 'w') as f:
+            for size, name in found:
+                f.write(name + "\n")
+
+        return sum(size for size, name in found)
+
+    def ingest(self, manifest, incoming, dest, name):
+        """
+        Moves the uploaded files in the incoming directory in to the store,
+        and links every file in to dest.  Without a manifest every file in
+        the incoming directory is stored.  Returns the (total, stored) bytes.
+        Runs in a thread.
+        """
+        if os.path.exists(manifest):
+            entries = self.read_manifest(manifest)
+        else:
+            entries = self.list_files(incoming)
+
+        total = 0
+        stored = 0
+        for digest, size, path in entries:
+            total += size
+            source = os.path.join(incoming, path)
+            if not os.path.isfile(source):
+                continue
+
+            # Files linked from the store are in place, the rest were
+            # uploaded.  The hash is recomputed since the manifest is
+            # provided by the slave and the file may have changed since it
+            # was written.
+            if os.stat(source).st_nlink == 1:
+                digest = self.hash_file(source)
+                obj = self.object_path(digest)
+                with self.lock:
+                    if os.path.exists(obj):
+                        os.remove(source)
+                    else:
+                        self.makedirs(os.path.dirname(obj))
+                        os.rename(source, obj)
+                        stored += os.stat(obj).st_size
+                    os.link(obj, source)
+
+            # Replace the file in dest in one step, so it is never written
+            # through, or removed, while another build uses it.  Renaming a
+            # link over another link to the same object leaves both.
+            target = os.path.join(dest, path)
+            self.makedirs(os.path.dirname(target))
+            if os.path.exists(target) and os.path.samefile(source, target):
+                continue
+
+            tmp = "%s.%s.tmp" % (target, name)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(source, tmp)
+            os.rename(tmp, target)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        if os.path.isdir(incoming):
+            shutil.rmtree(incoming)
+
+        if os.path.exists(manifest):
+            os.rename(manifest, self.manifest_path(name))
+        if os.path.exists(self.manifest_path(name + ".present")):
+            os.remove(self.manifest_path(name + ".present"))
+
+        return (total, stored)
+
+    def expire(self):
+        """
+        Removes the artifacts which are past their retention, and then any
+        objects which are no longer linked.  Returns the bytes removed from
+        the store.  Runs in a thread.
+        """
+        now = time.time()
+        for kind, days in (("pull", self.pr_days),
+                           ("branch", self.branch_days)):
+            top = os.path.join(self.public_html, "artifacts", kind)
+            if not os.path.isdir(top):
+                continue
+
+            for origin in os.listdir(top):
+                if not os.path.isdir(os.path.join(top, origin)):
+                    continue
+
+                for version in os.listdir(os.path.join(top, origin)):
+                    path = os.path.join(top, origin, version)
+                    if now - os.path.getmtime(path) > days * 86400:
+                        log.msg("Removing expired artifacts %s" % path)
+                        shutil.rmtree(path, ignore_errors=True)
+
+        # Remove the incoming directories of builds which never finished.
+        incoming = os.path.join(self.path, "incoming")
+        if os.path.isdir(incoming):
+            for name in os.listdir(incoming):
+                path = os.path.join(incoming, name)
+                if now - os.path.getmtime(path) > 86400:
+                    shutil.rmtree(path, ignore_errors=True)
+
+        manifests = os.path.join(self.path, "manifests")
+        if os.path.isdir(manifests):
+            for name in os.listdir(manifests):
+                path = os.path.join(manifests, name)
+                if now - os.path.getmtime(path) > self.branch_days * 86400:
+                    os.remove(path)
+
+        removed = 0
+        for root, dirs, files in os.walk(os.path.join(self.path, "objects")):
+            for name in files:
+                obj = os.path.join(root, name)
+                with self.lock:
+                    try:
+                        st = os.stat(obj)
+                    except OSError:
+                        continue
+
+                    if st.st_nlink == 1:
+                        os.remove(obj)
+                        removed += st.st_size
+
+        return removed
+
+#
+# Service which expires the artifact store every interval seconds, see
+# ArtifactStore.expire().
+#
+# For example:
+#
+#   c['status'].append(ArtifactExpiry(artifact_store, interval=3600))
+#
+class ArtifactExpiry(StatusReceiverMultiService):
+    def __init__(self, store, interval=3600):
+        StatusReceiverMultiService.__init__(self)
+        self.store = store
+        self.interval = interval
+        self.loop = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.loop = task.LoopingCall(self.run)
+        self.loop.start(self.interval, now=False)
+
+    def stopService(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+        return StatusReceiverMultiService.stopService(self)
+
+    def run(self):
+        d = threads.deferToThread(self.store.expire)
+        d.addCallback(lambda removed: log.msg(
+            "Artifact store removed %d unreferenced bytes" % removed))
+        d.addErrback(log.err, "Artifact store expiry failed")
+        return d
+
+#
+# Build steps which link the already stored files in to the incoming
+# directory of the build before the upload ('link'), and move the uploaded
+# files in to the store and link them in to dest after it ('ingest').  The
+# bytes uploaded, and newly stored, are recorded in the artifact_bytes_total,
+# artifact_bytes_uploaded and artifact_bytes_stored properties.
+#
+class ArtifactStoreStep(BuildStep):
+    renderables = ['dest', 'upload']
+
+    def __init__(self, store, mode, dest, upload, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.store = store
+        self.mode = mode
+        self.dest = dest
+        self.upload = upload
+        self.description = ["artifact store", mode]
+
+    def start(self):
+        manifest = self.store.manifest_path(self.upload + ".upload")
+        incoming = self.store.incoming_path(self.upload)
+        if not os.path.exists(manifest) and (self.mode == 'link' or
+                not os.path.isdir(incoming)):
+            self.step_status.setText(["artifact store", "no manifest"])
+            return self.finished(SUCCESS)
+
+        if self.mode == 'link':
+            d = threads.deferToThread(self.store.link, manifest, incoming,
+                self.store.manifest_path(self.upload + ".present"))
+            d.addCallback(self.linked)
+        else:
+            d = threads.deferToThread(self.store.ingest, manifest, incoming,
+                self.dest, self.upload)
+            d.addCallback(self.ingested)
+        d.addErrback(self.store_failed)
+
+    def linked(self, present):
+        self.setProperty('artifact_bytes_present', present, 'ArtifactStore')
+        self.step_status.setText(["artifact store", "linked"])
+        self.finished(SUCCESS)
+
+    def ingested(self, result):
+        total, stored = result
+        present = self.getProperty('artifact_bytes_present') or 0
+        self.setProperty('artifact_bytes_total', total, 'ArtifactStore')
+        self.setProperty('artifact_bytes_uploaded', total - present,
+            'ArtifactStore')
+        self.setProperty('artifact_bytes_stored', stored, 'ArtifactStore')
+        log.msg("Artifact store: %d bytes, %d uploaded, %d stored" % (
+            total, total - present, stored))
+        self.step_status.setText(["artifact store", "%d bytes stored" % stored])
+        self.finished(SUCCESS)
+
+    def store_failed(self, failure):
+        log.err(failure, "Artifact store %s failed" % self.mode)
+        self.step_status.setText(["artifact store", self.mode, "failed"])
+        self.finished(WARNINGS)
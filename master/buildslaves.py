@@ -4,17 +4,193 @@
 import string
 import random
 import re
+import heapq
+import json
+import time
+import threading
+import requests
 from password import *
+from directives import get_directives
+from prometheus import registry, DURATION_BUCKETS
 from buildbot.plugins import util
 from buildbot.buildslave import BuildSlave
 from buildbot.buildslave.ec2 import EC2LatentBuildSlave
+from buildbot.util import datetime2epoch
+from twisted.internet import defer, task
+from twisted.python import log
 
 import socket
 hostname=socket.gethostname()
 my_ip=socket.gethostbyname(hostname)
 
 ### BUILDER CLASSES
+#
+# Returns a property of a change, decoding the JSON values set by github.py.
+#
+def change_property(change, name):
+    properties = change.properties
+    if hasattr(properties, 'getProperty'):
+        value = properties.getProperty(name)
+    else:
+        value = properties.get(name)
+
+    if isinstance(value, basestring):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+
+    return value
+
+#
+# Priority index of the pending build requests for a builder.  Requests are
+# ranked when they are first seen: merges to a branch first, then the head
+# commit of a pull request, then everything else, with the oldest request
+# winning a tie.  Requests for a pull request which has since been pushed
+# again with a different head are superseded by the newer push and never
+# selected, so they don't consume any more slave time.  They're cancelled
+# by the PullRequestQueue when it adds the newer push, see pullqueue.py.
+#
+class BuildRequestIndex(object):
+    RANK_BRANCH = 0
+    RANK_PR_HEAD = 1
+    RANK_OTHER = 2
+
+    def __init__(self, name):
+        self.name = name
+        self.heap = []
+        self.requests = {}
+        self.superseded = set()
+        self.pr_requests = {}
+        self.pr_heads = {}
+
+    @staticmethod
+    def describe(request):
+        """
+        Returns the (rank, pr_number, push) for a request, where push is the
+        (pushed, head) of the pull request push it was created by or None.
+        """
+        rank = BuildRequestIndex.RANK_OTHER
+        pr_number = None
+        push = None
+
+        for change in request.source.changes:
+            directives = get_directives(change)
+
+            if not directives.is_pull_request():
+                rank = min(rank, BuildRequestIndex.RANK_BRANCH)
+                continue
+
+            pr_number = directives.pr_number
+            if directives.is_pull_request_head():
+                rank = min(rank, BuildRequestIndex.RANK_PR_HEAD)
+
+            pushed = change_property(change, 'pr_pushed')
+            head = change_property(change, 'pr_head')
+            if pushed is not None and head is not None:
+                push = max(push, (pushed, head))
+
+        return (rank, pr_number, push)
+
+    def is_superseded(self, pr_number, push):
+        # Changes created before the properties were recorded can't be
+        # placed and are never superseded.  A push of the same head again,
+        # e.g. when a pull request is reopened, doesn't supersede the last.
+        latest = self.pr_heads.get(pr_number)
+        if latest is None or push is None:
+            return False
+
+        return push[0] < latest[0] and push[1] != latest[1]
+
+    def supersede(self, request):
+        log.msg("%s: skipping superseded build request %d" % (
+            self.name, request.id))
+        self.superseded.add(request.id)
+
+    def remove(self, brid):
+        # Entries are removed from the heap lazily by next().
+        request, pr_number = self.requests.pop(brid)
+        if pr_number is not None:
+            del self.pr_requests[pr_number][brid]
+            if not self.pr_requests[pr_number]:
+                del self.pr_requests[pr_number]
+
+    def add(self, request):
+        rank, pr_number, push = self.describe(request)
+
+        if pr_number is not None:
+            if self.is_superseded(pr_number, push):
+                self.supersede(request)
+                return
+
+            # A newer push of this pull request supersedes older requests.
+            # Webhooks are processed asynchronously so the requests of two
+            # pushes may be interleaved, they're told apart by their head.
+            latest = self.pr_heads.get(pr_number)
+            if push is not None and (latest is None or push[0] > latest[0]):
+                self.pr_heads[pr_number] = push
+                for brid, other in list(self.pr_requests.get(pr_number, {}).items()):
+                    if self.is_superseded(pr_number, other):
+                        self.supersede(self.requests[brid][0])
+                        self.remove(brid)
+
+            self.pr_requests.setdefault(pr_number, {})[request.id] = push
+
+        self.requests[request.id] = (request, pr_number)
+        heapq.heappush(self.heap, (rank, request.submittedAt, request.id))
+
+    def update(self, requests):
+        """
+        Synchronize the index with the builder's current pending requests.
+        """
+        current = dict((request.id, request) for request in requests)
+
+        for brid in [brid for brid in self.requests if brid not in current]:
+            self.remove(brid)
+
+        self.superseded.intersection_update(current)
+        for pr_number in [pr for pr in self.pr_heads if pr not in self.pr_requests]:
+            del self.pr_heads[pr_number]
+
+        for brid, request in current.items():
+            if brid in self.requests:
+                self.requests[brid] = (request, self.requests[brid][1])
+            elif brid not in self.superseded:
+                self.add(request)
+
+    def next(self):
+        """
+        Returns the highest priority request, or None.
+        """
+        while self.heap and self.heap[0][2] not in self.requests:
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return None
+
+        return self.requests[self.heap[0][2]][0]
+
+queue_depth = registry.gauge("builder_queue_depth",
+    "Unclaimed build requests per builder", ["builder"])
+queue_oldest = registry.gauge("builder_queue_oldest_seconds",
+    "Age of the oldest unclaimed build request per builder", ["builder"])
+substantiate_seconds = registry.histogram("slave_substantiate_seconds",
+    "Time to substantiate a latent slave", ["ami", "instance_type"],
+    DURATION_BUCKETS)
+substantiate_failures = registry.counter("slave_substantiate_failures_total",
+    "Failed latent slave substantiations", ["ami", "instance_type"])
+warm_pool_active = registry.gauge("warm_pool_active",
+    "Whether the warm pool is keeping slaves substantiated", ["pool"])
+warm_pool_hits = registry.counter("warm_pool_hits_total",
+    "Builds started on a warm slave", ["pool"])
+warm_pool_saved_seconds = registry.counter("warm_pool_saved_seconds_total",
+    "Time to first step saved by starting builds on warm slaves", ["pool"])
+warm_pool_idle_cost = registry.counter("warm_pool_idle_cost_dollars_total",
+    "Spot cost of warm slaves waiting for a build", ["pool"])
+
 class ZFSBuilderConfig(util.BuilderConfig):
+    request_indexes = {}
+
     @staticmethod
     def nextSlave(builder, slaves):
         availableSlave = None
@@ -40,26 +216,15 @@ class ZFSBuilderConfig(util.BuilderConfig):
     # starving smaller pull requests from getting feedback.
     @staticmethod
     def nextBuild(builder, requests):
-        pattern = '^Pull-request:\s*#\d+\s*part\s*(?P<part>\d+)/(?P<total>\d+)$'
-
-        # go thru each request's changes to prioritize them
-        for request in requests:
-            for change in request.source.changes:
-                m = re.search(pattern, change.comments, re.I | re.M)
+        index = ZFSBuilderConfig.request_indexes.get(builder.name)
+        if index is None:
+            index = BuildRequestIndex(builder.name)
+            ZFSBuilderConfig.request_indexes[builder.name] = index
 
-                # if we don't find the pattern, this was a merge to master
-                if m is None:
-                    return request
+        index.update(requests)
 
-                part = int(m.group('part'))
-                total = int(m.group('total'))
-
-                # if the part is the same as the total, then we have the last commit
-                if part == total:
-                    return request
-
-        # we didn't have a merge into master or a final commit on a pull request
-        return requests[0]
+        # None when every pending request was superseded by a newer push
+        return index.next()
 
     def __init__(self, mergeRequests=False, nextSlave=None, nextBuild=None, **kwargs):
         if nextSlave is None:
@@ -72,9 +237,374 @@ class ZFSBuilderConfig(util.BuilderConfig):
                                     nextBuild=nextBuild,
                                     mergeRequests=mergeRequests, **kwargs)
 
+#
+# The state of a builder used to determine its priority.  The static details
+# (slave class, spot price) are recorded once, the rest is refreshed each
+# time the builders are prioritized.
+#
+class BuilderState(object):
+    def __init__(self, name, slave_class=None, spot_price=0.0):
+        self.name = name
+        self.slave_class = slave_class
+        self.spot_price = spot_price
+        self.idle = False
+        self.available = False
+        self.boot_latency = 0.0
+        self.queue_depth = 0
+        self.oldest_request = None
+
+TIER_IDLE = 0
+TIER_AVAILABLE = 1
+TIER_BUSY = 2
+
+def builder_priority(state, now, depth_weight=60.0, cost_weight=3600.0):
+    """
+    Returns the sort key for a builder, lower keys are started first.
+
+    Builders with substantiated, idle slaves are given priority, followed by
+    builders with slaves which can be substantiated, and finally builders
+    which are busy.  Within each tier builders are ordered by the expected
+    time until results are available: the boot latency of the slave class,
+    less a credit for how long the oldest request has waited and how many
+    requests are queued.  The spot cost of booting a slave, converted to
+    seconds by cost_weight, favors the cheaper slaves when they're close.
+    """
+    if state.idle:
+        tier = TIER_IDLE
+        startup = 0.0
+    elif state.available:
+        tier = TIER_AVAILABLE
+        startup = state.boot_latency
+    else:
+        tier = TIER_BUSY
+        startup = state.boot_latency
+
+    cost = startup / 3600.0 * state.spot_price
+    waited = 0.0
+    if state.oldest_request is not None:
+        waited = max(0.0, now - state.oldest_request)
+
+    score = startup + cost * cost_weight - waited - \
+        state.queue_depth * depth_weight
+
+    return (tier, score, state.name)
+
+class BuilderPrioritizer(object):
+    """
+    Called by the buildmaster to prioritize the builders.  Returns a sorted
+    array of builders designed to improve ec2 utilization, see
+    builder_priority() for the ordering.  This helps keep all buildslaves
+    busy while new latent buildslaves are bootstrapped, a process which can
+    take several minutes, and spends the spot budget where it gets results
+    back soonest.
+    """
+    def __init__(self, depth_weight=60.0, cost_weight=3600.0):
+        self.depth_weight = depth_weight
+        self.cost_weight = cost_weight
+        self.states = {}
+
+    def __call__(self, buildmaster, builders):
+        d = buildmaster.db.buildrequests.getBuildRequests(claimed=False)
+        d.addCallback(self.prioritize, builders)
+        return d
+
+    def get_state(self, builder):
+        # The slave class is only known once a slave has attached, and a
+        # reconfig replaces the builder's config and may change its slaves,
+        # so the state is recomputed until then and after every reconfig.
+        cached = self.states.get(builder.name)
+        if cached is not None and cached[0] is builder.config and \
+                cached[1].slave_class is not None:
+            return cached[1]
+
+        slaves = [sb.slave for sb in builder.slaves if sb.slave is not None]
+        if slaves:
+            state = BuilderState(builder.name,
+                slave_class=slaves[0].__class__.__name__,
+                spot_price=getattr(slaves[0], 'max_spot_price', 0.0) or 0.0)
+        else:
+            state = BuilderState(builder.name)
+        self.states[builder.name] = (builder.config, state)
+
+        return state
+
+    def update_state(self, state, builder, depth, oldest):
+        state.idle = False
+        state.available = False
+        for s in builder.slaves:
+            if s.isIdle():
+                state.idle = True
+                break
+
+            if s.isAvailable():
+                state.available = True
+
+        state.boot_latency = ZFSEC2Slave.get_boot_latency(state.slave_class)
+        state.queue_depth = depth
+        state.oldest_request = oldest
+
+    def prioritize(self, brdicts, builders):
+        now = time.time()
+        depths = {}
+        oldest = {}
+        for brdict in brdicts:
+            name = brdict['buildername']
+            submitted = datetime2epoch(brdict['submitted_at'])
+            depths[name] = depths.get(name, 0) + 1
+            if name not in oldest or submitted < oldest[name]:
+                oldest[name] = submitted
+
+        keys = {}
+        for b in builders:
+            state = self.get_state(b)
+            self.update_state(state, b, depths.get(b.name, 0),
+                oldest.get(b.name))
+            keys[b.name] = builder_priority(state, now,
+                depth_weight=self.depth_weight, cost_weight=self.cost_weight)
+
+        sorted_builders = sorted(builders, key=lambda b: keys[b.name])
+
+        queue_depth.replace([({"builder": name}, depth)
+            for name, depth in depths.items()])
+        queue_oldest.replace([({"builder": name}, now - submitted)
+            for name, submitted in oldest.items()])
+
+        log.msg("prioritized %i builder(s): %s" % (len(sorted_builders),
+            [b.name for b in sorted_builders]))
+
+        return sorted_builders
+
 ### BUILD SLAVE CLASSES
+#
+# Warm pool policy for latent slaves.  Test slaves are normally shut down as
+# soon as their build completes, so every build pays for booting an instance
+# and installing its dependencies.  When a policy is active it keeps `size`
+# slaves from its pool substantiated and ready to accept a build, and slaves
+# which finish a build stay up for `idle_timeout` seconds waiting for the
+# next one.  A policy is active between the `hours` (start, end) local time,
+# or while at least `queue_threshold` requests are pending for the pool's
+# builders.  Once inactive the idle slaves are drained.
+#
+# A single policy object is shared by all of the slaves in a pool, e.g.:
+#
+#   pool = WarmPoolPolicy("centos9", size=2, hours=(8, 18))
+#   ZFSEC2TestSlave(name=..., ami=..., warm_pool=pool)
+#
+class WarmPoolPolicy(object):
+    def __init__(self, name, size=1, hours=None, queue_threshold=None,
+                 idle_timeout=1800, interval=60):
+        self.name = name
+        self.size = size
+        self.hours = hours
+        self.queue_threshold = queue_threshold
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.members = []
+        self.active = False
+        self.loop = None
+
+        # Time-to-first-step saved by starting builds on warm slaves and the
+        # spot cost of keeping slaves waiting for work, which are also
+        # exported as the warm_pool_* metrics.
+        self.hits = 0
+        self.seconds_saved = 0.0
+        self.idle_cost = 0.0
+
+    def register(self, slave):
+        self.members.append(slave)
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.tick)
+            d = self.loop.start(self.interval, now=False)
+            d.addErrback(log.err, "in warm pool %s" % self.name)
+
+    def unregister(self, slave):
+        if slave in self.members:
+            self.members.remove(slave)
+        if not self.members and self.loop is not None:
+            self.loop.stop()
+            self.loop = None
+
+    def in_hours(self, now):
+        if self.hours is None:
+            return False
+
+        start, end = self.hours
+        hour = time.localtime(now).tm_hour
+        if start <= end:
+            return start <= hour < end
+
+        return hour >= start or hour < end
+
+    @defer.inlineCallbacks
+    def queue_depth(self):
+        slave = self.members[0]
+        botmaster = slave.botmaster
+        depth = 0
+        for name, builder in botmaster.builders.items():
+            if slave.slavename not in builder.config.slavenames:
+                continue
+
+            brdicts = yield botmaster.master.db.buildrequests.getBuildRequests(
+                buildername=name, claimed=False)
+            depth += len(brdicts)
+
+        defer.returnValue(depth)
+
+    @defer.inlineCallbacks
+    def is_active(self, now):
+        if self.in_hours(now):
+            defer.returnValue(True)
+
+        if self.queue_threshold is not None and self.members:
+            depth = yield self.queue_depth()
+            defer.returnValue(depth >= self.queue_threshold)
+
+        defer.returnValue(False)
+
+    @defer.inlineCallbacks
+    def tick(self):
+        active = yield self.is_active(time.time())
+        if active != self.active:
+            log.msg("warm pool %s %s" % (self.name,
+                "activated" if active else "draining"))
+            self.active = active
+            warm_pool_active.set(1 if active else 0, pool=self.name)
+
+        if active:
+            for slave in self.members:
+                slave.build_wait_timeout = self.idle_timeout
+
+            ready = [s for s in self.members if s.is_warm()]
+            cold = [s for s in self.members if s.is_cold()]
+            for slave in cold[:max(0, self.size - len(ready))]:
+                slave.warm_up()
+        else:
+            for slave in self.members:
+                slave.cool_down()
+
+    def record_hit(self, slave, idle_seconds):
+        saved = ZFSEC2Slave.get_boot_latency(slave.__class__.__name__)
+        self.hits += 1
+        self.seconds_saved += saved
+        warm_pool_hits.inc(pool=self.name)
+        warm_pool_saved_seconds.inc(saved, pool=self.name)
+        self.record_idle(slave, idle_seconds)
+
+        log.msg("warm pool %s: %d builds started warm, %.0fs time-to-first-"
+            "step saved, $%.2f idle spot cost" % (self.name, self.hits,
+            self.seconds_saved, self.idle_cost))
+
+    def record_idle(self, slave, idle_seconds):
+        cost = idle_seconds / 3600.0 * (slave.max_spot_price or 0.0)
+        self.idle_cost += cost
+        warm_pool_idle_cost.inc(cost, pool=self.name)
+
+#
+# Resolves AMIs which are published in an index rather than fixed in the
+# configuration, e.g. the FreeBSD snapshot AMIs.  The index is queried with
+# <url>/<region>/<abi>/<version> and returns the AMI id.
+#
+# get_image() is called by EC2LatentBuildSlave from a worker thread when an
+# instance is started, so lookups are synchronous but thread safe.  Results
+# are cached for `ttl` seconds and concurrent lookups for the same AMI wait
+# on a single request.  Once a result is older than `refresh` seconds it's
+# still returned but updated in the background.  If the index can't be
+# reached the last known good AMI is used.
+#
+class AMIResolver(object):
+    ami_pattern = re.compile(r'^ami-[0-9a-f]+$')
+
+    def __init__(self, url, ttl=3600, refresh=900, timeout=30):
+        self.url = url.rstrip('/')
+        self.ttl = ttl
+        self.refresh = refresh
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.amis = {}
+        self.images = {}
+        self.pending = {}
+
+    def fetch(self, key):
+        url = "%s/%s/%s/%s" % ((self.url,) + key)
+        log.msg("Resolving AMI from '%s'" % url)
+        response = requests.get(url, timeout=self.timeout)
+        response.raise_for_status()
+
+        ami = response.text.strip()
+        if not self.ami_pattern.match(ami):
+            raise ValueError("Invalid AMI '%s' from '%s'" % (ami[:64], url))
+
+        return ami
+
+    def update(self, key, event):
+        try:
+            ami = self.fetch(key)
+            with self.lock:
+                self.amis[key] = (ami, time.time())
+        except Exception as e:
+            log.msg("Unable to resolve AMI for %s: %s" % ("/".join(key), e))
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+    def resolve(self, region, abi, version):
+        key = (region, abi, version)
+
+        with self.lock:
+            cached = self.amis.get(key)
+            age = time.time() - cached[1] if cached else None
+            event = self.pending.get(key)
+            owner = event is None and (cached is None or age >= self.refresh)
+            if owner:
+                event = self.pending[key] = threading.Event()
+
+        if cached is not None and age < self.ttl:
+            if owner:
+                t = threading.Thread(target=self.update, args=(key, event))
+                t.daemon = True
+                t.start()
+            return cached[0]
+
+        if owner:
+            self.update(key, event)
+        else:
+            event.wait(self.timeout)
+
+        with self.lock:
+            cached = self.amis.get(key)
+
+        if cached is None:
+            raise ValueError("Unable to resolve AMI for %s" % "/".join(key))
+        elif time.time() - cached[1] >= self.ttl:
+            log.msg("Using last known good AMI %s for %s" % (cached[0],
+                "/".join(key)))
+
+        return cached[0]
+
+    def get_image(self, slave, region, abi, version):
+        """
+        Intended to be called from a ZFSEC2Slave get_image callback.
+        """
+        slave.ami = self.resolve(region, abi, version)
+
+        with self.lock:
+            image = self.images.get(slave.ami)
+        if image is None:
+            image = slave.conn.get_image(slave.ami)
+            with self.lock:
+                self.images[slave.ami] = image
+
+        return image
+
 # Create large EC2 latent build slave
 class ZFSEC2Slave(EC2LatentBuildSlave):
+    # Moving average of the time taken to substantiate a slave, from the
+    # request until the buildslave connects, for each slave class.
+    boot_latency = {}
+    default_boot_latency = 600.0
+    boot_latency_weight = 0.2
+
     default_user_data = user_data = """#!/bin/sh -x
 # Make /dev/console the serial console instead of the video console
 # so we get our output in the text system log at boot.
@@ -130,6 +660,22 @@ esac
 } 2>&1 | tee /var/log/user-data.log | logger -t user-data -s 2>/dev/console
 """
 
+    @staticmethod
+    def get_boot_latency(slave_class):
+        return ZFSEC2Slave.boot_latency.get(slave_class,
+            ZFSEC2Slave.default_boot_latency)
+
+    @staticmethod
+    def record_boot_latency(slave_class, seconds):
+        average = ZFSEC2Slave.boot_latency.get(slave_class)
+        if average is None:
+            average = seconds
+        else:
+            weight = ZFSEC2Slave.boot_latency_weight
+            average = (1.0 - weight) * average + weight * seconds
+
+        ZFSEC2Slave.boot_latency[slave_class] = average
+
     @staticmethod
     def pass_generator(size=24, chars=string.ascii_uppercase + string.digits):                                         
         return ''.join(random.choice(chars) for _ in range(size))
@@ -142,9 +688,13 @@ esac
                 user_data=None, region="us-west-2", placement='a', max_builds=1,
                 build_wait_timeout=60, spot_instance=False, max_spot_price=0.10,
                 price_multiplier=None, missing_timeout=3600*1,
-                block_device_map=None, get_image=None, **kwargs):
+                block_device_map=None, get_image=None, warm_pool=None,
+                **kwargs):
 
         self.name = name
+        self.warm_pool = warm_pool
+        self.warm_since = None
+        self.default_build_wait_timeout = build_wait_timeout
         bin_path = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
 
         tags = kwargs.get('tags')
@@ -215,6 +765,106 @@ esac
             build_wait_timeout=build_wait_timeout, missing_timeout=missing_timeout,
             placement=placement, block_device_map=block_device_map, **kwargs)
 
+    def substantiate(self, sb, build):
+        if self.substantiated or self.substantiation_deferred is not None:
+            return EC2LatentBuildSlave.substantiate(self, sb, build)
+
+        start = time.time()
+
+        def labels():
+            # The AMI may only be known once the instance is started.
+            ami = getattr(self.instance, 'image_id', None) or self.ami
+            return {"ami": ami or "unknown",
+                    "instance_type": self.instance_type}
+
+        def record(result):
+            if result:
+                ZFSEC2Slave.record_boot_latency(self.__class__.__name__,
+                    time.time() - start)
+                substantiate_seconds.time(start, **labels())
+            else:
+                substantiate_failures.inc(**labels())
+            return result
+
+        def failed(failure):
+            substantiate_failures.inc(**labels())
+            return failure
+
+        d = EC2LatentBuildSlave.substantiate(self, sb, build)
+        d.addCallbacks(record, failed)
+        return d
+
+    def startService(self):
+        EC2LatentBuildSlave.startService(self)
+        if self.warm_pool is not None:
+            self.warm_pool.register(self)
+
+    def stopService(self):
+        if self.warm_pool is not None:
+            self.warm_pool.unregister(self)
+        return EC2LatentBuildSlave.stopService(self)
+
+    def is_warm(self):
+        """
+        The slave is, or soon will be, substantiated and waiting for a build.
+        """
+        if self.building:
+            return False
+
+        return self.substantiated or self.substantiation_deferred is not None
+
+    def is_cold(self):
+        return not self.building and not self.substantiated and \
+            self.substantiation_deferred is None
+
+    def warm_up(self):
+        log.msg("warm pool %s: substantiating %s" % (self.warm_pool.name,
+            self.slavename))
+        self.build_wait_timeout = self.warm_pool.idle_timeout
+        self.warm_since = None
+
+        def ready(result):
+            if result:
+                self.warm_since = time.time()
+            return result
+
+        d = self.substantiate(None, None)
+        d.addCallback(ready)
+        d.addErrback(log.err, "while warming %s" % self.slavename)
+
+    def idle_seconds(self):
+        # A slave shuts itself down after waiting idle_timeout seconds.
+        return min(time.time() - self.warm_since, self.warm_pool.idle_timeout)
+
+    def cool_down(self):
+        self.build_wait_timeout = self.default_build_wait_timeout
+
+        # Only drain the slaves which are being kept waiting by the pool.
+        if self.warm_since is None:
+            return
+
+        self.warm_pool.record_idle(self, self.idle_seconds())
+        self.warm_since = None
+
+        if self.substantiated and not self.building:
+            log.msg("warm pool %s: draining %s" % (self.warm_pool.name,
+                self.slavename))
+            self._soft_disconnect()
+
+    def buildStarted(self, sb):
+        if self.warm_since is not None:
+            self.warm_pool.record_hit(self, self.idle_seconds())
+            self.warm_since = None
+
+        return EC2LatentBuildSlave.buildStarted(self, sb)
+
+    def buildFinished(self, sb):
+        # While the pool is active a slave waits for another build.
+        if self.warm_pool is not None and self.warm_pool.active:
+            self.warm_since = time.time()
+
+        return EC2LatentBuildSlave.buildFinished(self, sb)
+
 class ZFSEC2StyleSlave(ZFSEC2Slave):
     def __init__(self, name, **kwargs):
         ZFSEC2Slave.__init__(self, name, mode="STYLE",
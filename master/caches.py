@@ -0,0 +1,176 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+from buildbot.status.base import StatusReceiverMultiService
+from prometheus import registry
+from twisted.internet import task
+from twisted.python import log
+
+#
+# Instrumented and adaptively sized master caches.
+#
+# The master keeps LRU caches of the objects it reads from the database,
+# sized by c['caches'], and a cache of recent builds per builder, sized by
+# c['caches']['Builds'].  The AdaptiveCaches service samples their hit,
+# miss and eviction counts every interval seconds and exports them as
+# metrics, see prometheus.py.  Evictions are counted by patch 0021.
+#
+# When adaptive, each cache which was full and evicting entries while
+# missing at least min_misses lookups in the last interval is doubled.
+# The sizes are bounded by a memory budget, estimated from the typical
+# size of an entry of each cache.  When the caches grow past the budget the
+# ones with the fewest misses per byte are halved first.  The c['caches']
+# sizes are the minimum sizes, the caches are never shrunk below them.
+#
+# For example:
+#
+#   c['status'].append(AdaptiveCaches(budget=256*1024*1024))
+#
+
+# Estimated bytes per entry of each cache.
+cache_entry_bytes = {
+    'Builds': 256 * 1024,
+    'BuildRequests': 2048,
+    'Changes': 8192,
+    'chdicts': 4096,
+    'SourceStamps': 4096,
+    'ssdicts': 2048,
+    'objectids': 256,
+    'usdicts': 1024,
+}
+default_entry_bytes = 4096
+
+cache_requests = registry.counter("cache_requests_total",
+    "Master cache lookups by result", ["cache", "result"])
+cache_evictions = registry.counter("cache_evictions_total",
+    "Entries evicted from the master caches", ["cache"])
+cache_entries = registry.gauge("cache_entries",
+    "Entries in the master caches", ["cache"])
+cache_max_entries = registry.gauge("cache_max_entries",
+    "Maximum size of the master caches", ["cache"])
+
+def cache_counts(cache):
+    """
+    Returns the (hits, refhits, misses, evictions) of a cache.
+    """
+    return (cache.hits, cache.refhits, cache.misses,
+        getattr(cache, 'evictions', 0))
+
+class AdaptiveCaches(StatusReceiverMultiService):
+    def __init__(self, adaptive=True, budget=256*1024*1024, interval=300,
+                 min_misses=20, target_hit_rate=0.95, entry_bytes=None):
+        StatusReceiverMultiService.__init__(self)
+        self.adaptive = adaptive
+        self.budget = budget
+        self.interval = interval
+        self.min_misses = min_misses
+        self.target_hit_rate = target_hit_rate
+        self.entry_bytes = dict(cache_entry_bytes)
+        self.entry_bytes.update(entry_bytes or {})
+        self.samples = {}
+        self.sizes = {}
+        self.loop = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent
+        self.master = self.parent.master
+
+        self.loop = task.LoopingCall(self.update)
+        self.loop.start(self.interval, now=False)
+
+    def stopService(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+        return StatusReceiverMultiService.stopService(self)
+
+    def caches(self):
+        """
+        Returns a list of (name, kind, cache), kind is the c['caches'] key.
+        """
+        caches = [(name, name, cache) for name, cache in
+            sorted(self.master.caches._caches.items())]
+        for name in self.status.getBuilderNames():
+            builder = self.status.getBuilder(name)
+            caches.append(("Builds:" + name, 'Builds', builder.buildCache))
+
+        return caches
+
+    def bytes_per_entry(self, kind):
+        return self.entry_bytes.get(kind, default_entry_bytes)
+
+    def update(self):
+        try:
+            self.resize(self.sample())
+        except Exception:
+            log.err(None, "Failed to update the master caches")
+
+    def sample(self):
+        """
+        Records the counts of every cache since the last sample, returns a
+        list of (name, kind, cache, (hits, refhits, misses, evictions)).
+        """
+        deltas = []
+        for name, kind, cache in self.caches():
+            current = cache_counts(cache)
+            last = self.samples.get(name, (0, 0, 0, 0))
+            self.samples[name] = current
+            if current[2] < last[2]:
+                # The cache was replaced.
+                last = (0, 0, 0, 0)
+
+            delta = tuple(c - l for c, l in zip(current, last))
+            hits, refhits, misses, evictions = delta
+            cache_requests.inc(hits, cache=name, result="hit")
+            cache_requests.inc(refhits, cache=name, result="refhit")
+            cache_requests.inc(misses, cache=name, result="miss")
+            cache_evictions.inc(evictions, cache=name)
+            cache_entries.set(len(cache.cache), cache=name)
+            cache_max_entries.set(cache.max_size, cache=name)
+
+            deltas.append((name, kind, cache, delta))
+
+        return deltas
+
+    def resize(self, deltas):
+        if not self.adaptive:
+            return
+
+        minimums = self.master.config.caches
+        sizes = {}
+        misses = {}
+        for name, kind, cache, (hits, refhits, missed, evicted) in deltas:
+            size = max(self.sizes.get(name, cache.max_size),
+                minimums.get(kind, 1))
+
+            lookups = hits + refhits + missed
+            hit_rate = float(hits + refhits) / lookups if lookups else 1.0
+            if evicted and missed >= self.min_misses and \
+                    hit_rate < self.target_hit_rate:
+                size *= 2
+
+            sizes[name] = size
+            misses[name] = missed
+
+        def cost(name, kind):
+            return sizes[name] * self.bytes_per_entry(kind)
+
+        # Shrink the caches with the fewest misses per byte until the
+        # estimated total is within the budget.
+        caches = [(name, kind) for name, kind, cache, delta in deltas]
+        for name, kind in sorted(caches,
+                key=lambda c: float(misses[c[0]]) / cost(*c)):
+            minimum = minimums.get(kind, 1)
+            while sum(cost(*c) for c in caches) > self.budget and \
+                    sizes[name] > minimum:
+                sizes[name] = max(minimum, sizes[name] // 2)
+
+        for name, kind, cache, (hits, refhits, missed, evicted) in deltas:
+            if sizes[name] != cache.max_size:
+                log.msg("Resizing cache %s from %d to %d entries, %d misses "
+                    "and %d evictions in %ds" % (name, cache.max_size,
+                    sizes[name], missed, evicted, self.interval))
+                cache.set_max_size(sizes[name])
+
+        self.sizes = sizes
@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+#
+# Maintenance of the master's state database.
+#
+# The DatabaseMaintenance service tunes the sqlite database when the master
+# starts and then periodically moves old changes out of it and prunes the
+# expired build and log files of the builders.  All of the work is done in
+# the database pool or in threads, in batches of batch_size with a pause
+# between them, so neither the reactor nor the database is held for long.
+#
+# - Every connection is opened with the sqlite_pragmas.  The database is
+#   kept in WAL mode, which buildbot enables, and checkpointed after each
+#   run so the WAL doesn't grow without bound.
+# - The sqlite_indexes used by the master's queries which the buildbot
+#   schema lacks are created, e.g. for the pull request branch lookups in
+#   pullqueue.py and the change pruning.
+# - Changes older than change_days, which are no longer referenced by an
+#   incomplete buildset, are appended to a gzip compressed JSON lines file
+#   per month in the archive directory and deleted from the database.  A
+#   batch is written to the archive before it's deleted, so after a crash
+#   the archive may contain a change twice; readers should skip duplicate
+#   numbers.  simulate.py accepts the archive files as --changes.
+# - The build and log files older than build_horizon and log_horizon builds
+#   are removed.  This replaces c['buildHorizon'] and c['logHorizon'],
+#   which are applied by listing and pruning the builder directory in the
+#   reactor after every build, so they should be set to None.
+#
+# It can also be run on the database of a stopped master, and a benchmark
+# on a synthetic database with a year of changes is included:
+#
+#   python dbmaint.py archive --db state.sqlite --days 180
+#   python dbmaint.py benchmark --days 365 --per-day 80
+#
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+from buildbot.db.model import Model
+from buildbot.status.base import StatusReceiverMultiService
+from prometheus import registry, DURATION_BUCKETS
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+
+sqlite_pragmas = [
+    "pragma synchronous = normal",
+    "pragma temp_store = memory",
+    "pragma cache_size = -32768",
+    "pragma mmap_size = 268435456",
+    "pragma busy_timeout = 10000",
+]
+
+# (name, table, columns)
+sqlite_indexes = [
+    ("sourcestamp_changes_changeid", "sourcestamp_changes", "changeid"),
+    ("sourcestamps_branch", "sourcestamps", "branch"),
+    ("buildsets_sourcestampsetid", "buildsets", "sourcestampsetid"),
+]
+
+# Tables referencing a change, in the order they're deleted from.
+change_tables = ('scheduler_changes', 'sourcestamp_changes', 'change_files',
+    'change_properties', 'change_users', 'changes')
+
+changes_archived = registry.counter("db_changes_archived_total",
+    "Changes moved from the database to the archive")
+build_files_pruned = registry.counter("build_files_pruned_total",
+    "Expired build and log files removed")
+maintenance_seconds = registry.histogram("db_maintenance_seconds",
+    "Duration of a database maintenance run", buckets=DURATION_BUCKETS)
+database_bytes = registry.gauge("db_size_bytes",
+    "Size of the state database including its WAL")
+
+def set_pragmas(dbapi_conn, record):
+    cursor = dbapi_conn.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+def tune(conn):
+    """
+    Creates the missing indexes and updates the query planner statistics.
+    """
+    conn.execute("pragma journal_mode = wal")
+    for name, table, columns in sqlite_indexes:
+        conn.execute("create index if not exists %s on %s (%s)" % (name,
+            table, columns))
+    conn.execute("analyze")
+
+def checkpoint(conn):
+    conn.execute("pragma optimize")
+    conn.execute("pragma wal_checkpoint(truncate)")
+
+def chunks(values, size=100):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def pending_changes(conn):
+    """
+    Returns the changes referenced by incomplete buildsets.
+    """
+    bs = Model.buildsets
+    ss = Model.sourcestamps
+    ssc = Model.sourcestamp_changes
+    q = sa.select([ssc.c.changeid],
+        from_obj=[bs.join(ss, ss.c.sourcestampsetid == bs.c.sourcestampsetid)
+            .join(ssc, ssc.c.sourcestampid == ss.c.id)],
+        whereclause=(bs.c.complete == 0))
+
+    return set(row.changeid for row in conn.execute(q))
+
+def archive_record(row, files, properties):
+    return {"number": row.changeid, "author": row.author,
+        "comments": row.comments, "branch": row.branch,
+        "category": row.category, "revision": row.revision,
+        "revlink": row.revlink, "when": row.when_timestamp,
+        "repository": row.repository, "codebase": row.codebase,
+        "project": row.project, "files": files.get(row.changeid, []),
+        "properties": properties.get(row.changeid, {})}
+
+def archive_changes(conn, cutoff, batch_size, directory):
+    """
+    Moves up to batch_size changes made before cutoff to the archive in
+    directory.  Returns the number of changes moved.  Runs in a thread.
+    """
+    changes = Model.changes
+    q = sa.select([changes], whereclause=(changes.c.when_timestamp < cutoff),
+        order_by=[changes.c.changeid], limit=batch_size)
+    pending = pending_changes(conn)
+    if pending:
+        q = q.where(~changes.c.changeid.in_(list(pending)))
+    rows = conn.execute(q).fetchall()
+    if not rows:
+        return 0
+
+    ids = [row.changeid for row in rows]
+    files = {}
+    properties = {}
+    for batch in chunks(ids):
+        tbl = Model.change_files
+        for r in conn.execute(sa.select([tbl.c.changeid, tbl.c.filename],
+                tbl.c.changeid.in_(batch))):
+            files.setdefault(r.changeid, []).append(r.filename)
+
+        # Change properties are stored as JSON [value, source], the source
+        # is always 'Change'.
+        tbl = Model.change_properties
+        for r in conn.execute(sa.select([tbl.c.changeid, tbl.c.property_name,
+                tbl.c.property_value], tbl.c.changeid.in_(batch))):
+            try:
+                value = json.loads(r.property_value)[0]
+            except (ValueError, IndexError, TypeError):
+                continue
+            properties.setdefault(r.changeid, {})[r.property_name] = value
+
+    months = {}
+    for row in rows:
+        month = time.strftime("%Y-%m", time.gmtime(row.when_timestamp))
+        months.setdefault(month, []).append(archive_record(row, files,
+            properties))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Each batch is appended as a new gzip member.
+    for month, records in sorted(months.items()):
+        path = os.path.join(directory, "changes-%s.jsonl.gz" % month)
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                for record in records:
+                    gz.write(json.dumps(record, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    transaction = conn.begin()
+    try:
+        for table_name in change_tables:
+            table = Model.metadata.tables[table_name]
+            for batch in chunks(ids):
+                conn.execute(table.delete(table.c.changeid.in_(batch)))
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+
+    return len(rows)
+
+def expired_build_files(basedir, earliest_build, earliest_log, skip):
+    """
+    Returns the build and log files in basedir which are older than the
+    horizons, the same files BuilderStatus.prune() would remove.  Builds
+    in skip are kept.  Runs in a thread.
+
+    Unlike BuilderStatus.prune(), the logs are pruned even when the builder
+    has fewer builds than the build horizon.
+    """
+    earliest_log = max(earliest_log, earliest_build)
+    if earliest_log <= 0 or not os.path.isdir(basedir):
+        return []
+
+    expired = []
+    for filename in os.listdir(basedir):
+        number, sep, rest = filename.partition("-")
+        if not number.isdigit():
+            continue
+
+        number = int(number)
+        if number in skip:
+            continue
+
+        if number < earliest_build or (sep and number < earliest_log):
+            expired.append(filename)
+
+    return expired
+
+def remove_files(basedir, filenames):
+    removed = 0
+    for filename in filenames:
+        try:
+            os.unlink(os.path.join(basedir, filename))
+            removed += 1
+        except OSError:
+            pass
+
+    return removed
+
+class DatabaseMaintenance(StatusReceiverMultiService):
+    def __init__(self, archive="changes-archive", change_days=180,
+                 build_horizon=None, log_horizon=None, batch_size=200,
+                 pause=0.5, interval=3600, delay=300):
+        StatusReceiverMultiService.__init__(self)
+        self.archive = archive
+        self.change_days = change_days
+        self.build_horizon = build_horizon
+        self.log_horizon = log_horizon
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.delay = delay
+        self.tuned = False
+        self.loop = None
+        self.start_timer = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent
+        self.db = self.parent.master.db
+
+        engine = self.db.pool.engine
+        self.sqlite = engine.dialect.name == 'sqlite'
+        self.path = engine.url.database if self.sqlite else None
+        if self.sqlite and not getattr(engine, 'zfs_pragmas', False):
+            # New connections are opened for every query, see NullPool.
+            sa.event.listen(engine.pool, 'connect', set_pragmas)
+            engine.zfs_pragmas = True
+
+        self.loop = task.LoopingCall(self.run)
+        self.start_timer = reactor.callLater(self.delay, self.loop.start,
+            self.interval)
+
+    def stopService(self):
+        if self.start_timer is not None and self.start_timer.active():
+            self.start_timer.cancel()
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+        return StatusReceiverMultiService.stopService(self)
+
+    def pause_batch(self):
+        return task.deferLater(reactor, self.pause, lambda: None)
+
+    @defer.inlineCallbacks
+    def run(self):
+        start = time.time()
+        try:
+            if self.sqlite and not self.tuned:
+                yield self.db.pool.do(tune)
+                self.tuned = True
+
+            archived = yield self.archive_changes()
+            pruned = yield self.prune_builds()
+
+            if self.sqlite:
+                yield self.db.pool.do(checkpoint)
+                database_bytes.set(sum(os.path.getsize(path)
+                    for path in (self.path, self.path + "-wal")
+                    if os.path.exists(path)))
+
+            log.msg("Database maintenance: %d changes archived, %d build "
+                "files pruned in %.1fs" % (archived, pruned,
+                time.time() - start))
+        except Exception:
+            log.err(None, "Database maintenance failed")
+        finally:
+            maintenance_seconds.time(start)
+
+    @defer.inlineCallbacks
+    def archive_changes(self):
+        total = 0
+        if self.change_days is None:
+            defer.returnValue(total)
+
+        cutoff = int(time.time() - self.change_days * 86400)
+        while self.running:
+            count = yield self.db.pool.do(archive_changes, cutoff,
+                self.batch_size, self.archive)
+            total += count
+            changes_archived.inc(count)
+            if count < self.batch_size:
+                break
+
+            yield self.pause_batch()
+
+        defer.returnValue(total)
+
+    @defer.inlineCallbacks
+    def prune_builds(self):
+        total = 0
+        if self.build_horizon is None and self.log_horizon is None:
+            defer.returnValue(total)
+
+        for name in self.status.getBuilderNames():
+            if not self.running:
+                break
+
+            builder = self.status.getBuilder(name)
+            next_build = builder.nextBuildNumber
+            earliest_build = earliest_log = 0
+            if self.build_horizon is not None:
+                earliest_build = next_build - self.build_horizon
+            if self.log_horizon is not None:
+                earliest_log = next_build - self.log_horizon
+            skip = set(builder.buildCache.cache.keys())
+            skip.update(build.getNumber() for build in builder.currentBuilds)
+
+            expired = yield threads.deferToThread(expired_build_files,
+                builder.basedir, earliest_build, earliest_log, skip)
+
+            for batch in chunks(expired, self.batch_size):
+                removed = yield threads.deferToThread(remove_files,
+                    builder.basedir, batch)
+                total += removed
+                build_files_pruned.inc(removed)
+                yield self.pause_batch()
+
+        defer.returnValue(total)
+
+#
+# Offline archiving and the benchmark.
+#
+def create_engine(path):
+    engine = sa.create_engine("sqlite:///%s" % path,
+        poolclass=sa.pool.NullPool)
+    sa.event.listen(engine.pool, 'connect', set_pragmas)
+
+    return engine
+
+def run_archive(conn, cutoff, batch_size, directory):
+    """
+    Archives every change before cutoff, returns the number of changes
+    and the longest batch in seconds.
+    """
+    total = 0
+    longest = 0.0
+    while True:
+        start = time.time()
+        count = archive_changes(conn, cutoff, batch_size, directory)
+        longest = max(longest, time.time() - start)
+        total += count
+        if count < batch_size:
+            return (total, longest)
+
+def synthetic_database(path, start, days, per_day, builders=12):
+    """
+    Creates a database with per_day changes for days, each built by the
+    builders, about half of them pull requests.  The requests of the last
+    day are pending.
+    """
+    engine = sa.create_engine("sqlite:///%s" % path)
+    Model.metadata.create_all(engine)
+
+    conn = sqlite3.connect(path)
+    changeid = 0
+    for day in range(days):
+        changes, files, props, sets, stamps, links = [], [], [], [], [], []
+        buildsets, requests = [], []
+        for i in range(per_day):
+            changeid += 1
+            when = start + day * 86400 + i * 86400 // per_day
+            if changeid % 2:
+                branch = "refs/pull/%d/head" % (changeid // 10)
+                category = "arch,centos9,fedora38,freebsd14"
+            else:
+                branch = "master"
+                category = "arch,centos9,fedora38,freebsd14,coverage"
+            revision = "%040x" % changeid
+
+            changes.append((changeid, "Author <author@example.com>",
+                "Commit %d\n\nSigned-off-by: Author" % changeid, 0, branch,
+                revision, None, when, category, "https://github.com/openzfs/"
+                "zfs.git", "", "zfs"))
+            for n in range(3):
+                files.append((changeid, "module/zfs/file%d.c" % n))
+            props.append((changeid, "github.number",
+                json.dumps([changeid // 10, "Change"])))
+            props.append((changeid, "event.change",
+                json.dumps(["synchronize", "Change"])))
+            sets.append((changeid,))
+            stamps.append((changeid, branch, revision, None, "https://github"
+                ".com/openzfs/zfs.git", "", "zfs", changeid))
+            links.append((changeid, changeid))
+            complete = int(day < days - 1)
+            buildsets.append((changeid, None, "scheduler", when, complete,
+                when + 3600, 0, changeid))
+            for b in range(builders):
+                requests.append((changeid * builders + b, changeid,
+                    "builder-%d" % b, 0, complete, 0, when, when + 3600))
+
+        conn.executemany("insert into changes (changeid, author, comments, "
+            "is_dir, branch, revision, revlink, when_timestamp, category, "
+            "repository, codebase, project) values "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", changes)
+        conn.executemany("insert into change_files (changeid, filename) "
+            "values (?, ?)", files)
+        conn.executemany("insert into change_properties (changeid, "
+            "property_name, property_value) values (?, ?, ?)", props)
+        conn.executemany("insert into sourcestampsets (id) values (?)", sets)
+        conn.executemany("insert into sourcestamps (id, branch, revision, "
+            "patchid, repository, codebase, project, sourcestampsetid) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?)", stamps)
+        conn.executemany("insert into sourcestamp_changes (sourcestampid, "
+            "changeid) values (?, ?)", links)
+        conn.executemany("insert into buildsets (id, external_idstring, "
+            "reason, submitted_at, complete, complete_at, results, "
+            "sourcestampsetid) values (?, ?, ?, ?, ?, ?, ?, ?)", buildsets)
+        conn.executemany("insert into buildrequests (id, buildsetid, "
+            "buildername, priority, complete, results, submitted_at, "
+            "complete_at) values (?, ?, ?, ?, ?, ?, ?, ?)", requests)
+        conn.commit()
+    conn.close()
+
+    return changeid
+
+def time_queries(path, prs, repeat=20):
+    """
+    Returns the median milliseconds of the master's hot queries: the
+    console's recent changes, and the pull request lookups of pullqueue.py.
+    """
+    conn = sqlite3.connect(path)
+    for pragma in sqlite_pragmas:
+        conn.execute(pragma)
+
+    def console():
+        ids = [r[0] for r in conn.execute("select changeid from changes "
+            "order by changeid desc limit 100")]
+        for changeid in ids:
+            conn.execute("select * from changes where changeid = ?",
+                (changeid,)).fetchall()
+            conn.execute("select filename from change_files where "
+                "changeid = ?", (changeid,)).fetchall()
+            conn.execute("select property_name, property_value from "
+                "change_properties where changeid = ?", (changeid,)).fetchall()
+
+    def pull_requests():
+        for pr in prs:
+            conn.execute("select br.id from buildrequests br "
+                "left outer join buildrequest_claims c on c.brid = br.id "
+                "join buildsets bs on bs.id = br.buildsetid "
+                "join sourcestamps ss on "
+                "ss.sourcestampsetid = bs.sourcestampsetid "
+                "where br.complete = 0 and c.claimed_at is null "
+                "and ss.branch = ?", ("refs/pull/%d/head" % pr,)).fetchall()
+
+    results = {}
+    for name, fn in (("console", console), ("pull requests", pull_requests)):
+        samples = []
+        for i in range(repeat):
+            start = time.time()
+            fn()
+            samples.append(time.time() - start)
+        results[name] = sorted(samples)[len(samples) // 2] * 1000
+    conn.close()
+
+    return results
+
+def stock_prune(path, horizon):
+    """
+    Prunes the changes the way the buildbot changeHorizon does, in a single
+    pool call.  Returns the seconds taken.
+    """
+    conn = sqlite3.connect(path)
+    start = time.time()
+    ids = [r[0] for r in conn.execute("select changeid from changes "
+        "order by changeid desc limit -1 offset ?", (horizon,))]
+    for table in change_tables:
+        for batch in chunks(ids):
+            conn.execute("delete from %s where changeid in (%s)" % (table,
+                ",".join("?" * len(batch))), batch)
+            conn.commit()
+    elapsed = time.time() - start
+    conn.close()
+
+    return elapsed
+
+def database_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal")
+        if os.path.exists(p))
+
+def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="dbmaint-")
+    try:
+        path = os.path.join(workdir, "state.sqlite")
+        start = time.time() - args.days * 86400
+        print("Creating a database with %d changes over %d days..." % (
+            args.days * args.per_day, args.days))
+        count = synthetic_database(path, int(start), args.days, args.per_day)
+        prs = range(count // 10 - 20, count // 10)
+
+        cutoff = int(time.time() - args.keep_days * 86400)
+        conn = sqlite3.connect(path)
+        keep = conn.execute("select count(*) from changes where "
+            "when_timestamp >= ?", (cutoff,)).fetchone()[0]
+        conn.close()
+
+        rows = [("database", "%.1f MB" % (database_size(path) / 1e6))]
+        before = time_queries(path, prs)
+
+        copy = os.path.join(workdir, "stock.sqlite")
+        shutil.copy(path, copy)
+        stock = stock_prune(copy, keep)
+
+        engine = create_engine(path)
+        conn = engine.connect()
+        tune(conn)
+        tuned = time_queries(path, prs)
+        archived, longest = run_archive(conn, cutoff, args.batch_size,
+            os.path.join(workdir, "archive"))
+        checkpoint(conn)
+        conn.execute("vacuum")
+        conn.close()
+        after = time_queries(path, prs)
+
+        archive_size = sum(os.path.getsize(os.path.join(workdir, "archive",
+            name)) for name in os.listdir(os.path.join(workdir, "archive")))
+
+        rows.extend([
+            ("console, untuned", "%.1f ms" % before["console"]),
+            ("console, indexed", "%.1f ms" % tuned["console"]),
+            ("console, archived", "%.1f ms" % after["console"]),
+            ("pull requests, untuned", "%.1f ms" % before["pull requests"]),
+            ("pull requests, indexed", "%.1f ms" % tuned["pull requests"]),
+            ("pull requests, archived", "%.1f ms" % after["pull requests"]),
+            ("stock prune, one call", "%.2f s" % stock),
+            ("archive, %d changes" % archived, "%d batches of %d" % (
+                (archived + args.batch_size - 1) // args.batch_size,
+                args.batch_size)),
+            ("archive, longest batch", "%.3f s" % longest),
+            ("database, archived", "%.1f MB" % (database_size(path) / 1e6)),
+            ("archive files", "%.1f MB" % (archive_size / 1e6)),
+        ])
+        for name, value in rows:
+            print("%-32s %s" % (name, value))
+    finally:
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Maintain the master's state database.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    archive = subparsers.add_parser("archive",
+        help="archive the old changes of a stopped master")
+    archive.add_argument("--db", default="state.sqlite",
+        help="state database (default: %(default)s)")
+    archive.add_argument("--archive", default="changes-archive",
+        help="archive directory (default: %(default)s)")
+    archive.add_argument("--days", type=int, default=180,
+        help="changes kept in the database (default: %(default)s)")
+    archive.add_argument("--batch-size", type=int, default=200,
+        help="changes archived per batch (default: %(default)s)")
+    archive.add_argument("--vacuum", action="store_true",
+        help="reclaim the free space once archived")
+
+    bench = subparsers.add_parser("benchmark",
+        help="benchmark on a synthetic database")
+    bench.add_argument("--days", type=int, default=365,
+        help="days of changes (default: %(default)s)")
+    bench.add_argument("--per-day", type=int, default=80,
+        help="changes per day (default: %(default)s)")
+    bench.add_argument("--keep-days", type=int, default=30,
+        help="changes kept in the database (default: %(default)s)")
+    bench.add_argument("--batch-size", type=int, default=200,
+        help="changes archived per batch (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args)
+        return
+
+    engine = create_engine(args.db)
+    conn = engine.connect()
+    tune(conn)
+    cutoff = int(time.time() - args.days * 86400)
+    archived, longest = run_archive(conn, cutoff, args.batch_size,
+        args.archive)
+    checkpoint(conn)
+    if args.vacuum:
+        conn.execute("vacuum")
+    conn.close()
+    print("Archived %d changes to %s, longest batch %.3fs" % (archived,
+        args.archive, longest))
+
+if __name__ == "__main__":
+    main()
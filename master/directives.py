@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+import argparse
+import random
+import re
+import string
+import sys
+import time
+
+#
+# Commit message directives.
+#
+# Developers may control how a change is built by adding directives to the
+# commit message, one per line, e.g. "Requires-builders: style,arch".  The
+# buildbot also appends a "Pull-request: #N part x/y" trailer to every commit
+# which is part of a pull request.  All of the directives are parsed in a
+# single pass over the commit message and the result is cached on the change
+# so the schedulers and builders never need to scan the message again.
+#
+# The benchmark command compares this to searching the whole message with a
+# regex per directive, as was done before, on synthetic commit messages.
+#
+
+_yes_no = re.compile(r'\s*(yes|no)\s*$', re.I)
+_anything = re.compile(r'(.*)$')
+_builders = re.compile(r'\s*([ ,a-zA-Z0-9]+)')
+_kernel = re.compile(r'\s*([a-zA-Z0-9_\-\:\/\+\.]+)')
+_pull_request = re.compile(r'\s*#(\d+)\s*part\s*(\d+)/(\d+)$', re.I)
+
+# Matches the "<word><separator><word>:<value>" form shared by all directives.
+_line_pattern = re.compile(r'([A-Za-z]+)([-|\s])([A-Za-z]+):(.*)')
+
+# The directive name (lower case, '-' separated) maps to the separators which
+# are accepted in the name, the pattern for its value, and the name of the
+# build property which is overridden.  A property of None indicates the
+# directive is handled specially by Directives.
+_directives = {
+    'build-linux':       ('-' + string.whitespace, _yes_no, 'override-buildlinux'),
+    'build-zfs':         ('-' + string.whitespace, _yes_no, 'override-buildzfs'),
+    'built-in':          ('-' + string.whitespace, _yes_no, 'override-builtin'),
+    'check-lint':        ('-' + string.whitespace, _yes_no, 'override-checklint'),
+    'configure-zfs':     ('-|' + string.whitespace, _anything, 'override-configzfs'),
+    'perf-zts':          ('-|' + string.whitespace, _yes_no, 'override-perfzts'),
+    'perf-pts':          ('-|' + string.whitespace, _yes_no, 'override-perfpts'),
+    'requires-builders': ('-', _builders, None),
+    'requires-kernel':   ('-', _kernel, None),
+    'pull-request':      ('-', _pull_request, None),
+}
+
+class Directives(object):
+    """
+    The directives found in a commit message.  Only the first occurrence of
+    each directive is used.
+
+    properties  - dict of overridden build properties, values are lower case
+    builders    - Requires-builders value (lower case) or None
+    kernel      - Requires-kernel value or None
+    pr_number   - pull request number or None for branch commits
+    pr_part     - position of the commit in the pull request or None
+    pr_total    - number of commits in the pull request or None
+    """
+    def __init__(self):
+        self.properties = {}
+        self.builders = None
+        self.kernel = None
+        self.pr_number = None
+        self.pr_part = None
+        self.pr_total = None
+
+    def is_pull_request(self):
+        return self.pr_number is not None
+
+    def is_pull_request_head(self):
+        return self.pr_number is not None and self.pr_part == self.pr_total
+
+def parse_directives(comments):
+    """
+    Returns the Directives for the provided commit message.
+    """
+    result = Directives()
+    seen = set()
+
+    for line in comments.splitlines():
+        m = _line_pattern.match(line)
+        if m is None:
+            continue
+
+        name = "%s-%s" % (m.group(1).lower(), m.group(3).lower())
+        if name in seen or name not in _directives:
+            continue
+
+        separators, pattern, prop = _directives[name]
+        if m.group(2) not in separators:
+            continue
+
+        v = pattern.match(m.group(4))
+        if v is None:
+            continue
+
+        seen.add(name)
+        if prop is not None:
+            result.properties[prop] = v.group(1).lower()
+        elif name == 'requires-builders':
+            result.builders = v.group(1).lower()
+        elif name == 'requires-kernel':
+            result.kernel = v.group(1)
+        elif name == 'pull-request':
+            result.pr_number = int(v.group(1))
+            result.pr_part = int(v.group(2))
+            result.pr_total = int(v.group(3))
+
+    return result
+
+def get_directives(change):
+    """
+    Returns the Directives for a change, parsing its comments only once.
+    """
+    directives = getattr(change, 'directives', None)
+    if directives is None:
+        directives = parse_directives(change.comments)
+        change.directives = directives
+
+    return directives
+
+#
+# Benchmark.
+#
+_search_patterns = [
+    ('override-buildlinux', r'^Build[-\s]linux:\s*(yes|no)\s*$'),
+    ('override-buildzfs', r'^Build[-\s]zfs:\s*(yes|no)\s*$'),
+    ('override-builtin', r'^Built[-\s]in:\s*(yes|no)\s*$'),
+    ('override-checklint', r'^Check[-\s]lint:\s*(yes|no)\s*$'),
+    ('override-configzfs', r'^Configure[-|\s]zfs:(.*)$'),
+    ('override-perfzts', r'^Perf[-|\s]zts:\s*(yes|no)\s*$'),
+    ('override-perfpts', r'^Perf[-|\s]pts:\s*(yes|no)\s*$'),
+    ('builders', r'^Requires-builders:\s*([ ,a-zA-Z0-9]+)'),
+    ('kernel', r'^Requires-kernel:\s*([a-zA-Z0-9_\-\:\/\+\.]+)'),
+    ('pull-request', r'^Pull-request:\s*#(\d+)\s*part\s*(\d+)/(\d+)$'),
+]
+
+def search_directives(comments):
+    """
+    Returns the directives found by searching the message with a regex per
+    directive, which is how they were parsed before.
+    """
+    result = {}
+    for name, pattern in _search_patterns:
+        m = re.search(pattern, comments, re.I | re.M)
+        if m is not None:
+            result[name] = m.groups()
+
+    return result
+
+def synthetic_message(rng, pr_number, part, total):
+    words = ["zfs", "spa", "arc", "zil", "vdev", "dmu", "fix", "the", "when",
+        "pool", "import", "txg", "leak", "race", "lock", "send", "recv"]
+
+    lines = [" ".join(rng.choice(words) for i in range(8)), ""]
+    for paragraph in range(rng.randint(1, 4)):
+        for line in range(rng.randint(2, 8)):
+            lines.append(" ".join(rng.choice(words) for i in range(11)))
+        lines.append("")
+
+    if rng.random() < 0.2:
+        lines.append("Requires-builders: style,arch,centos9")
+    if rng.random() < 0.1:
+        lines.append("Build-linux: yes")
+    if rng.random() < 0.05:
+        lines.append("Requires-kernel: v6.6")
+    for i in range(rng.randint(1, 3)):
+        lines.append("Reviewed-by: Developer %d <dev%d@example.org>" % (i, i))
+    lines.append("Signed-off-by: Developer <dev@example.org>")
+    lines.append("Closes #%d" % rng.randint(1, 16000))
+    lines.append("")
+    lines.append("Pull-request: #%d part %d/%d" % (pr_number, part, total))
+
+    return "\n".join(lines) + "\n"
+
+class _Change(object):
+    def __init__(self, comments):
+        self.comments = comments
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    messages = []
+    while len(messages) < args.messages:
+        pr_number = rng.randint(1, 16000)
+        total = rng.randint(1, 5)
+        for part in range(1, total + 1):
+            messages.append(synthetic_message(rng, pr_number, part, total))
+
+    # Both parsers must agree on every message.
+    for comments in messages:
+        old = search_directives(comments)
+        new = parse_directives(comments)
+        assert new.properties == dict((name, value[0].lower())
+            for name, value in old.items() if name.startswith('override-'))
+        assert new.builders == (old['builders'][0].lower()
+            if 'builders' in old else None)
+        assert new.kernel == old.get('kernel', (None,))[0]
+        assert (new.pr_number, new.pr_part, new.pr_total) == \
+            tuple(int(v) for v in old['pull-request'])
+
+    changes = [_Change(comments) for comments in messages]
+    rows = []
+    for name, fn, items in (
+            ("regex per directive", search_directives, messages),
+            ("single pass", parse_directives, messages),
+            ("cached on the change", get_directives, changes)):
+        start = time.time()
+        for i in range(args.passes):
+            for item in items:
+                fn(item)
+        elapsed = time.time() - start
+        rows.append((name, 1e6 * elapsed / (args.passes * len(items))))
+
+    print("%d messages, %d passes" % (len(messages), args.passes))
+    for name, us in rows:
+        print("%-24s %8.1f us/message" % (name, us))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parse the directives in commit messages.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parse = subparsers.add_parser("parse",
+        help="print the directives in a commit message read from stdin")
+
+    bench = subparsers.add_parser("benchmark",
+        help="benchmark on synthetic commit messages")
+    bench.add_argument("--messages", type=int, default=2000,
+        help="commit messages (default: %(default)s)")
+    bench.add_argument("--passes", type=int, default=10,
+        help="times each message is parsed, e.g. once by the webhook and "
+        "then by every scheduling pass (default: %(default)s)")
+    bench.add_argument("--seed", type=int, default=0,
+        help="random seed (default: %(default)s)")
+
+    args = parser.parse_args()
+    if args.command == "parse":
+        directives = parse_directives(sys.stdin.read())
+        for name in sorted(vars(directives)):
+            print("%-12s %r" % (name, getattr(directives, name)))
+    else:
+        benchmark(args)
+
+if __name__ == "__main__":
+    main()
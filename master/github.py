@@ -1,16 +1,31 @@
 # -*- python -*-
 # ex: set syntax=python:
 
+import argparse
+import BaseHTTPServer
 import logging
-import urllib2
 import json
 import string
 import re
+import os
+import SocketServer
+import threading
+import time
+import urllib2
 
+from collections import OrderedDict
+from io import BytesIO
 from password import *
+from directives import parse_directives
+from impact import Impact, analyze
+from prometheus import registry
 from buildbot.status.web.hooks.github import GitHubEventHandler
 from dateutil.parser import parse as dateparse
+from twisted.internet import defer, reactor
 from twisted.python import log
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
 
 builders_common="arch,"
 builders_linux="centos7,centos8,centos9,centosstream8,fedora37,fedora38,builtin,"
@@ -25,47 +40,363 @@ builders_pr_release=builders_common+builders_linux+builders_freebsd
 # Default builders for non-top PR commits
 builders_pr_minimum="arch"
 
-def query_url(url, token=None):
-    log.msg("Making request to '%s'" % url)
-    request = urllib2.Request(url)
+# The platform tested by each builder, see impact.py.  Builders which aren't
+# listed here are always run.
+builders_platform = dict(
+    [(name, 'linux') for name in builders_linux.split(",") if name] +
+    [(name, 'freebsd') for name in builders_freebsd.split(",") if name] +
+    [('coverage', 'linux')])
+
+def narrow_builders(category, impact):
+    """
+    Returns the builders in the category which test a platform affected by
+    the change.
+    """
+    if impact.platforms is None:
+        return category
+
+    builders = []
+    for name in category.split(","):
+        platform = builders_platform.get(name)
+        if name and (platform is None or impact.has_platform(platform)):
+            builders.append(name)
+
+    return ",".join(builders)
+
+github_api_url = "https://api.github.com"
+
+# Maximum number of concurrent GitHub API requests.
+github_max_requests = 8
+
+# All GitHub API requests share a pool of keep-alive connections.  Requests
+# are issued asynchronously so the webhook never blocks the reactor.
+github_pool = HTTPConnectionPool(reactor, persistent=True)
+github_pool.maxPersistentPerHost = github_max_requests
+github_agent = Agent(reactor, pool=github_pool)
+github_semaphore = defer.DeferredSemaphore(github_max_requests)
+
+github_requests = registry.counter("github_api_requests_total",
+    "GitHub API requests by method and result", ["method", "result"])
+github_seconds = registry.histogram("github_api_request_seconds",
+    "GitHub API request latency, excluding time queued for a connection",
+    ["method"])
+webhook_events = registry.counter("github_webhook_events_total",
+    "GitHub webhook events by event type and result", ["event", "result"])
+webhook_seconds = registry.histogram("github_webhook_seconds",
+    "Time to handle a GitHub webhook event", ["event"])
+
+class GitHubAPIError(Exception):
+    pass
+
+#
+# Cache of GitHub API responses.  Commit objects are immutable so once
+# fetched they are served directly from the cache using their SHA as the
+# key.  All other responses (e.g. the commit list for a pull request) are
+# stored along with their ETag and revalidated with a conditional request,
+# a 304 response does not count against the API rate limit.  The cache is
+# bounded in size, evicting the least recently used entries, and may be
+# saved to disk so a master restart doesn't begin with an empty cache.
+# Only the fields of the commits read by CustomGitHubEventHandler are kept,
+# not e.g. the patch of every file.
+#
+class GitHubCache(object):
+    commit_pattern = re.compile(r'/commits/([0-9a-f]{40})$')
+
+    def __init__(self, size=2048, path=None, save_delay=30):
+        self.size = size
+        self.path = None
+        self.save_delay = save_delay
+        self.save_timer = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+        self.set_path(path)
+
+    def set_path(self, path):
+        """
+        Sets the file the cache is saved to, and loads it.
+        """
+        if path == self.path:
+            return
+
+        self.path = path
+        self.load()
+
+    @staticmethod
+    def strip_commit(commit):
+        stripped = {}
+        for name in ('sha', 'url', 'html_url'):
+            if name in commit:
+                stripped[name] = commit[name]
+
+        if 'commit' in commit:
+            committer = commit['commit'].get('committer') or {}
+            stripped['commit'] = {
+                'message': commit['commit'].get('message'),
+                'committer': dict((name, committer.get(name))
+                    for name in ('name', 'email', 'date')),
+            }
+
+        if 'files' in commit:
+            stripped['files'] = [{'filename': f['filename']}
+                for f in commit['files']]
+
+        return stripped
+
+    def strip(self, data):
+        """
+        Returns the fields of a commit, or list of commits, which are read.
+        """
+        if isinstance(data, list):
+            return [self.strip(item) for item in data]
+        if isinstance(data, dict) and 'sha' in data:
+            return self.strip_commit(data)
+
+        return data
+
+    def key(self, url):
+        m = self.commit_pattern.search(url)
+        if m is not None:
+            return "commit:" + m.group(1)
+
+        return url
+
+    def get(self, url):
+        """
+        Returns the (etag, data) tuple cached for url, or None.
+        """
+        key = self.key(url)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+
+        return entry
+
+    def put(self, url, etag, data):
+        key = self.key(url)
+        self.entries.pop(key, None)
+        self.entries[key] = (etag, self.strip(data))
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        self.schedule_save()
+
+    def is_immutable(self, url):
+        return self.key(url).startswith("commit:")
+
+    def stats(self):
+        return "GitHub cache: %d entries, %d hits, %d misses, %d not modified" % (
+            len(self.entries), self.hits, self.misses, self.not_modified)
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            log.msg("Unable to load GitHub cache '%s': %s" % (self.path, e))
+            return
+
+        for key, etag, data in entries[-self.size:]:
+            self.entries[key] = (etag, data)
+
+    def save(self):
+        self.save_timer = None
+        if self.path is None:
+            return
+
+        entries = [[key, etag, data]
+            for key, (etag, data) in self.entries.items()]
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.msg("Unable to save GitHub cache '%s': %s" % (self.path, e))
+
+    def schedule_save(self):
+        # Coalesce the updates from a burst of requests in to a single write.
+        if self.path is not None and self.save_timer is None:
+            self.save_timer = reactor.callLater(self.save_delay, self.save)
+
+# The path is set by master.cfg, relative to the master's basedir.
+github_cache = GitHubCache(size=2048)
+
+def encode_url(url):
+    # The URLs in the webhook payloads and API responses are decoded JSON,
+    # the Agent only accepts byte strings.
+    if isinstance(url, unicode):
+        return url.encode("utf-8")
+
+    return url
+
+@defer.inlineCallbacks
+def _query_url(url, token=None, etag=None):
+    headers = Headers({"User-Agent": ["zfs-buildbot"]})
     if token:
-        request.add_header("Authorization", "token %s" % token)
-    response = urllib2.urlopen(request)
+        headers.addRawHeader("Authorization", "token %s" % token)
+    if etag:
+        headers.addRawHeader("If-None-Match", etag)
+
+    start = time.time()
+    try:
+        response = yield github_agent.request("GET", encode_url(url),
+            headers)
+        body = yield readBody(response)
+    except Exception:
+        github_requests.inc(method="GET", result="error")
+        raise
+    finally:
+        github_seconds.time(start, method="GET")
+
+    if response.code == 304:
+        github_requests.inc(method="GET", result="not_modified")
+        defer.returnValue((etag, None))
+    elif response.code != 200:
+        github_requests.inc(method="GET", result="error")
+        raise GitHubAPIError("Request to '%s' failed: %d %s" % (
+            url, response.code, response.phrase))
+
+    github_requests.inc(method="GET", result="ok")
+
+    etags = response.headers.getRawHeaders("ETag")
+    defer.returnValue((etags[0] if etags else None, json.loads(body)))
+
+def query_url(url, token=None, cache=github_cache):
+    """
+    Returns a Deferred which fires with the decoded JSON response for url.
+    """
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and cache.is_immutable(url):
+        cache.hits += 1
+        github_requests.inc(method="GET", result="cached")
+        return defer.succeed(entry[1])
+
+    def update(result):
+        etag, data = result
+        if data is None:
+            cache.not_modified += 1
+            return entry[1]
+
+        cache.misses += 1
+        cache.put(url, etag, data)
+        return cache.strip(data)
 
-    return json.loads(response.read())
+    log.msg("Making request to '%s'" % url)
+    etag = entry[0] if entry is not None else None
+    d = github_semaphore.run(_query_url, url, token=token, etag=etag)
+    if cache is not None:
+        d.addCallback(update)
+    else:
+        d.addCallback(lambda result: result[1])
+
+    return d
+
+def query_urls(urls, token=None):
+    """
+    Returns a Deferred which fires with a list of the decoded JSON responses
+    for urls, in the same order.  The requests are issued concurrently.
+    """
+    def unwrap(failure):
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+
+    d = defer.gatherResults([query_url(url, token=token) for url in urls],
+        consumeErrors=True)
+    d.addErrback(unwrap)
+
+    return d
+
+@defer.inlineCallbacks
+def _post_url(url, data, token=None):
+    headers = Headers({"User-Agent": ["zfs-buildbot"],
+                       "Content-Type": ["application/json"]})
+    if token:
+        headers.addRawHeader("Authorization", "token %s" % token)
+
+    body = FileBodyProducer(BytesIO(json.dumps(data)))
+    start = time.time()
+    try:
+        response = yield github_agent.request("POST", encode_url(url),
+            headers, body)
+        yield readBody(response)
+    except Exception:
+        github_requests.inc(method="POST", result="error")
+        raise
+    finally:
+        github_seconds.time(start, method="POST")
+
+    if response.code not in (200, 201):
+        github_requests.inc(method="POST", result="error")
+        raise GitHubAPIError("Request to '%s' failed: %d %s" % (
+            url, response.code, response.phrase))
+
+    github_requests.inc(method="POST", result="ok")
+
+def post_status(owner, repo, sha, state, context, description,
+                target_url=None, token=None):
+    """
+    Returns a Deferred which fires once the commit status has been set.
+    The state is one of 'pending', 'success', 'failure' or 'error'.
+    """
+    url = "%s/repos/%s/%s/statuses/%s" % (github_api_url, owner, repo, sha)
+    data = {"state": state, "context": context, "description": description}
+    if target_url:
+        data["target_url"] = target_url
+
+    log.msg("Setting status '%s' for '%s' to %s" % (context, sha, state))
+    return github_semaphore.run(_post_url, url, data, token=token)
 
 #
 # Custom class to determine how to handle incoming Github changes.
 #
 class CustomGitHubEventHandler(GitHubEventHandler):
-    valid_props = [
-        ('^Build[-\s]linux:\s*(yes|no)\s*$', 'override-buildlinux'),
-        ('^Build[-\s]zfs:\s*(yes|no)\s*$', 'override-buildzfs'),
-        ('^Built[-\s]in:\s*(yes|no)\s*$', 'override-builtin'),
-        ('^Check[-\s]lint:\s*(yes|no)\s*$', 'override-checklint'),
-        ('^Configure[-|\s]zfs:(.*)$', 'override-configzfs'),
-        ('^Perf[-|\s]zts:\s*(yes|no)\s*$', 'override-perfzts'),
-        ('^Perf[-|\s]pts:\s*(yes|no)\s*$', 'override-perfpts'),
-    ]
-
-    def parse_comments(self, comments, default_category):
+    # Pull request events are debounced by the PullRequestQueue, when set.
+    queue = None
+
+    def process(self, request):
+        event = request.getHeader("X-GitHub-Event") or "unknown"
+        start = time.time()
+
+        def done(result, outcome):
+            webhook_seconds.time(start, event=event)
+            webhook_events.inc(event=event, result=outcome)
+            return result
+
+        d = defer.maybeDeferred(GitHubEventHandler.process, self, request)
+        d.addCallbacks(done, done, callbackArgs=("ok",),
+            errbackArgs=("error",))
+
+        return d
+
+    def parse_comments(self, directives, default_category):
         category = default_category
 
         # Extract any overrides for builders for this commit
         # Requires-builders: build arch distro test perf none
-        category_pattern = '^Requires-builders:\s*([ ,a-zA-Z0-9]+)'
-        m = re.search(category_pattern, comments, re.I | re.M)
-        if m is not None:
-            category = m.group(1).lower();
+        if directives.builders is not None:
+            category = directives.builders
 
             # If Requires-builders contains 'none', then skip this commit
-            none_pattern = '.*none.*'
-            m = re.search(none_pattern, category, re.I | re.M)
-            if m is not None:
+            if 'none' in category:
                 category = ""
 
         return category
 
+    def parse_properties(self, directives):
+        # Extract if the commit message has property overrides
+        props = { }
+        for prop_name, value in directives.properties.items():
+            props[prop_name] = json.dumps(value)
+
+        return props
+
     def handle_push_commit(self, payload, commit, branch):
         created_at = dateparse(commit['timestamp'])
         comments = commit['message']
@@ -75,22 +406,22 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         for kind in ('added', 'modified', 'removed'):
             files.extend(commit.get(kind, []))
 
-        # Extract if the commit message has property overrides
-        props = { }
-        for prop in CustomGitHubEventHandler.valid_props:
-            step_pattern = prop[0]
-            m = re.search(step_pattern, comments, re.I | re.M)
-            if m is not None:
-                prop_name = prop[1]
-                props[prop_name] = json.dumps(m.group(1).lower())
+        directives = parse_directives(comments)
+        props = self.parse_properties(directives)
+
+        # The impact is only logged, every platform and the full test suite
+        # are always run for branches, their results are the baseline for
+        # the known issues report.
+        impact = analyze(files)
+        log.msg("Commit `%s' %r" % (commit['id'], impact))
 
         match = re.match("master", branch)
         if match:
-            category = self.parse_comments(comments, builders_push_master)
+            category = self.parse_comments(directives, builders_push_master)
         else:
             # Extract if the commit message has property overrides
             # For 0.8 and earlier releases include the legacy builders.
-            category = self.parse_comments(comments, builders_push_release)
+            category = self.parse_comments(directives, builders_push_release)
 
         props['branch'] = branch
 
@@ -159,7 +490,7 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         return changes, 'git'
 
     def handle_pull_request_commit(self, payload, commit, nr, commits_nr,
-                                   kernel_pr):
+                                   kernel_pr, impact, received):
 
         pr_number = payload['number']
         refname = 'refs/pull/%d/head' % (pr_number,)
@@ -172,14 +503,8 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         for f in commit['files']:
             changed_files.append(f['filename'])
 
-        # Extract if the commit message has property overrides
-        props = { }
-        for prop in CustomGitHubEventHandler.valid_props:
-            step_pattern = prop[0]
-            m = re.search(step_pattern, comments, re.I | re.M)
-            if m is not None:
-                prop_name = prop[1]
-                props[prop_name] = json.dumps(m.group(1).lower())
+        directives = parse_directives(comments)
+        props = self.parse_properties(directives)
 
         # Annotate the head commit to allow special handling.
         if commit['sha'] == payload['pull_request']['head']['sha']:
@@ -193,11 +518,15 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         else:
             category = builders_pr_minimum
 
-        # Extract if the commit message has property overrides
-        category = self.parse_comments(comments, category)
+        # Only test the platforms and test areas affected by the pull
+        # request, unless overridden by the commit message.
+        category = self.parse_comments(directives,
+            narrow_builders(category, impact))
+        if impact.tags is not None:
+            props['zfstests_tags'] = json.dumps(impact.get_tags())
 
         if kernel_pr:
-            if re.search(kernel_pattern, comments, re.I | re.M) is None:
+            if directives.kernel is None:
                 comments = comments + kernel_pr + "\n"
 
         comments = comments + "Pull-request: #%d part %d/%d\n" % (
@@ -206,6 +535,12 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         props['branch'] = json.dumps(branch)
         props['pr_number'] = json.dumps(pr_number)
 
+        # Every commit of a push records the head it was pushed with and
+        # when the event was received, so the build requests of an older
+        # push can be recognized and skipped, see BuildRequestIndex.
+        props['pr_head'] = json.dumps(payload['pull_request']['head']['sha'])
+        props['pr_pushed'] = json.dumps(received)
+
         # Disabled performance testing on PRs by default.
         props['perfpts'] = json.dumps("no")
         props['perfzts'] = json.dumps("no")
@@ -233,7 +568,25 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         return change
 
     def handle_pull_request(self, payload):
+        if self.queue is None:
+            return self.process_pull_request(payload)
+
+        # The changes are added by the queue once the pull request has
+        # stopped changing, see pullqueue.py.
+        action = payload.get('action')
+        if action in self.queue.actions:
+            self.queue.add(payload)
+        elif action == 'closed':
+            self.queue.discard(payload)
+
+        log.msg("GitHub PR #%d %s, queued" % (payload['number'], action))
+        return [], 'git'
+
+    @defer.inlineCallbacks
+    def process_pull_request(self, payload, received=None):
         changes = []
+        if received is None:
+            received = time.time()
         pr_number = payload['number']
         commits_nr = payload['pull_request']['commits']
 
@@ -242,39 +595,207 @@ class CustomGitHubEventHandler(GitHubEventHandler):
         action = payload.get('action')
         if action not in ('opened', 'reopened', 'synchronize'):
             log.msg("GitHub PR #%d %s, ignoring" % (pr_number, action))
-            return changes, 'git'
+            defer.returnValue((changes, 'git'))
 
         # When receiving a large PR only test the top commit.
         if commits_nr > 5:
             commit_url = payload['pull_request']['base']['repo']['commits_url'][:-6]
             commit_url += "/" + payload['pull_request']['head']['sha']
-            commit = query_url(commit_url, token=github_token)
+            commit = yield query_url(commit_url, token=github_token)
+
+            # Only the files modified by the top commit are known, the
+            # impact of the whole pull request can't be determined.
             change = self.handle_pull_request_commit(payload, commit,
-                commits_nr, commits_nr, None)
+                commits_nr, commits_nr, None, Impact(), received)
             changes.append(change)
         # Compile all commits in the stack and test the top commit.
         else:
             commits_url = payload['pull_request']['commits_url']
-            commits = query_url(commits_url, token=github_token)
+            commits = yield query_url(commits_url, token=github_token)
 
             kernel_pr = None
-            kernel_pattern = '^Requires-kernel:\s*([a-zA-Z0-9_\-\:\/\+\.]+)'
             for commit in commits:
-                comments = commit['commit']['message']
-                m = re.search(kernel_pattern, comments, re.I | re.M)
-                if m is not None:
-                    kernel_pr = 'Requires-kernel: %s' % m.group(1)
+                directives = parse_directives(commit['commit']['message'])
+                if directives.kernel is not None:
+                    kernel_pr = 'Requires-kernel: %s' % directives.kernel
                     break
 
+            # Fetch the details for every commit in the stack concurrently.
+            commits = yield query_urls([commit['url'] for commit in commits],
+                token=github_token)
+
+            # The top commit is tested with every change in the stack, so
+            # the impact is determined by all of the modified files.
+            files = set()
+            for commit in commits:
+                files.update(f['filename'] for f in commit['files'])
+            impact = analyze(files)
+            log.msg("GitHub PR #%d %r" % (pr_number, impact))
+
             nr = 0
             for commit in commits:
                 nr += 1
-                commit = query_url(commit['url'], token=github_token)
                 change = self.handle_pull_request_commit(payload, commit,
-                    nr, commits_nr, kernel_pr)
+                    nr, commits_nr, kernel_pr, impact, received)
                 changes.append(change)
 
         log.msg("Received %d changes from GitHub Pull Request #%d" % (
             len(changes), pr_number))
+        log.msg(github_cache.stats())
 
-        return changes, 'git'
+        defer.returnValue((changes, 'git'))
+
+#
+# Benchmark of the pull request handler against a local fake GitHub API,
+# which answers every request after a fixed latency.  M pull request events
+# of N commits each arrive at once.  They're handled as the blocking
+# urllib2 handler did, one request after another, and by the handler above:
+#
+#   python github.py --commits 5 --events 10 --latency 100
+#
+class FakeGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    commits_pattern = re.compile(r'^/repos/[^/]+/[^/]+/pulls/(\d+)/commits$')
+    commit_pattern = re.compile(r'^/repos/[^/]+/[^/]+/commits/(\w+)$')
+
+    def commit(self, sha):
+        return {
+            'sha': sha,
+            'url': "%s/repos/openzfs/zfs/commits/%s" % (self.server.url, sha),
+            'html_url': "https://github.com/openzfs/zfs/commit/%s" % sha,
+            'commit': {
+                'message': "Fix a bug\n\nSigned-off-by: A <a@example.com>\n",
+                'committer': {'name': "A", 'email': "a@example.com"},
+            },
+            'files': [{'filename': "module/zfs/dbuf.c"}],
+        }
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        m = self.commits_pattern.match(self.path)
+        if m is not None:
+            pr = int(m.group(1))
+            data = [self.commit(benchmark_sha(pr, i))
+                for i in range(self.server.commits)]
+        else:
+            m = self.commit_pattern.match(self.path)
+            data = self.commit(m.group(1)) if m is not None else None
+
+        body = json.dumps(data)
+        self.send_response(200 if data is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeGitHubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, commits, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+            FakeGitHubHandler)
+        self.commits = commits
+        self.latency = latency
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # urllib2 closes the connection once it has read the response.
+        pass
+
+def benchmark_sha(pr, i):
+    return "%040x" % (pr * 1000 + i)
+
+def benchmark_payload(url, pr, commits):
+    head = benchmark_sha(pr, commits - 1)
+    return {
+        'action': 'synchronize',
+        'number': pr,
+        'repository': {'clone_url': "https://github.com/openzfs/zfs.git",
+                       'name': "zfs"},
+        'pull_request': {
+            'commits': commits,
+            'commits_url': "%s/repos/openzfs/zfs/pulls/%d/commits" % (url, pr),
+            'created_at': "2024-01-01T00:00:00Z",
+            'base': {'ref': "master", 'repo': {'commits_url':
+                "%s/repos/openzfs/zfs/commits{/sha}" % url}},
+            'head': {'sha': head},
+        },
+    }
+
+def blocking_pull_request(payload):
+    """
+    Fetches the commits of a pull request the way the blocking handler did.
+    """
+    commits = json.load(urllib2.urlopen(payload['pull_request']['commits_url']))
+    return [json.load(urllib2.urlopen(commit['url'])) for commit in commits]
+
+def benchmark(args):
+    server = FakeGitHubServer(args.commits, args.latency / 1000.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    payloads = [benchmark_payload(server.url, pr, args.commits)
+        for pr in range(1, args.events + 1)]
+    github_cache.path = None
+
+    # Blocking: the reactor handles one event at a time.
+    start = time.time()
+    blocking = []
+    for payload in payloads:
+        blocking_pull_request(payload)
+        blocking.append(time.time() - start)
+
+    handler = CustomGitHubEventHandler(None, False)
+    concurrent = []
+
+    @defer.inlineCallbacks
+    def run():
+        github_cache.entries.clear()
+        start = time.time()
+
+        def done(result):
+            concurrent.append(time.time() - start)
+            return result
+
+        try:
+            yield defer.gatherResults([
+                handler.process_pull_request(payload).addCallback(done)
+                for payload in payloads], consumeErrors=True)
+        finally:
+            yield github_pool.closeCachedConnections()
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    server.shutdown()
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    print("%d events of %d commits, %d ms per request, %d concurrent "
+        "requests" % (args.events, args.commits, args.latency,
+        github_max_requests))
+    for name, values in (("blocking", blocking), ("concurrent", concurrent)):
+        print("%-12s median %6.0f ms   p95 %6.0f ms   max %6.0f ms" % (name,
+            percentile(values, 0.5), percentile(values, 0.95),
+            max(values) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pull request handler against a fake "
+        "GitHub API.")
+    parser.add_argument("--commits", type=int, default=5,
+        help="commits per pull request (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=10,
+        help="simultaneous pull request events (default: %(default)s)")
+    parser.add_argument("--latency", type=int, default=100,
+        help="GitHub API latency in ms (default: %(default)s)")
+    benchmark(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+import argparse
+import gzip
+import json
+import re
+import subprocess
+
+from directives import parse_directives
+
+#
+# Change impact analysis.
+#
+# The files modified by a change determine which platforms need to be built
+# and tested, and which ZFS Test Suite tags need to be run.  Each file is
+# matched against the rules below, in order, and the first matching rule
+# decides its impact.  A file which doesn't match any rule could affect
+# anything and requires a full run on every platform.  The impact of a
+# change is the union of the impact of its files, so a single unrecognized
+# file always falls back to the full run.  Only pull requests are narrowed,
+# branch commits are always fully tested since their results are the
+# baseline for the known issues report.
+#
+# This is intentionally conservative, only changes which clearly can't
+# affect a platform or test area are narrowed:
+#
+#   - Documentation only changes don't need to be tested.
+#   - Changes to Linux or FreeBSD specific code only need to be tested on
+#     that platform, but require the full test suite.
+#   - Changes to the test scripts (.ksh) in a functional test area only need
+#     to run the tests for those areas, on every platform.  The libraries
+#     and configuration (.kshlib, .cfg) of an area may be sourced by the
+#     tests of other areas, so they require the full test suite.
+#
+# The replay command estimates the EC2 hours which would have been saved
+# on the historical changes archived by dbmaint.py, or the commits of a ZFS
+# repository, see replay() below.
+#
+
+PLATFORMS = ('linux', 'freebsd')
+
+# The default ZFS Test Suite tags for a full run.
+FULL_TAGS = 'functional'
+
+# GitHub truncates the list of files for very large commits.
+MAX_FILES = 300
+
+# The impact of a rule on platforms: None for all platforms, or a tuple of
+# platform names.  The impact on tests: None for the full test suite, ()
+# when no tests are required, or the regex group holding the test tag.
+_rules = [
+    # Documentation
+    (re.compile(r'^(man/|.*\.md$|AUTHORS$|COPYRIGHT$|LICENSE$|NOTICE$|'
+                r'NEWS$|README|\.github/ISSUE_TEMPLATE/)'), (), ()),
+
+    # Functional test scripts, the tag is the test area.  The cli_root and
+    # cli_user areas are tagged by their sub-directory.
+    (re.compile(r'^tests/zfs-tests/tests/functional/cli_(?:root|user)/'
+                r'([a-zA-Z0-9_]+)/(?:[^/]+/)*[^/]+\.ksh$'), None, 1),
+    (re.compile(r'^tests/zfs-tests/tests/functional/([a-zA-Z0-9_]+)/'
+                r'(?:[^/]+/)*[^/]+\.ksh$'), None, 1),
+
+    # Linux specific
+    (re.compile(r'^(module/os/linux/|include/os/linux/|lib/.*/os/linux/|'
+                r'config/kernel|rpm/|udev/|contrib/dracut/|'
+                r'contrib/initramfs/|etc/systemd/)'), ('linux',), None),
+
+    # FreeBSD specific
+    (re.compile(r'^(module/os/freebsd/|include/os/freebsd/|'
+                r'lib/.*/os/freebsd/)'), ('freebsd',), None),
+]
+
+class Impact(object):
+    """
+    The impact of a change.
+
+    platforms  - set of platform names which need to be tested, or None
+                 for all platforms
+    tags       - set of ZFS Test Suite tags which need to be run, or None
+                 for the full test suite
+    """
+    def __init__(self, platforms=None, tags=None):
+        self.platforms = platforms
+        self.tags = tags
+
+    def is_full(self):
+        return self.platforms is None and self.tags is None
+
+    def has_platform(self, platform):
+        return self.platforms is None or platform in self.platforms
+
+    def get_tags(self):
+        """
+        Returns the comma separated tags to pass to zfs-tests.sh.
+        """
+        if not self.tags:
+            return FULL_TAGS
+
+        return ",".join(sorted(self.tags))
+
+    def __repr__(self):
+        return "Impact(platforms=%r, tags=%r)" % (self.platforms, self.tags)
+
+def file_impact(filename):
+    """
+    Returns the (platforms, tags) impact of a single modified file.
+    """
+    for pattern, platforms, tags in _rules:
+        m = pattern.match(filename)
+        if m is None:
+            continue
+
+        if isinstance(tags, int):
+            tags = (m.group(tags),)
+
+        return (platforms, tags)
+
+    return (None, None)
+
+def analyze(files):
+    """
+    Returns the Impact of a change which modified the provided files.
+    """
+    if not files or len(files) >= MAX_FILES:
+        return Impact()
+
+    platforms = set()
+    tags = set()
+
+    for filename in files:
+        file_platforms, file_tags = file_impact(filename)
+
+        if file_platforms is None:
+            platforms = None
+        elif platforms is not None:
+            platforms.update(file_platforms)
+
+        if file_tags is None:
+            tags = None
+        elif tags is not None:
+            tags.update(file_tags)
+
+        if platforms is None and tags is None:
+            break
+
+    return Impact(platforms, tags)
+
+#
+# Replay of historical changes.
+#
+def archived_changes(path):
+    """
+    Yields the (comments, files) of the changes archived by dbmaint.py.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    numbers = set()
+    with opener(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            if d.get('number') in numbers:
+                continue
+            numbers.add(d.get('number'))
+            yield d.get('comments', ""), d.get('files', [])
+
+def repository_changes(path, since):
+    """
+    Yields the (comments, files) of the commits in a git repository.
+    """
+    out = subprocess.check_output(["git", "-C", path, "log", "--no-merges",
+        "--since=" + since, "--name-only", "--format=%x00%B%x01"])
+    for record in out.split("\0")[1:]:
+        comments, sep, files = record.partition("\1")
+        yield comments, [name for name in files.split("\n") if name]
+
+def change_hours(impact, args):
+    """
+    Returns the EC2 hours of the test builders run for a change.
+    """
+    if impact.tags is None or not impact.tags:
+        test_hours = args.full_hours
+    else:
+        test_hours = min(args.full_hours, len(impact.tags) * args.area_hours)
+
+    hours = 0.0
+    for platform, builders in (('linux', args.linux), ('freebsd',
+            args.freebsd)):
+        if impact.has_platform(platform):
+            hours += builders * (args.build_hours + test_hours)
+
+    return hours
+
+def replay(args):
+    if args.changes:
+        changes = archived_changes(args.changes)
+    else:
+        changes = repository_changes(args.repo, args.since)
+
+    full_hours = change_hours(Impact(), args)
+    counts = {}
+    total = 0
+    narrowed = 0.0
+    stacks = {}
+    for comments, files in changes:
+        # Only the head of a pull request, and branch commits, are tested.
+        # The head is tested with every commit in the stack, so its impact
+        # is determined by all of their files, as in github.py.  Branch
+        # commits are never narrowed.
+        directives = parse_directives(comments)
+        if not directives.is_pull_request():
+            counts["branch"] = counts.get("branch", 0) + 1
+            total += 1
+            narrowed += full_hours
+            continue
+
+        if directives.pr_part == 1:
+            stacks[directives.pr_number] = set()
+        stack = stacks.setdefault(directives.pr_number, set())
+        stack.update(files)
+        if not directives.is_pull_request_head():
+            continue
+        files = stacks.pop(directives.pr_number)
+
+        impact = analyze(files)
+        if impact.is_full():
+            kind = "full"
+        elif impact.platforms is not None and not impact.platforms:
+            kind = "untested"
+        elif impact.platforms is not None:
+            kind = "platform"
+        else:
+            kind = "test areas"
+        counts[kind] = counts.get(kind, 0) + 1
+
+        total += 1
+        narrowed += change_hours(impact, args)
+
+    for kind in ("branch", "full", "platform", "test areas", "untested"):
+        print("%-24s %8d" % (kind + " changes", counts.get(kind, 0)))
+    if total:
+        print("%-24s %8.1f" % ("EC2 hours, full runs", total * full_hours))
+        print("%-24s %8.1f" % ("EC2 hours, narrowed", narrowed))
+        print("%-24s %8.1f (%.1f%%)" % ("EC2 hours saved",
+            total * full_hours - narrowed,
+            100.0 * (1 - narrowed / (total * full_hours))))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze the impact of changes on the builders.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    files_parser = subparsers.add_parser("files",
+        help="print the impact of the modified files")
+    files_parser.add_argument("files", nargs="+")
+
+    replay_parser = subparsers.add_parser("replay",
+        help="estimate the EC2 hours saved on historical changes")
+    replay_parser.add_argument("--changes",
+        help="changes archived by dbmaint.py (.jsonl or .jsonl.gz)")
+    replay_parser.add_argument("--repo", default=".",
+        help="ZFS repository replayed without --changes "
+        "(default: %(default)s)")
+    replay_parser.add_argument("--since", default="6 months ago",
+        help="first commit replayed from --repo (default: %(default)s)")
+    replay_parser.add_argument("--linux", type=int, default=7,
+        help="Linux test builders (default: %(default)s)")
+    replay_parser.add_argument("--freebsd", type=int, default=2,
+        help="FreeBSD test builders (default: %(default)s)")
+    replay_parser.add_argument("--build-hours", type=float, default=0.5,
+        help="hours to boot a slave and build (default: %(default)s)")
+    replay_parser.add_argument("--full-hours", type=float, default=4.0,
+        help="hours of a full test suite run (default: %(default)s)")
+    replay_parser.add_argument("--area-hours", type=float, default=0.25,
+        help="hours to run the tests of one area (default: %(default)s)")
+
+    args = parser.parse_args()
+    if args.command == "files":
+        print(analyze(args.files))
+    else:
+        replay(args)
+
+if __name__ == "__main__":
+    main()
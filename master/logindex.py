@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+#
+# Fast tail, range reads and search of the compressed build logs.
+#
+# Finished logs are compressed in independent blocks of about 256kB with a
+# small index next to them, see patch 0022.  The compressed log is still a
+# valid .bz2 file, so the existing log URLs and the readers of the log
+# files, e.g. zts_index.py for known-issues.sh, are unchanged.  The index
+# records the compressed offset, and the text offset and line number of
+# each block, and which blocks end a line containing one of the markers,
+# e.g. [FAIL].  With it:
+#
+# - tail() decompresses only the last blocks of the log,
+# - read_lines() decompresses the blocks holding the requested lines,
+# - search() for a marker decompresses only the blocks which contain it,
+#   and any other search reads the log a block at a time.
+#
+# Logs which were compressed before the index existed, and logs which are
+# still being written, are read a block of 1MB at a time from the start.
+# The convert command rewrites the existing compressed logs in blocks.
+#
+# The LogTailResource serves these from the WebStatus, e.g.:
+#
+#   /logtail/<builder>/<build>/<step>/<log>?lines=200
+#   /logtail/<builder>/<build>/<step>/<log>?first=1000&count=100
+#   /logtail/<builder>/<build>/<step>/<log>?grep=[FAIL]
+#
+# and the same commands are available on the master, with a benchmark on a
+# synthetic test log:
+#
+#   python logindex.py tail -n 200 <builder>/<build>-log-shell_4-tests.bz2
+#   python logindex.py grep [FAIL] <builder>/<build>-log-shell_4-tests.bz2
+#   python logindex.py convert <builder> ...
+#   python logindex.py benchmark
+#
+
+import argparse
+import bisect
+import collections
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bz2 import BZ2File
+from gzip import GzipFile
+
+from buildbot.status.logfile import BLOCKSIZE, INDEX_MARKERS, \
+    LogFileScanner, STDOUT, STDERR, compressBlocks, decompressBlock, \
+    readBlockIndex
+from prometheus import registry
+from twisted.internet import threads
+from twisted.python import log
+from twisted.web import resource, server
+
+COMPRESSED_SUFFIXES = (".bz2", ".gz")
+READ_SIZE = 1024 * 1024
+
+log_reads = registry.counter("log_reads_total",
+    "Log tail, range and search requests", ["kind", "indexed"])
+log_read_seconds = registry.histogram("log_read_seconds",
+    "Time to answer log tail, range and search requests", ["kind"])
+log_blocks_read = registry.counter("log_blocks_read_total",
+    "Compressed log blocks decompressed for tail, range and search requests",
+    ["kind"])
+
+def base_filename(path):
+    """
+    Returns the uncompressed filename of a log, as LogFile.getFilename().
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+
+    return path
+
+def chunk_text(data):
+    """
+    Returns the stdout and stderr text of a string of log chunks.
+    """
+    chunks = []
+    LogFileScanner(chunks.append, [STDOUT, STDERR]).dataReceived(data)
+    return "".join(text for channel, text in chunks)
+
+def split_lines(texts, number=0):
+    """
+    Yields (line number, line) for the lines of a sequence of strings.
+    """
+    partial = ""
+    for text in texts:
+        lines = (partial + text).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            yield number, line
+            number += 1
+
+    if partial:
+        yield number, partial
+
+class IndexedLog(object):
+    """
+    A log compressed in blocks, see patch 0022.
+    """
+    def __init__(self, filename, index, kind="read"):
+        self.filename = filename
+        self.index = index
+        self.kind = kind
+        self.method = "bz2" if filename.endswith(".bz2") else "gz"
+        self.lines = [row[3] for row in index]
+        self.blocks = len(index) - 1
+
+    @classmethod
+    def open(cls, filename, kind="read"):
+        """
+        Returns the IndexedLog for a log, or None if it isn't indexed.
+        """
+        base = base_filename(filename)
+        for suffix in COMPRESSED_SUFFIXES:
+            index = readBlockIndex(base + suffix)
+            if index is not None and os.path.exists(base + suffix):
+                return cls(base + suffix, index, kind)
+
+        return None
+
+    def text(self, i):
+        """
+        Returns the stdout and stderr text of block i.
+        """
+        start, end = self.index[i][0], self.index[i + 1][0]
+        f = open(self.filename, "rb")
+        try:
+            f.seek(start)
+            data = f.read(end - start)
+        finally:
+            f.close()
+
+        log_blocks_read.inc(kind=self.kind)
+        return chunk_text(decompressBlock(data, self.method))
+
+    def texts(self, first=0):
+        for i in range(first, self.blocks):
+            yield self.text(i)
+
+    def tail(self, lines):
+        texts = []
+        newlines = 0
+        i = self.blocks
+        # One more newline than lines is needed, unless the log ends in
+        # the middle of a line.
+        while i > 0 and newlines <= lines:
+            i -= 1
+            texts.insert(0, self.text(i))
+            newlines += texts[0].count("\n")
+
+        return list(split_lines(texts, self.index[i][3]))[-lines:]
+
+    def read_lines(self, first, count):
+        # The block before the first one starting at or after the line
+        # holds the start of the line.
+        i = max(0, bisect.bisect_left(self.lines, first) - 1)
+        result = []
+        for number, line in split_lines(self.texts(i), self.index[i][3]):
+            if number >= first + count:
+                break
+            if number >= first:
+                result.append((number, line))
+
+        return result
+
+    def search(self, pattern):
+        if pattern not in INDEX_MARKERS:
+            return [(number, line) for number, line in
+                split_lines(self.texts()) if pattern in line]
+
+        result = []
+        texts = {}
+        for i in range(self.blocks):
+            if pattern not in self.index[i][5]:
+                continue
+
+            # The first line ending in the block starts in the last of the
+            # previous blocks with a newline, and the last line continues
+            # in the next block.
+            first = i
+            while first > 0 and self.index[first][4]:
+                first -= 1
+                if self.lines[first] < self.lines[first + 1]:
+                    break
+            for j in range(first, i + 1):
+                if j not in texts:
+                    texts[j] = self.text(j)
+            lines = list(split_lines([texts[j] for j in range(first, i + 1)],
+                self.index[first][3]))
+            if i < self.blocks - 1 and self.index[i + 1][4]:
+                lines.pop()
+            result.extend((number, line) for number, line in lines
+                if number >= self.index[i][3] and pattern in line)
+
+        return result
+
+def open_log(filename):
+    """
+    Returns a file object for a log which isn't indexed, compressed or not.
+    """
+    base = base_filename(filename)
+    for suffix, fileclass in ((".bz2", BZ2File), (".gz", GzipFile)):
+        if os.path.exists(base + suffix):
+            return fileclass(base + suffix, "r")
+
+    return open(base, "r")
+
+def read_texts(filename):
+    """
+    Yields the stdout and stderr text of a log which isn't indexed.
+    """
+    f = open_log(filename)
+    chunks = []
+    scanner = LogFileScanner(chunks.append, [STDOUT, STDERR])
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            scanner.dataReceived(data)
+            yield "".join(text for channel, text in chunks)
+            del chunks[:]
+    finally:
+        f.close()
+
+def tail(filename, lines=100):
+    """
+    Returns the last lines of a log as a list of (line number, line).
+    """
+    start = time.time()
+    indexed = IndexedLog.open(filename, "tail")
+    log_reads.inc(kind="tail", indexed=str(indexed is not None).lower())
+    if indexed is not None:
+        result = indexed.tail(lines)
+    else:
+        result = list(collections.deque(split_lines(read_texts(filename)),
+            lines))
+
+    log_read_seconds.time(start, kind="tail")
+    return result
+
+def read_lines(filename, first, count):
+    """
+    Returns count lines of a log starting at line first, counting from 0,
+    as a list of (line number, line).
+    """
+    start = time.time()
+    indexed = IndexedLog.open(filename, "range")
+    log_reads.inc(kind="range", indexed=str(indexed is not None).lower())
+    if indexed is not None:
+        result = indexed.read_lines(first, count)
+    else:
+        result = []
+        for number, line in split_lines(read_texts(filename)):
+            if number >= first + count:
+                break
+            if number >= first:
+                result.append((number, line))
+
+    log_read_seconds.time(start, kind="range")
+    return result
+
+def search(filename, pattern):
+    """
+    Returns the lines of a log containing pattern, as a list of (line
+    number, line).
+    """
+    start = time.time()
+    indexed = IndexedLog.open(filename, "search")
+    log_reads.inc(kind="search", indexed=str(indexed is not None).lower())
+    if indexed is not None:
+        result = indexed.search(pattern)
+    else:
+        result = [(number, line) for number, line in
+            split_lines(read_texts(filename)) if pattern in line]
+
+    log_read_seconds.time(start, kind="search")
+    return result
+
+def convert(filename):
+    """
+    Rewrites a compressed log which isn't indexed in blocks.  Returns the
+    compressed size before and after, or None if it was skipped.
+
+    The log is renamed in to place before its index, so an interrupted
+    conversion never leaves an index beside the old log.  The index of a
+    log which was renamed, but not yet indexed, is renamed by the next
+    conversion.
+    """
+    base = base_filename(filename)
+    for suffix, fileclass in ((".bz2", BZ2File), (".gz", GzipFile)):
+        compressed = base + suffix
+        if not os.path.exists(compressed):
+            continue
+        if os.path.exists(compressed + ".idx"):
+            return None
+
+        tmp = compressed + ".tmp"
+        if os.path.exists(tmp + ".idx") and not os.path.exists(tmp):
+            os.rename(tmp + ".idx", compressed + ".idx")
+            return None
+
+        before = os.path.getsize(compressed)
+        infile = fileclass(compressed, "r")
+        try:
+            compressBlocks(infile, tmp, suffix[1:])
+        finally:
+            infile.close()
+        os.rename(tmp, compressed)
+        os.rename(tmp + ".idx", compressed + ".idx")
+
+        return before, os.path.getsize(compressed)
+
+    return None
+
+def log_files(paths):
+    """
+    Yields the compressed logs in paths, which are logs or builder
+    directories.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for name in sorted(os.listdir(path)):
+            if "-log-" in name and name.endswith(COMPRESSED_SUFFIXES):
+                yield os.path.join(path, name)
+
+#
+# Serves the tail, a range or the matching lines of a step's log as text,
+# e.g. ws.putChild("logtail", LogTailResource()).
+#
+class LogTailResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, default_lines=100, max_lines=10000):
+        resource.Resource.__init__(self)
+        self.default_lines = default_lines
+        self.max_lines = max_lines
+
+    def error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader("Content-Type", "text/plain; charset=utf-8")
+        return message + "\n"
+
+    def find_log(self, request):
+        if len(request.postpath) != 4:
+            return None
+
+        builder_name, build, step_name, log_name = request.postpath
+        status = request.site.buildbot_service.getStatus()
+        try:
+            builder = status.getBuilder(builder_name)
+            build = builder.getBuild(int(build))
+        except (KeyError, ValueError):
+            return None
+        if build is None:
+            return None
+
+        for step in build.getSteps():
+            if step.getName() != step_name:
+                continue
+            for logfile in step.getLogs():
+                if logfile.getName() == log_name:
+                    return logfile
+
+        return None
+
+    def argument(self, request, name, default=None):
+        values = request.args.get(name)
+        if not values:
+            return default
+
+        return values[0]
+
+    def render_GET(self, request):
+        logfile = self.find_log(request)
+        if logfile is None or not logfile.old_hasContents():
+            return self.error(request, 404,
+                "Usage: /logtail/<builder>/<build>/<step>/<log>"
+                "[?lines=N|?first=N&count=N|?grep=TEXT]")
+
+        try:
+            pattern = self.argument(request, "grep")
+            first = self.argument(request, "first")
+            if pattern:
+                call = (search, logfile.getFilename(), pattern)
+            elif first is not None:
+                count = int(self.argument(request, "count",
+                    self.default_lines))
+                call = (read_lines, logfile.getFilename(),
+                    max(0, int(first)), min(max(count, 0), self.max_lines))
+            else:
+                lines = int(self.argument(request, "lines",
+                    self.default_lines))
+                call = (tail, logfile.getFilename(),
+                    min(max(lines, 1), self.max_lines))
+        except ValueError:
+            return self.error(request, 400, "Invalid line number")
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def write(lines):
+            if finished:
+                return
+            request.setHeader("Content-Type", "text/plain; charset=utf-8")
+            if pattern or first is not None:
+                request.write("".join("%d: %s\n" % (number + 1, line)
+                    for number, line in lines))
+            else:
+                request.write("".join(line + "\n" for number, line in lines))
+            request.finish()
+
+        def failed(failure):
+            log.err(failure, "Failed to read %s" % logfile.getFilename())
+            if not finished:
+                request.write(self.error(request, 500, "Failed to read log"))
+                request.finish()
+
+        d = threads.deferToThread(*call)
+        d.addCallbacks(write, failed)
+        return server.NOT_DONE_YET
+
+def synthetic_log(path, size, failures):
+    """
+    Writes a log of size bytes of netstring chunks resembling a ZFS Test
+    Suite run with the given number of failed tests.
+    """
+    rng = random.Random(1)
+    groups = ["acl/posix", "cli_root/zfs_create", "cli_root/zpool_import",
+        "redundancy", "rsend", "snapshot", "zvol/zvol_misc", "removal"]
+    lines = []
+    tests = []
+    length = 0
+    while length < size:
+        group = rng.choice(groups)
+        name = "%s_%03d_pos" % (group.split("/")[-1], rng.randint(1, 60))
+        for i in range(rng.randint(0, 20)):
+            lines.append("%02d:%02d:%02d.%02d SUCCESS: zfs create -o "
+                "recordsize=%dk testpool/fs%d/%x\n" % (rng.randint(0, 23),
+                rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 99),
+                2 ** rng.randint(2, 10), rng.randint(0, 99),
+                rng.getrandbits(48)))
+            length += len(lines[-1])
+        tests.append(len(lines))
+        lines.append("Test: /usr/share/zfs/zfs-tests/tests/functional/%s/%s "
+            "(run as root) [%02d:%02d] [PASS]\n" % (group, name,
+            rng.randint(0, 3), rng.randint(0, 59)))
+        length += len(lines[-1])
+
+    for i in rng.sample(tests, failures):
+        lines[i] = lines[i].replace("[PASS]", "[FAIL]")
+    text = "".join(lines)
+
+    f = open(path, "wb")
+    offset = 0
+    while offset < len(text):
+        # The slaves send output in chunks of varying size.
+        size = rng.randint(100, 10000)
+        chunk = "%d%s" % (STDOUT, text[offset:offset + size])
+        f.write("%d:%s," % (len(chunk), chunk))
+        offset += size
+    f.close()
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, (time.time() - start) * 1000
+
+def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="logindex-")
+    try:
+        raw = os.path.join(workdir, "1-log-shell_4-tests")
+        synthetic_log(raw, args.size * 1024 * 1024, args.failures)
+
+        stock = os.path.join(workdir, "stock", "1-log-shell_4-tests")
+        os.mkdir(os.path.dirname(stock))
+        f = BZ2File(stock + ".bz2", "w")
+        f.write(open(raw, "rb").read())
+        f.close()
+
+        blocks = raw + ".bz2"
+        compressBlocks(open(raw, "rb"), blocks, "bz2", args.block_size)
+        index = readBlockIndex(blocks)
+
+        def run(filename):
+            return [
+                timed(tail, filename, args.lines),
+                timed(read_lines, filename, index[-1][3] // 2, args.lines),
+                timed(search, filename, "[FAIL]"),
+                timed(search, filename, "zpool_import_012"),
+            ]
+
+        old = run(stock)
+        new = run(raw)
+        for (a, t), (b, t2) in zip(old, new):
+            assert a == b, "results differ"
+
+        rows = [
+            ("log", "%.1f MB, %d lines" % (os.path.getsize(raw) / 1e6,
+                index[-1][3])),
+            ("bz2, one stream", "%.2f MB" % (os.path.getsize(stock +
+                ".bz2") / 1e6)),
+            ("bz2, %d blocks" % (len(index) - 1), "%.2f MB + %d byte "
+                "index" % (os.path.getsize(blocks) / 1e6,
+                os.path.getsize(blocks + ".idx"))),
+        ]
+        names = ["tail, %d lines" % args.lines,
+            "range, %d lines" % args.lines, "search [FAIL], %d found" %
+            len(new[2][0]), "search other, %d found" % len(new[3][0])]
+        for name, (a, t), (b, t2) in zip(names, old, new):
+            rows.append((name, "%.0f ms -> %.0f ms" % (t, t2)))
+
+        for name, value in rows:
+            print("%-32s %s" % (name, value))
+    finally:
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Read and convert the master's compressed build logs.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    tail_parser = subparsers.add_parser("tail", help="print the last lines")
+    tail_parser.add_argument("-n", "--lines", type=int, default=100,
+        help="lines (default: %(default)s)")
+    tail_parser.add_argument("log")
+
+    lines_parser = subparsers.add_parser("lines",
+        help="print a range of lines")
+    lines_parser.add_argument("-f", "--first", type=int, default=1,
+        help="first line, counting from 1 (default: %(default)s)")
+    lines_parser.add_argument("-c", "--count", type=int, default=100,
+        help="lines (default: %(default)s)")
+    lines_parser.add_argument("log")
+
+    grep_parser = subparsers.add_parser("grep",
+        help="print the lines containing a string")
+    grep_parser.add_argument("pattern")
+    grep_parser.add_argument("logs", nargs="+")
+
+    convert_parser = subparsers.add_parser("convert",
+        help="compress existing logs in blocks")
+    convert_parser.add_argument("paths", nargs="+",
+        help="logs or builder directories")
+
+    bench = subparsers.add_parser("benchmark",
+        help="benchmark on a synthetic test log")
+    bench.add_argument("--size", type=int, default=10,
+        help="log size in MB (default: %(default)s)")
+    bench.add_argument("--failures", type=int, default=5,
+        help="failed tests (default: %(default)s)")
+    bench.add_argument("--lines", type=int, default=200,
+        help="lines read (default: %(default)s)")
+    bench.add_argument("--block-size", type=int, default=BLOCKSIZE,
+        help="bytes per block (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "tail":
+        for number, line in tail(args.log, args.lines):
+            print(line)
+    elif args.command == "lines":
+        for number, line in read_lines(args.log, max(0, args.first - 1),
+                args.count):
+            print("%d: %s" % (number + 1, line))
+    elif args.command == "grep":
+        for filename in args.logs:
+            for number, line in search(filename, args.pattern):
+                print("%s:%d: %s" % (filename, number + 1, line))
+    elif args.command == "convert":
+        before = after = 0
+        for filename in log_files(args.paths):
+            sizes = convert(filename)
+            if sizes is not None:
+                before += sizes[0]
+                after += sizes[1]
+                print("%s: %d -> %d bytes" % (filename, sizes[0], sizes[1]))
+        print("Converted %.1f MB to %.1f MB" % (before / 1e6, after / 1e6))
+    elif args.command == "benchmark":
+        benchmark(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import cgi
+import glob
+import json
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+from buildbot.process.buildstep import BuildStep
+from buildbot.status.results import SUCCESS, WARNINGS
+from github import post_status
+from twisted.internet import threads
+from twisted.python import log
+
+#
+# Performance regression detection for the PERF builders.
+#
+# bb-test-pts.sh uploads the Phoronix Test Suite composite.xml of each run
+# next to the results tarball.  After the upload the PerfRegressionCheck
+# step parses it and appends every result to the PerfHistory, a series per
+# (benchmark, pool layout) holding a column per field.  Each new value is
+# compared with a rolling baseline of the most recent values for the same
+# branch, pull requests are compared with master.  A value is a regression
+# when it's worse than the baseline median by more than threshold and by
+# more than sigmas robust standard deviations (1.4826 * MAD), so a single
+# noisy benchmark doesn't flag every build.
+#
+# The history is kept as JSON:
+#
+#   { "sources": [ "<composite.xml path>" ],
+#     "series": { "<benchmark>|<layout>": {
+#         "benchmark": "<benchmark>", "layout": "<layout>",
+#         "unit": "<unit>", "hib": <bool>,
+#         "columns": { "time": [], "build": [], "origin": [], "revision": [],
+#                      "version": [], "value": [], "change": [],
+#                      "regression": [] } } } }
+#
+# The trend page is regenerated after every build.
+#
+
+def parse_composite(text, version):
+    """
+    Returns a list of (benchmark, layout, unit, hib, value) parsed from the
+    text of a PTS composite.xml.  The result identifiers are the ZFS
+    version followed by the pool layout, see bb-test-pts.sh.
+    """
+    results = []
+    root = ElementTree.fromstring(text)
+    for result in root.findall('Result'):
+        name = re.sub(r'-[0-9.]+$', '', result.findtext('Identifier') or '')
+        if not name:
+            name = result.findtext('Title') or 'unknown'
+        description = result.findtext('Description') or ''
+        benchmark = "%s: %s" % (name, description) if description else name
+        unit = result.findtext('Scale') or ''
+        hib = (result.findtext('Proportion') or 'HIB') != 'LIB'
+
+        for entry in result.findall('Data/Entry'):
+            layout = entry.findtext('Identifier') or ''
+            if version and layout.startswith(version + " "):
+                layout = layout[len(version) + 1:]
+
+            try:
+                value = float(entry.findtext('Value'))
+            except (TypeError, ValueError):
+                continue
+
+            results.append((benchmark, layout, unit, hib, value))
+
+    return results
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+class PerfHistory(object):
+    columns = ("time", "build", "origin", "revision", "version", "value",
+        "change", "regression")
+
+    def __init__(self, path, page, window=20, min_baseline=5,
+                 threshold=0.05, sigmas=3.0, baseline_origin=
+                 "artifacts/branch/master"):
+        self.path = path
+        self.page = page
+        self.window = window
+        self.min_baseline = min_baseline
+        self.threshold = threshold
+        self.sigmas = sigmas
+        self.baseline_origin = baseline_origin
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {"sources": [], "series": {}}
+
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, history):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(history, f, separators=(',', ':'))
+        os.rename(self.path + ".tmp", self.path)
+
+    def baseline(self, series, origin):
+        """
+        Returns the most recent values recorded for origin, or for the
+        baseline origin when origin is a pull request.
+        """
+        if origin.startswith("artifacts/pull/"):
+            origin = self.baseline_origin
+
+        cols = series["columns"]
+        values = [value for o, value in zip(cols["origin"], cols["value"])
+            if o == origin]
+
+        return values[-self.window:]
+
+    def check(self, series, value, base):
+        """
+        Returns the relative change of value from the baseline, positive
+        when worse, and whether it's a regression.
+        """
+        if len(base) < self.min_baseline:
+            return (None, False)
+
+        center = median(base)
+        if center == 0:
+            return (None, False)
+
+        mad = median([abs(v - center) for v in base])
+        change = (value - center) / abs(center)
+        if series["hib"]:
+            change = -change
+
+        regression = change > self.threshold and \
+            abs(value - center) > self.sigmas * 1.4826 * mad
+
+        return (change, regression)
+
+    def add(self, path, version, origin, revision, build):
+        """
+        Adds the results in the composite.xml at path.  Returns a list of
+        (benchmark, layout, change) for the regressions found, or None if
+        the file was already added.  Runs in a thread.
+        """
+        with self.lock:
+            history = self.load()
+            if path in history["sources"]:
+                return None
+
+            with open(path, 'r') as f:
+                results = parse_composite(f.read(), version)
+
+            regressions = []
+            now = int(time.time())
+            for benchmark, layout, unit, hib, value in results:
+                key = "%s|%s" % (benchmark, layout)
+                series = history["series"].setdefault(key, {
+                    "benchmark": benchmark, "layout": layout, "unit": unit,
+                    "hib": hib,
+                    "columns": dict((col, []) for col in self.columns)})
+
+                change, regression = self.check(series, value,
+                    self.baseline(series, origin))
+                if regression:
+                    regressions.append((benchmark, layout, change))
+
+                row = (now, build, origin, revision, version, value, change,
+                    regression)
+                for col, field in zip(self.columns, row):
+                    series["columns"][col].append(field)
+
+            history["sources"].append(path)
+            self.save(history)
+            self.write_page(history)
+
+            return regressions
+
+    def write_page(self, history):
+        """
+        Writes the trend page, a plot of the recent baseline origin values
+        and the latest change for every series.  Pull requests aren't shown.
+        """
+        rows = []
+        for key in sorted(history["series"]):
+            series = history["series"][key]
+            cols = series["columns"]
+            latest = [i for i, o in enumerate(cols["origin"])
+                if o == self.baseline_origin][-100:]
+            if not latest:
+                continue
+
+            points = [(cols["value"][i], cols["regression"][i])
+                for i in latest]
+            last = latest[-1]
+            change = cols["change"][last]
+            rows.append("<tr%s><td>%s</td><td>%s</td><td>%.2f %s</td>"
+                "<td>%s</td><td>%s</td><td>%s</td></tr>" % (
+                ' class="regression"' if cols["regression"][last] else '',
+                cgi.escape(series["benchmark"]), cgi.escape(series["layout"]),
+                cols["value"][last], cgi.escape(series["unit"]),
+                "-" if change is None else "%+.1f%%" % (-100.0 * change),
+                cgi.escape(cols["version"][last] or ""), self.plot(points)))
+
+        with open(self.page + ".tmp", 'w') as f:
+            f.write("""<!DOCTYPE html>
+<html>
+<head>
+<title>OpenZFS Performance Trends</title>
+<style>
+body { font-family: sans-serif; font-size: 12px; }
+table { border-collapse: collapse; }
+td, th { border: 1px solid #ccc; padding: 2px 6px; text-align: left; }
+tr.regression { background: #fdd; }
+</style>
+</head>
+<body>
+<h2>OpenZFS Performance Trends</h2>
+<p>The latest result of every benchmark and pool layout, and the trend of
+the last %d results for %s.  Changes are relative to the median of the
+previous %d results, positive changes are improvements.  Highlighted
+results are regressions of more than %d%% and %.1f robust standard
+deviations.</p>
+<table>
+<tr><th>Benchmark</th><th>Layout</th><th>Value</th><th>Change</th>
+<th>Version</th><th>Trend</th></tr>
+%s
+</table>
+<p>Last Update: %s</p>
+</body>
+</html>
+""" % (100, cgi.escape(self.baseline_origin), self.window,
+            int(self.threshold * 100), self.sigmas, "\n".join(rows),
+            time.strftime("%Y-%m-%d %H:%M:%S")))
+        os.rename(self.page + ".tmp", self.page)
+
+    @staticmethod
+    def plot(points, width=300, height=40):
+        if len(points) < 2:
+            return ""
+
+        low = min(value for value, regression in points)
+        high = max(value for value, regression in points)
+        scale = (high - low) or 1.0
+        coords = [(i * width / float(len(points) - 1),
+            height - 2 - (value - low) * (height - 4) / scale)
+            for i, (value, regression) in enumerate(points)]
+
+        svg = ['<svg width="%d" height="%d">' % (width, height),
+            '<polyline fill="none" stroke="#36c" points="%s"/>' % " ".join(
+            "%.1f,%.1f" % xy for xy in coords)]
+        for (x, y), (value, regression) in zip(coords, points):
+            if regression:
+                svg.append('<circle cx="%.1f" cy="%.1f" r="3" fill="red"/>' %
+                    (x, y))
+        svg.append('</svg>')
+
+        return "".join(svg)
+
+#
+# Build step which adds the PTS results uploaded by the build to the
+# history, and reports any regressions as a GitHub status on the commit.
+#
+class PerfRegressionCheck(BuildStep):
+    name = "perf regressions"
+    description = ["checking perf regressions"]
+    descriptionDone = ["perf regressions"]
+    renderables = ['dest', 'origin']
+
+    def __init__(self, history, dest, origin, url=None, token=None,
+                 context="buildbot/perf-regression", **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.history = history
+        self.dest = dest
+        self.origin = origin
+        self.url = url
+        self.token = token
+        self.context = context
+
+    def start(self):
+        paths = sorted(glob.glob(os.path.join(self.dest, "*", "pts", "*.xml")))
+        if not paths:
+            self.step_status.setText(["perf", "no results"])
+            return self.finished(SUCCESS)
+
+        self.revision = None
+        for ss in self.build.getSourceStamps():
+            if ss.codebase == 'zfs':
+                self.revision = ss.revision
+
+        version = self.getProperty('commit-description', {}).get('zfs', '')
+        d = threads.deferToThread(self.add, paths, version)
+        d.addCallback(self.checked)
+        d.addErrback(self.check_failed)
+
+    def add(self, paths, version):
+        regressions = []
+        for path in paths:
+            found = self.history.add(path, version, self.origin,
+                self.revision, self.getProperty('buildnumber'))
+            regressions.extend(found or [])
+
+        return regressions
+
+    def checked(self, regressions):
+        self.setProperty('perf_regressions', len(regressions),
+            'PerfRegressionCheck')
+        for benchmark, layout, change in regressions:
+            log.msg("Performance regression: %s (%s) %+.1f%%" % (
+                benchmark, layout, -100.0 * change))
+
+        if regressions:
+            worst = max(regressions, key=lambda r: r[2])
+            description = "%d regressions, worst %s (%s) %+.1f%%" % (
+                len(regressions), worst[0], worst[1], -100.0 * worst[2])
+            self.report('failure', description)
+            self.step_status.setText(["perf", "%d regressions" %
+                len(regressions)])
+            self.finished(WARNINGS)
+        else:
+            self.report('success', "No performance regressions.")
+            self.step_status.setText(["perf", "no regressions"])
+            self.finished(SUCCESS)
+
+    def report(self, state, description):
+        if self.token is None or self.revision is None:
+            return
+
+        target_url = None
+        if self.url is not None:
+            target_url = self.url + os.path.basename(self.history.page)
+
+        d = post_status(self.getProperty('repoowner'),
+            self.getProperty('reponame'), self.revision, state, self.context,
+            description[:140], target_url=target_url, token=self.token)
+        d.addErrback(log.err, "Failed to set the perf regression status")
+
+    def check_failed(self, failure):
+        log.err(failure, "Failed to check for performance regressions")
+        self.step_status.setText(["perf", "check failed"])
+        self.finished(WARNINGS)
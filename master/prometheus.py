@@ -0,0 +1,280 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import bisect
+import threading
+import time
+
+from buildbot.status.base import StatusReceiverMultiService
+from twisted.web import resource
+
+#
+# Prometheus metrics.
+#
+# The master's modules record counters, gauges and histograms in the
+# registry as events happen; recording only updates a few numbers in
+# memory so it never delays the reactor.  The registry is served in the
+# Prometheus text format by the MetricsResource, which is added to the
+# WebStatus as /metrics.  Per-build and per-step durations are recorded by
+# the MetricsCollector status receiver.
+#
+# Metrics are declared once, at module level, e.g.:
+#
+#   requests = registry.counter("github_api_requests_total",
+#       "GitHub API requests", ["result"])
+#   requests.inc(result="hit")
+#
+
+# Buckets, in seconds, for request latencies and for builds and steps.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+    14400, 28800, 43200)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (n, escape(v)) for n, v in zip(names, values)]
+    pairs.extend('%s="%s"' % (n, escape(v)) for n, v in extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    return repr(float(value))
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s expects labels %s, not %s" % (self.name,
+                ", ".join(self.labels), ", ".join(sorted(labels))))
+
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+        Returns a list of (suffix, label values, extra labels, value).
+        """
+        with self.lock:
+            return [("", key, (), value)
+                for key, value in sorted(self.values.items())]
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                format_labels(self.labels, key, extra), format_value(value)))
+
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, values):
+        """
+        Replaces every value, values is a list of (labels, value) where
+        labels is a dict.  Labels which are no longer reported are removed.
+        """
+        values = dict((self.key(labels), value) for labels, value in values)
+        with self.lock:
+            self.values = values
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            # Only the first bucket the value falls in is counted, the
+            # buckets are made cumulative when exposed.
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def time(self, start, **labels):
+        self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), count, total))
+                for key, (counts, count, total) in self.values.items())
+
+        samples = []
+        for key, (counts, count, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append(("_bucket", key, (("le", format_value(bound)),),
+                    cumulative))
+            samples.append(("_bucket", key, (("le", "+Inf"),), count))
+            samples.append(("_count", key, (), count))
+            samples.append(("_sum", key, (), total))
+
+        return samples
+
+class Registry(object):
+    def __init__(self, prefix="buildbot_"):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(self.prefix + name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def expose(self):
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+registry = Registry()
+
+#
+# Serves the registry, e.g. c['status'][0].putChild("metrics", ...).
+#
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.registry.expose()
+
+build_seconds = registry.histogram("build_duration_seconds",
+    "Duration of finished builds", ["builder", "result"], DURATION_BUCKETS)
+step_seconds = registry.histogram("step_duration_seconds",
+    "Duration of finished build steps", ["builder", "step", "result"],
+    DURATION_BUCKETS)
+builds_running = registry.gauge("builds_running",
+    "Builds currently running", ["builder"])
+queue_wait_seconds = registry.histogram("builder_queue_wait_seconds",
+    "Time from submission until a build request is started", ["builder"],
+    DURATION_BUCKETS)
+
+#
+# Records the duration of every build and step, e.g. the time spent
+# installing dependencies, building, and running the ZFS Test Suite, and
+# the time the requests of each build waited to be started.
+#
+class MetricsCollector(StatusReceiverMultiService):
+    results = ["success", "warnings", "failure", "skipped", "exception",
+        "retry", "cancelled"]
+
+    def __init__(self):
+        StatusReceiverMultiService.__init__(self)
+        self.running_builds = {}
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent
+        self.status.subscribe(self)
+
+    def stopService(self):
+        self.status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def result_name(self, result):
+        if result is None:
+            return "unknown"
+        if 0 <= result < len(self.results):
+            return self.results[result]
+
+        return str(result)
+
+    def builderAdded(self, name, builder):
+        return self
+
+    def build_requests(self, builderName, build):
+        """
+        Returns the build requests of a started build.
+        """
+        builder = self.status.master.botmaster.builders.get(builderName)
+        for running in getattr(builder, 'building', []):
+            if running.build_status is build:
+                return running.requests
+
+        return []
+
+    def buildStarted(self, builderName, build):
+        self.running_builds[builderName] = \
+            self.running_builds.get(builderName, 0) + 1
+        builds_running.set(self.running_builds[builderName],
+            builder=builderName)
+
+        # A request may be selected by nextBuild several times before it's
+        # started, e.g. when the slave fails to substantiate, so the wait is
+        # only recorded once the build has started.
+        start, end = build.getTimes()
+        for request in self.build_requests(builderName, build):
+            if start is not None and request.submittedAt is not None:
+                queue_wait_seconds.observe(start - request.submittedAt,
+                    builder=builderName)
+
+        return self
+
+    def stepFinished(self, build, step, results):
+        start, end = step.getTimes()
+        if start is None or end is None:
+            return
+
+        step_seconds.observe(end - start,
+            builder=build.getBuilder().getName(), step=step.getName(),
+            result=self.result_name(step.getResults()[0]))
+
+    def buildFinished(self, builderName, build, results):
+        self.running_builds[builderName] = max(0,
+            self.running_builds.get(builderName, 0) - 1)
+        builds_running.set(self.running_builds[builderName],
+            builder=builderName)
+
+        start, end = build.getTimes()
+        if start is not None and end is not None:
+            build_seconds.observe(end - start, builder=builderName,
+                result=self.result_name(results))
@@ -0,0 +1,273 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import json
+import os
+import time
+
+from buildbot.db.buildrequests import AlreadyClaimedError
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import FAILURE
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+#
+# Debounced queue of GitHub pull request events.
+#
+# Contributors often push to a pull request several times in quick
+# succession.  Rather than building every intermediate head, the webhook
+# hands the events to the PullRequestQueue (see CustomGitHubEventHandler)
+# which waits until no new event has been received for the pull request
+# for delay seconds, or max_delay seconds have passed since the first one,
+# and then only processes the latest event.  Any build requests still
+# pending for heads of the pull request which have since been replaced are
+# cancelled before the changes for the new head are added.
+#
+# The queued events are written to path as they arrive, so they're
+# processed after a master restart rather than lost.  The revisions added
+# for an event are recorded as they're added, so a replayed event doesn't
+# add them again.  A reconfig replaces the queue with a new instance, so the
+# queue is only read when the service starts, after the old instance has
+# finished processing and saved it.  Events received by the new instance
+# before then are held until it starts.
+#
+# The queue is stored as JSON:
+#
+#   { "stats": { "events": <n>, "collapsed": <n>, "processed": <n>,
+#                "cancelled": <n> },
+#     "pulls": { "<repo>#<number>": { "first": <secs>, "last": <secs>,
+#                                     "events": <n>, "payload": { ... },
+#                                     "added": [ "<sha>" ] } } }
+#
+class PullRequestQueue(StatusReceiverMultiService):
+    actions = ('opened', 'reopened', 'synchronize')
+    retries = 3
+
+    def __init__(self, handler, path="pull-request-queue.json", delay=120,
+                 max_delay=600):
+        StatusReceiverMultiService.__init__(self)
+        self.handler = handler
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.timers = {}
+        self.processing = {}
+        self.held = []
+        self.queue = {"stats": {"events": 0, "collapsed": 0, "processed": 0,
+            "cancelled": 0}, "pulls": {}}
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.master = self.parent.master
+        self.load()
+
+        # Replay the events queued before the master was restarted, or
+        # received before the queue was started.
+        for key in self.queue["pulls"].keys():
+            self.schedule(key)
+
+        held, self.held = self.held, []
+        for method, payload in held:
+            method(payload)
+
+    def cancel_timers(self):
+        for timer in self.timers.values():
+            if timer.active():
+                timer.cancel()
+        self.timers = {}
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        # Events being processed may be rescheduled as they finish.
+        self.cancel_timers()
+        yield defer.DeferredList(self.processing.values())
+        self.cancel_timers()
+        self.save()
+
+        yield StatusReceiverMultiService.stopService(self)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                self.queue = json.load(f)
+        except (IOError, ValueError) as e:
+            log.msg("Unable to load pull request queue '%s': %s" % (
+                self.path, e))
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.queue, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.msg("Unable to save pull request queue '%s': %s" % (
+                self.path, e))
+
+    def stats(self):
+        stats = self.queue["stats"]
+        return "Pull request queue: %d queued, %d events, %d collapsed, " \
+            "%d processed, %d build requests cancelled" % (
+            len(self.queue["pulls"]), stats["events"], stats["collapsed"],
+            stats["processed"], stats["cancelled"])
+
+    def key(self, payload):
+        return "%s#%d" % (payload['repository']['full_name'],
+            payload['number'])
+
+    def add(self, payload):
+        """
+        Queues a pull request event, replacing any event already queued for
+        the same pull request.
+        """
+        if not self.running:
+            self.held.append((self.add, payload))
+            return
+
+        key = self.key(payload)
+        now = time.time()
+        stats = self.queue["stats"]
+        stats["events"] += 1
+
+        entry = self.queue["pulls"].get(key)
+        if entry is None or key in self.processing:
+            entry = {"first": now, "events": 0, "added": []}
+        else:
+            stats["collapsed"] += 1
+            log.msg("GitHub PR %s: replacing queued head %s with %s" % (key,
+                entry["payload"]['pull_request']['head']['sha'],
+                payload['pull_request']['head']['sha']))
+
+        entry["last"] = now
+        entry["events"] += 1
+        entry["payload"] = payload
+        self.queue["pulls"][key] = entry
+        self.save()
+
+        self.schedule(key)
+
+    def discard(self, payload):
+        """
+        Drops the queued event for a pull request which has been closed.
+        """
+        if not self.running:
+            self.held.append((self.discard, payload))
+            return
+
+        key = self.key(payload)
+        if key in self.queue["pulls"] and key not in self.processing:
+            log.msg("GitHub PR %s closed, discarding queued event" % key)
+            del self.queue["pulls"][key]
+            self.queue["stats"]["collapsed"] += 1
+            self.save()
+
+            timer = self.timers.pop(key, None)
+            if timer is not None and timer.active():
+                timer.cancel()
+
+    def schedule(self, key):
+        entry = self.queue["pulls"][key]
+        due = min(entry["last"] + self.delay, entry["first"] + self.max_delay)
+        delay = max(0, due - time.time())
+
+        timer = self.timers.get(key)
+        if timer is not None and timer.active():
+            timer.reset(delay)
+        else:
+            self.timers[key] = reactor.callLater(delay, self.start_process,
+                key)
+
+    def start_process(self, key):
+        self.timers.pop(key, None)
+        if key in self.processing:
+            return
+
+        d = self.processing[key] = self.process(key)
+        d.addBoth(self.processed, key)
+
+    def processed(self, result, key):
+        del self.processing[key]
+        return result
+
+    @defer.inlineCallbacks
+    def process(self, key):
+
+        entry = self.queue["pulls"][key]
+        payload = entry["payload"]
+        failed = False
+        try:
+            changes, src = yield self.handler().process_pull_request(payload,
+                entry["last"])
+
+            revisions = set(change['revision'] for change in changes)
+            yield self.cancel_superseded(payload, revisions)
+
+            for change in changes:
+                if change['revision'] in entry["added"]:
+                    continue
+
+                yield self.master.addChange(src=src, **change)
+                entry["added"].append(change['revision'])
+                self.save()
+
+            self.queue["stats"]["processed"] += 1
+        except Exception:
+            log.err(None, "Failed to process GitHub PR %s" % key)
+            failed = True
+
+        # A newer event may have been queued while processing.  A failed
+        # event is retried a few times, e.g. for GitHub API errors.
+        if self.queue["pulls"].get(key) is entry:
+            if failed and entry.get("retries", 0) < self.retries:
+                entry["retries"] = entry.get("retries", 0) + 1
+                entry["first"] = entry["last"] = time.time()
+                self.schedule(key)
+            else:
+                del self.queue["pulls"][key]
+        elif key in self.queue["pulls"]:
+            self.schedule(key)
+        self.save()
+
+        log.msg(self.stats())
+
+    @defer.inlineCallbacks
+    def cancel_superseded(self, payload, revisions):
+        """
+        Cancels the unclaimed build requests for the pull request which are
+        for revisions other than those being added.
+        """
+        db = self.master.db
+        branch = 'refs/pull/%d/head' % payload['number']
+        brdicts = yield db.buildrequests.getBuildRequests(complete=False,
+            claimed=False, branch=branch)
+
+        buildsets = {}
+        for brdict in brdicts:
+            bsid = brdict['buildsetid']
+            if bsid not in buildsets:
+                bsdict = yield db.buildsets.getBuildset(bsid)
+                sslist = yield db.sourcestamps.getSourceStamps(
+                    bsdict['sourcestampsetid'])
+                buildsets[bsid] = set(ss['revision'] for ss in sslist
+                    if ss['branch'] == branch)
+
+            if not buildsets[bsid] or buildsets[bsid] & revisions:
+                continue
+
+            # Cancelled the same way as from the web interface.
+            try:
+                yield db.buildrequests.claimBuildRequests([brdict['brid']])
+            except AlreadyClaimedError:
+                continue
+
+            yield db.buildrequests.completeBuildRequests([brdict['brid']],
+                FAILURE)
+            yield self.master.maybeBuildsetComplete(bsid)
+
+            log.msg("Cancelled build request %d on %s for superseded %s" % (
+                brdict['brid'], brdict['buildername'],
+                ", ".join(sorted(buildsets[bsid]))))
+            self.queue["stats"]["cancelled"] += 1
@@ -0,0 +1,358 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import os
+import re
+import time
+
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.github import GitHubStatus
+from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED
+from buildbot.status.results import EXCEPTION, RETRY, worst_status
+from github import post_status
+from twisted.internet import threads
+from twisted.python import log
+
+#
+# Sharded ZFS Test Suite builds.
+#
+# A sharded platform is tested by several builders, one per shard, each of
+# which builds ZFS and then runs its part of the test suite (see
+# bb-test-zfstests.sh and zts_shard.py).  The ShardMerger waits for every
+# shard of a revision to finish, combines their summary logs, and links
+# their test logs, in to a single result under public_html, and reports one
+# GitHub status for the platform.  The individual shards are excluded from the usual per-builder
+# GitHub status by ShardedGitHubStatus.
+#
+# Only the shards submitted together, in one buildset, are combined.  A shard
+# rebuilt on its own, e.g. with the rebuild button, is in a buildset of its
+# own which would never be complete, so no status is reported for it.
+#
+
+def shard_name(name, shard, count):
+    """
+    Returns the builder name for a shard, e.g. "CentOS 9 x86_64 shard 1/4
+    (TEST)" for "CentOS 9 x86_64 (TEST)".
+    """
+    m = re.match(r'(.*?)\s*(\(.*\))$', name)
+    if m is None:
+        return "%s shard %d/%d" % (name, shard, count)
+
+    return "%s shard %d/%d %s" % (m.group(1), shard, count, m.group(2))
+
+_result_pattern = re.compile(r'^(PASS|FAIL|SKIP|KILLED|RERAN)\s+(\d+)\s*$')
+_time_pattern = re.compile(r'^Running Time:\s+(\d+):(\d+):(\d+)')
+_section_pattern = re.compile(r'^Tests with .*:\s*$')
+_plan_pattern = re.compile(r'^Shard (\d+)/(\d+):.* plan (\w+)\s*$')
+
+class ShardSummary(object):
+    """
+    The parsed summary.log of one shard.
+    """
+    def __init__(self, text):
+        self.counts = {}
+        self.seconds = 0
+        self.sections = []
+        self.details = []
+        self.plan = None
+
+        section = None
+        in_details = False
+        for line in text.splitlines():
+            m = _plan_pattern.match(line)
+            if m is not None:
+                self.plan = m.group(3)
+                continue
+
+            if in_details:
+                self.details.append(line)
+                continue
+
+            m = _result_pattern.match(line)
+            if m is not None:
+                self.counts[m.group(1)] = int(m.group(2))
+                continue
+
+            m = _time_pattern.match(line)
+            if m is not None:
+                self.seconds = int(m.group(1)) * 3600 + \
+                    int(m.group(2)) * 60 + int(m.group(3))
+                continue
+
+            if _section_pattern.match(line):
+                section = (line.strip(), [])
+                self.sections.append(section)
+            elif section is not None and line[:1].isspace() and line.strip():
+                section[1].append(line)
+            elif section is not None and line.strip():
+                # Everything after the summary is the output of the tests
+                # which failed.
+                in_details = True
+                self.details.append(line)
+
+def format_time(seconds):
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60,
+        seconds % 60)
+
+def merge_summaries(summaries):
+    """
+    Returns the text of a summary.log combining the shard summaries.
+    """
+    counts = {}
+    sections = []
+    entries = {}
+    for summary in summaries:
+        for result, count in summary.counts.items():
+            counts[result] = counts.get(result, 0) + count
+        for header, lines in summary.sections:
+            if header not in entries:
+                sections.append(header)
+                entries[header] = []
+            entries[header].extend(lines)
+
+    lines = ["Results Summary"]
+    for result in ("PASS", "FAIL", "SKIP", "KILLED", "RERAN"):
+        if result in counts:
+            lines.append("%s\t%5d" % (result, counts[result]))
+
+    total = sum(counts.values())
+    lines.append("")
+    lines.append("Running Time:\t%s (longest shard), %s (total)" % (
+        format_time(max([s.seconds for s in summaries] or [0])),
+        format_time(sum(s.seconds for s in summaries))))
+    if total:
+        lines.append("Percent passed:\t%.1f%%" % (
+            100.0 * counts.get("PASS", 0) / total))
+    lines.append("Shards:\t\t%d" % len(summaries))
+
+    plans = set(s.plan for s in summaries)
+    if len(plans) > 1:
+        lines.append("WARNING: the shards used different plans (%s), some "
+            "tests may have been skipped or run twice" % ", ".join(
+            sorted(str(plan) for plan in plans)))
+
+    for header in sections:
+        lines.append("")
+        lines.append(header)
+        lines.extend(sorted(entries[header]))
+
+    for summary in summaries:
+        if summary.details:
+            lines.append("")
+            lines.extend(summary.details)
+
+    return "\n".join(lines) + "\n"
+
+def get_log_text(build, name):
+    for logfile in build.getLogs():
+        if logfile.getName() == name:
+            return logfile.getText()
+
+    return ""
+
+def get_log_url(status, build, name):
+    for logfile in build.getLogs():
+        if logfile.getName() == name:
+            return status.getURLForThing(logfile)
+
+    return None
+
+def replace_file(path, text):
+    """
+    Writes a file under public_html by renaming a new file over it.  The
+    files there may be hard links in to the artifact store, see
+    artifacts.py, which must never be written in place.
+    """
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+class ShardMerger(StatusReceiverMultiService):
+    """
+    Combines the results of the shards for each revision.
+
+    shards  - dict mapping each shard builder name to (platform builder
+              name, shard number, shard count)
+    path    - function returning the directory for the combined results
+              of a build, relative to basedir
+    url     - base URL of basedir, used as the GitHub status target
+    token   - GitHub API token, no status is reported when None
+    expire  - seconds after which the results of an incomplete set of
+              shards are discarded
+    """
+    github_states = {
+        SUCCESS: 'success',
+        WARNINGS: 'success',
+        SKIPPED: 'success',
+        FAILURE: 'failure',
+        EXCEPTION: 'error',
+    }
+
+    def __init__(self, shards, path, basedir="public_html", url=None,
+                 token=None, expire=86400):
+        StatusReceiverMultiService.__init__(self)
+        self.shards = shards
+        self.path = path
+        self.basedir = basedir
+        self.url = url
+        self.token = token
+        self.expire = expire
+        self.pending = {}
+        self.platform_shards = {}
+        for name, (platform, shard, count) in shards.items():
+            self.platform_shards.setdefault(platform, set()).add(name)
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self.status = self.parent
+        self.status.subscribe(self)
+
+    def stopService(self):
+        self.status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        if name in self.shards:
+            return self
+
+        return None
+
+    def get_bsid(self, builderName, build):
+        """
+        Returns the buildset of a running build, or None.
+        """
+        builder = self.status.master.botmaster.builders.get(builderName)
+        for running in getattr(builder, 'building', []):
+            if running.build_status is build and running.requests:
+                return running.requests[0].bsid
+
+        return None
+
+    def get_key(self, builderName, build):
+        revision = None
+        for ss in build.getSourceStamps():
+            if ss.codebase == 'zfs':
+                revision = ss.revision
+
+        return (self.shards[builderName][0], revision,
+            self.get_bsid(builderName, build))
+
+    def expire_pending(self):
+        now = time.time()
+        for key, (started, complete, results) in self.pending.items():
+            if now - started > self.expire:
+                log.msg("Discarding incomplete shards for %s %s" % key[:2])
+                del self.pending[key]
+
+    def buildStarted(self, builderName, build):
+        self.expire_pending()
+
+        key = self.get_key(builderName, build)
+        if key not in self.pending:
+            self.pending[key] = (time.time(), None, {})
+            d = self.status.master.db.buildrequests.getBuildRequests(
+                bsid=key[2])
+            d.addCallback(self.got_buildset, key, build)
+            d.addErrback(log.err, "Failed to look up the shards for %s %s" %
+                key[:2])
+
+        return None
+
+    def got_buildset(self, brdicts, key, build):
+        entry = self.pending.get(key)
+        if entry is None:
+            return
+
+        platform = key[0]
+        builders = set(brdict['buildername'] for brdict in brdicts)
+        complete = self.platform_shards[platform] <= builders
+        started, unused, finished = entry
+        self.pending[key] = (started, complete, finished)
+
+        if complete:
+            self.report(key, build, 'pending', 'Build started.')
+        else:
+            log.msg("Not combining the shards for %s %s, only %s were "
+                "submitted" % (key[:2] + (", ".join(sorted(builders)),)))
+
+    def buildFinished(self, builderName, build, results):
+        # The shard will be built again.
+        if results == RETRY:
+            return
+
+        key = self.get_key(builderName, build)
+        platform, shard, count = self.shards[builderName]
+        started, complete, finished = self.pending.setdefault(key,
+            (time.time(), None, {}))
+        if complete is False:
+            del self.pending[key]
+            return
+
+        finished[shard] = (results, build)
+        if len(finished) < count:
+            return
+
+        del self.pending[key]
+        builds = [finished[i][1] for i in sorted(finished)]
+        result = reduce(worst_status, [r for r, b in finished.values()])
+
+        logs = [(b.getBuilder().getName(), b.getNumber(),
+            get_log_url(self.status, b, "tests")) for b in builds]
+        d = threads.deferToThread(self.merge, builds, logs)
+        d.addCallback(lambda path: self.report(key, build,
+            self.github_states.get(result, 'error'), 'Build done.', path))
+        d.addErrback(log.err, "Failed to merge shards for %s %s" % key[:2])
+
+    def merge(self, builds, logs):
+        """
+        Writes the combined summary, and a test log linking the test log of
+        each shard, a list of (builder name, build number, URL).  Runs in a
+        thread.  Returns the path of the combined summary.
+        """
+        path = os.path.join(self.path(builds[0]), "zts")
+        directory = os.path.join(self.basedir, path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        summaries = [ShardSummary(get_log_text(b, "summary")) for b in builds]
+        replace_file(os.path.join(directory, "summary.log"),
+            merge_summaries(summaries))
+
+        replace_file(os.path.join(directory, "test.log"), "".join(
+            "==== %s #%d ====\n%s\n" % (name, number, url or "(no log)")
+            for name, number, url in logs))
+
+        return os.path.join(path, "summary.log")
+
+    def report(self, key, build, state, description, path=None):
+        platform, revision, bsid = key
+        if self.token is None or revision is None:
+            return
+
+        target_url = None
+        if path is not None and self.url is not None:
+            target_url = self.url + path
+
+        d = post_status(build.getProperty('repoowner'),
+            build.getProperty('reponame'), revision, state,
+            "buildbot/%s" % platform, description, target_url=target_url,
+            token=self.token)
+        d.addErrback(log.err, "Failed to set status for %s %s" % key[:2])
+
+class ShardedGitHubStatus(GitHubStatus):
+    """
+    GitHubStatus which doesn't report the individual shards, the combined
+    status is reported by the ShardMerger.
+    """
+    def __init__(self, shards=(), **kwargs):
+        GitHubStatus.__init__(self, **kwargs)
+        self.shards = set(shards)
+
+    def builderAdded(self, name, builder):
+        if name in self.shards:
+            return None
+
+        return GitHubStatus.builderAdded(self, name, builder)
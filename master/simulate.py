@@ -0,0 +1,1068 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+#
+# Offline simulation of the master's scheduling.
+#
+# Loads the builders, slaves and schedulers from master.cfg and replays a
+# stream of changes against simulated latent slaves, without starting the
+# master or any EC2 instances.  Build requests are distributed the way the
+# buildmaster does: the builders with pending requests are ordered by
+# c['prioritizeBuilders'], then for each builder nextSlave() picks one of
+# the available slaves and nextBuild() one of the pending requests until
+# either runs out.  Latent slaves take the boot time to substantiate and
+# are shut down build_wait_timeout seconds after their last build.
+#
+# The change stream is either recorded, from the master's state database or
+# a JSON lines file, or synthetic, a week of pull requests being pushed to
+# repeatedly plus merges to master.  The nightly schedulers fire at their
+# configured time (UTC).  For example:
+#
+#   python simulate.py --synthetic --prs 40 --days 7
+#   python simulate.py --changes state.sqlite --start 2023-06-01 --days 7
+#   python simulate.py --synthetic --boot-time 'FreeBSD=900' \
+#       --run-time '\(TEST\)=240' --json report.json
+#
+# With --warm-pool a WarmPoolPolicy is checked against real slaves and the
+# offline EC2 connection instead, see check_warm_pool().
+#
+# With --stock-priority the builders are ordered the way the buildmaster
+# does without c['prioritizeBuilders'], by their oldest pending request, to
+# compare the effect of the configured BuilderPrioritizer.
+#
+# Reported are the request wait (submitted until claimed by a slave) and
+# start (until the build starts running) percentiles, slave utilization,
+# the spot cost of the substantiated slaves, the CPU time spent in each
+# scheduling decision, and the hit rates of the c['caches'] sizes for a
+# model of the master's cache accesses.
+#
+# Run from the master directory in the master's environment, master.cfg
+# must be loadable (e.g. password.py must exist).
+#
+
+import argparse
+import calendar
+import gzip
+import heapq
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+
+from collections import OrderedDict
+
+from buildbot.util import epoch2datetime
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+#
+# Simulated clock, substituted for the time module used by buildslaves.py
+# so the builder priorities are computed in simulated time.
+#
+class SimClock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def call(fn, *args):
+    """
+    Calls fn, which may return a Deferred, and returns its result.  The
+    simulated database fires every Deferred synchronously.
+    """
+    results = []
+    d = defer.maybeDeferred(fn, *args)
+    d.addBoth(results.append)
+    if not results:
+        raise RuntimeError("%r did not complete synchronously" % fn)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+
+    return results[0]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+#
+# LRU model of one of the master's caches.
+#
+class SimCache(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries[key] = self.entries.pop(key)
+            return
+
+        self.misses += 1
+        self.entries[key] = True
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return 100.0 * self.hits / total if total else 0.0
+
+class SimChange(object):
+    def __init__(self, number, when, category="", branch="master",
+                 comments="", revision=None, properties=None,
+                 project="zfs", repository="", codebase="zfs"):
+        self.number = number
+        self.when = when
+        self.category = category
+        self.branch = branch
+        self.comments = comments
+        self.revision = revision
+        self.properties = properties or {}
+        self.project = project
+        self.repository = repository
+        self.codebase = codebase
+        self.files = []
+
+class SimSource(object):
+    def __init__(self, ssid, changes):
+        self.ssid = ssid
+        self.changes = changes
+
+class SimRequest(object):
+    def __init__(self, sim, brid, builder, source, submitted):
+        self.sim = sim
+        self.id = brid
+        self.builder = builder
+        self.source = source
+        self.submittedAt = submitted
+        self.claimed = None
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+
+class SimSlave(object):
+    """
+    The state of a slave, shared by the builders it's attached to.
+    """
+    def __init__(self, slave, boot_time, price):
+        self.slave = slave
+        self.name = slave.slavename
+        self.latent = hasattr(slave, 'build_wait_timeout')
+        self.boot_time = boot_time if self.latent else 0.0
+        self.price = price if self.latent else 0.0
+        self.wait_timeout = getattr(slave, 'build_wait_timeout', 0)
+        self.substantiated = not self.latent
+        self.up_since = None
+        self.build = None
+        self.shutdown_at = None
+        self.busy_seconds = 0.0
+        self.up_seconds = 0.0
+        self.boots = 0
+
+class SimSlaveBuilder(object):
+    """
+    A slave attached to a builder, as passed to nextSlave().
+    """
+    def __init__(self, simslave):
+        self.simslave = simslave
+        self.slave = simslave.slave
+
+    def isAvailable(self):
+        return self.simslave.build is None
+
+    def isIdle(self):
+        return self.simslave.build is None and self.simslave.substantiated
+
+class SimBuilder(object):
+    def __init__(self, config, slaves, run_time):
+        self.config = config
+        self.name = config.name
+        self.slaves = slaves
+        self.run_time = run_time
+        self.pending = []
+        self.number = 0
+
+class SimBuildRequests(object):
+    def __init__(self, sim):
+        self.sim = sim
+
+    def getBuildRequests(self, buildername=None, complete=None, claimed=None,
+                         **kwargs):
+        brdicts = []
+        for builder in self.sim.builders.values():
+            if buildername is not None and builder.name != buildername:
+                continue
+            for request in builder.pending:
+                self.sim.caches['BuildRequests'].get(request.id)
+                brdicts.append({'brid': request.id,
+                    'buildername': builder.name,
+                    'submitted_at': epoch2datetime(request.submittedAt)})
+
+        return defer.succeed(brdicts)
+
+class SimDB(object):
+    def __init__(self, sim):
+        self.buildrequests = SimBuildRequests(sim)
+
+class SimMaster(object):
+    def __init__(self, sim):
+        self.db = SimDB(sim)
+
+#
+# Default run times, in minutes, by builder type.  The build part of a
+# sharded test builder is repeated by each shard.
+#
+default_run_times = [
+    (r'\(STYLE\)', 15),
+    (r'\(BUILD\)', 30),
+    (r'\(PERF\)', 600),
+    (r'shard (\d+)/(\d+)', None),
+    (r'\(TEST\)', 240),
+]
+
+default_build_minutes = 30
+
+def parse_overrides(values):
+    overrides = []
+    for value in values or []:
+        pattern, sep, number = value.rpartition('=')
+        if not sep:
+            raise ValueError("Expected REGEX=NUMBER, not '%s'" % value)
+        overrides.append((re.compile(pattern), float(number)))
+
+    return overrides
+
+def lookup(overrides, name, default):
+    for pattern, value in overrides:
+        if pattern.search(name):
+            return value
+
+    return default
+
+def run_time(name, overrides):
+    """
+    Returns the mean run time of a builder in seconds.
+    """
+    minutes = lookup(overrides, name, None)
+    if minutes is not None:
+        return minutes * 60.0
+
+    for pattern, minutes in default_run_times:
+        m = re.search(pattern, name)
+        if m is None:
+            continue
+        if minutes is None:
+            test = dict(default_run_times)[r'\(TEST\)'] - default_build_minutes
+            minutes = default_build_minutes + test / float(m.group(2))
+        return minutes * 60.0
+
+    return default_build_minutes * 60.0
+
+class Simulation(object):
+    def __init__(self, config, boot_times, run_times, prices, jitter=0.15,
+                 seed=0, start=0.0):
+        self.config = config
+        self.random = random.Random(seed)
+        self.jitter = jitter
+        self.clock = SimClock(start)
+        self.events = []
+        self.sequence = 0
+        self.next_brid = 1
+        self.next_ssid = 1
+        self.requests = []
+        self.cancelled = 0
+        self.timings = {'prioritizeBuilders': [], 'nextSlave': [],
+            'nextBuild': []}
+        self.master = SimMaster(self)
+
+        c = config['c']
+        self.prioritize = c.get('prioritizeBuilders')
+        self.caches = {}
+        sizes = {'Changes': 10, 'Builds': 15}
+        sizes.update(c.get('caches', {}))
+        for name in ('Changes', 'chdicts', 'BuildRequests', 'SourceStamps',
+                     'ssdicts', 'Builds'):
+            self.caches[name] = SimCache(name, sizes.get(name, 1))
+
+        self.slaves = {}
+        for slave in c['slaves']:
+            cls = type(slave).__name__
+            default_boot = getattr(slave, 'default_boot_latency', 600.0)
+            price = getattr(slave, 'max_spot_price', 0.0) or 0.0
+            self.slaves[slave.slavename] = SimSlave(slave,
+                lookup(boot_times, cls, lookup(boot_times, slave.slavename,
+                default_boot)),
+                lookup(prices, getattr(slave, 'instance_type', '') or '',
+                price))
+
+        self.builders = OrderedDict()
+        for bc in c['builders']:
+            slaves = [SimSlaveBuilder(self.slaves[name])
+                for name in bc.slavenames if name in self.slaves]
+            self.builders[bc.name] = SimBuilder(bc, slaves,
+                run_time(bc.name, run_times))
+
+        self.schedulers = c['schedulers']
+
+    def now(self):
+        return self.clock.now
+
+    def schedule(self, when, fn, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, fn, args))
+
+    def timed(self, name, fn, *args):
+        start = time.clock()
+        try:
+            return call(fn, *args)
+        finally:
+            self.timings[name].append(time.clock() - start)
+
+    def vary(self, seconds):
+        if not self.jitter:
+            return seconds
+
+        return seconds * self.random.lognormvariate(0.0, self.jitter)
+
+    def add_change(self, change):
+        self.cancel_superseded(change)
+        for sched in self.schedulers:
+            change_filter = getattr(sched, 'change_filter', None)
+            if change_filter is None or not change_filter.filter_change(change):
+                continue
+            self.add_buildset(sched.builderNames, [change])
+
+    def add_nightly(self, sched):
+        self.add_buildset(sched.builderNames, [])
+
+    def add_buildset(self, builder_names, changes):
+        source = SimSource(self.next_ssid, changes)
+        self.next_ssid += 1
+        for name in builder_names:
+            builder = self.builders.get(name)
+            if builder is None:
+                continue
+            request = SimRequest(self, self.next_brid, builder, source,
+                self.now())
+            self.next_brid += 1
+            builder.pending.append(request)
+            self.requests.append(request)
+
+    def cancel_superseded(self, change):
+        # PullRequestQueue.cancel_superseded(), the pending requests for
+        # other heads of the pull request are cancelled as a push is added.
+        from buildslaves import change_property
+        pr_number = change_property(change, 'pr_number')
+        head = change_property(change, 'pr_head')
+        if pr_number is None or head is None:
+            return
+
+        for builder in self.builders.values():
+            for request in list(builder.pending):
+                heads = set(change_property(c, 'pr_head')
+                    for c in request.source.changes
+                    if change_property(c, 'pr_number') == pr_number)
+                if heads and head not in heads:
+                    self.cancel(request)
+
+    def cancel(self, request):
+        if request in request.builder.pending:
+            request.builder.pending.remove(request)
+        request.cancelled = True
+        self.cancelled += 1
+
+    def load_requests(self, builder):
+        # BuildRequest.fromBrdict() for each pending request.
+        for request in builder.pending:
+            self.caches['BuildRequests'].get(request.id)
+            self.caches['ssdicts'].get(request.source.ssid)
+            self.caches['SourceStamps'].get(request.source.ssid)
+            for change in request.source.changes:
+                self.caches['chdicts'].get(change.number)
+                self.caches['Changes'].get(change.number)
+
+    def distribute(self):
+        builders = [b for b in self.builders.values() if b.pending]
+        if not builders:
+            return
+
+        if self.prioritize is not None:
+            builders = self.timed('prioritizeBuilders', self.prioritize,
+                self.master, builders)
+
+        for builder in builders:
+            self.load_requests(builder)
+            while builder.pending:
+                pool = [sb for sb in builder.slaves if sb.isAvailable()]
+                if not pool:
+                    break
+
+                sb = self.timed('nextSlave', builder.config.nextSlave,
+                    builder, pool)
+                if sb not in pool:
+                    break
+
+                if builder.config.nextBuild is not None:
+                    request = self.timed('nextBuild', builder.config.nextBuild,
+                        builder, list(builder.pending))
+                else:
+                    request = builder.pending[0]
+                if request not in builder.pending:
+                    break
+
+                requests = [request]
+                if builder.config.mergeRequests:
+                    requests.extend(r for r in builder.pending
+                        if r is not request and r.source.changes and
+                        request.source.changes and
+                        r.source.changes[0].branch ==
+                        request.source.changes[0].branch)
+
+                self.claim(builder, sb.simslave, requests)
+
+    def claim(self, builder, simslave, requests):
+        for request in requests:
+            builder.pending.remove(request)
+            request.claimed = self.now()
+
+        simslave.build = (builder, requests)
+        simslave.shutdown_at = None
+        if simslave.substantiated:
+            self.start_build(simslave)
+        else:
+            simslave.boots += 1
+            simslave.up_since = self.now()
+            self.schedule(self.now() + self.vary(simslave.boot_time),
+                self.substantiated, simslave)
+
+    def substantiated(self, simslave):
+        simslave.substantiated = True
+        record = getattr(type(simslave.slave), 'record_boot_latency', None)
+        if record is not None:
+            record(type(simslave.slave).__name__,
+                self.now() - simslave.up_since)
+        self.start_build(simslave)
+
+    def start_build(self, simslave):
+        builder, requests = simslave.build
+        builder.number += 1
+        self.caches['Builds'].get((builder.name, builder.number))
+        for request in requests:
+            request.started = self.now()
+
+        duration = self.vary(builder.run_time)
+        simslave.busy_seconds += duration
+        self.schedule(self.now() + duration, self.finish_build, simslave,
+            builder.number)
+
+    def finish_build(self, simslave, number):
+        builder, requests = simslave.build
+        self.caches['Builds'].get((builder.name, number))
+        for request in requests:
+            request.finished = self.now()
+
+        simslave.build = None
+        if simslave.latent:
+            simslave.shutdown_at = self.now() + simslave.wait_timeout
+            self.schedule(simslave.shutdown_at, self.shutdown, simslave)
+
+    def shutdown(self, simslave):
+        if simslave.build is not None or simslave.shutdown_at is None or \
+                simslave.shutdown_at > self.now():
+            return
+
+        simslave.substantiated = False
+        simslave.shutdown_at = None
+        simslave.up_seconds += self.now() - simslave.up_since
+        simslave.up_since = None
+
+    def nightly_times(self, sched, start, end):
+        def values(v, limit):
+            if v == '*':
+                return range(limit)
+            if isinstance(v, (list, tuple)):
+                return list(v)
+            return [v]
+
+        day = start - start % 86400
+        times = []
+        while day < end:
+            for hour in values(sched.hour, 24):
+                for minute in values(sched.minute, 60):
+                    when = day + hour * 3600 + minute * 60
+                    if start <= when < end:
+                        times.append(when)
+            day += 86400
+
+        return times
+
+    def run(self, changes, start, end):
+        for change in changes:
+            self.schedule(change.when, self.add_change, change)
+
+        for sched in self.schedulers:
+            if hasattr(sched, 'hour') and hasattr(sched, 'minute'):
+                for when in self.nightly_times(sched, start, end):
+                    self.schedule(when, self.add_nightly, sched)
+
+        while self.events:
+            when, seq, fn, args = heapq.heappop(self.events)
+            self.clock.now = when
+            fn(*args)
+
+            # Distribute once all of the events at this time are handled.
+            if not self.events or self.events[0][0] > when:
+                self.distribute()
+
+        for simslave in self.slaves.values():
+            if simslave.up_since is not None:
+                simslave.up_seconds += self.now() - simslave.up_since
+                simslave.up_since = None
+
+    def report(self, start):
+        hours = max(self.now() - start, 1.0) / 3600.0
+        built = [r for r in self.requests if r.finished is not None]
+        waits = [(r.claimed - r.submittedAt) / 60.0 for r in built]
+        starts = [(r.started - r.submittedAt) / 60.0 for r in built]
+        turnarounds = [(r.finished - r.submittedAt) / 60.0 for r in built]
+
+        def pcts(values):
+            return OrderedDict((k, round(percentile(values, p), 1))
+                for k, p in (('p50', 50), ('p90', 90), ('p99', 99),
+                ('max', 100)))
+
+        builders = OrderedDict()
+        for builder in self.builders.values():
+            mine = [r for r in built if r.builder is builder]
+            if not mine:
+                continue
+            builders[builder.name] = OrderedDict([
+                ('builds', len(mine)),
+                ('wait', pcts([(r.claimed - r.submittedAt) / 60.0
+                    for r in mine])),
+            ])
+
+        latent = [s for s in self.slaves.values() if s.latent]
+        busy = sum(s.busy_seconds for s in latent) / 3600.0
+        up = sum(s.up_seconds for s in latent) / 3600.0
+        cost = sum(s.up_seconds / 3600.0 * s.price for s in latent)
+
+        decisions = OrderedDict()
+        for name, values in sorted(self.timings.items()):
+            micros = [v * 1e6 for v in values]
+            decisions[name] = OrderedDict([
+                ('calls', len(micros)),
+                ('mean_us', round(sum(micros) / len(micros), 1)
+                    if micros else 0.0),
+                ('p50_us', round(percentile(micros, 50), 1)),
+                ('p99_us', round(percentile(micros, 99), 1)),
+            ])
+
+        caches = OrderedDict((name, OrderedDict([
+            ('size', cache.size), ('hits', cache.hits),
+            ('misses', cache.misses),
+            ('hit_rate', round(cache.hit_rate(), 1))]))
+            for name, cache in sorted(self.caches.items()))
+
+        return OrderedDict([
+            ('hours', round(hours, 1)),
+            ('requests', len(self.requests)),
+            ('builds', len(built)),
+            ('cancelled', self.cancelled),
+            ('unfinished', len(self.requests) - len(built) - self.cancelled),
+            ('wait_minutes', pcts(waits)),
+            ('start_minutes', pcts(starts)),
+            ('turnaround_minutes', pcts(turnarounds)),
+            ('slave_hours', OrderedDict([('substantiated', round(up, 1)),
+                ('building', round(busy, 1)),
+                ('utilization', round(100.0 * busy / up, 1) if up else 0.0),
+                ('boots', sum(s.boots for s in latent))])),
+            ('spot_cost', round(cost, 2)),
+            ('decisions', decisions),
+            ('caches', caches),
+            ('builders', builders),
+        ])
+
+def print_report(report, out=sys.stdout):
+    def line(fmt, *args):
+        out.write(fmt % args + "\n")
+
+    line("Simulated %.1f hours: %d requests, %d builds, %d cancelled, "
+        "%d unfinished", report['hours'], report['requests'],
+        report['builds'], report['cancelled'], report['unfinished'])
+    line("")
+    line("%-24s %8s %8s %8s %8s", "minutes", "p50", "p90", "p99", "max")
+    for key, label in (('wait_minutes', "wait for slave"),
+                       ('start_minutes', "wait for build start"),
+                       ('turnaround_minutes', "turnaround")):
+        p = report[key]
+        line("%-24s %8.1f %8.1f %8.1f %8.1f", label, p['p50'], p['p90'],
+            p['p99'], p['max'])
+    line("")
+    s = report['slave_hours']
+    line("Latent slaves: %.1f hours substantiated, %.1f building "
+        "(%.1f%% utilization), %d boots, $%.2f spot cost",
+        s['substantiated'], s['building'], s['utilization'], s['boots'],
+        report['spot_cost'])
+    line("")
+    line("%-24s %8s %10s %10s %10s", "decision", "calls", "mean us",
+        "p50 us", "p99 us")
+    for name, d in report['decisions'].items():
+        line("%-24s %8d %10.1f %10.1f %10.1f", name, d['calls'],
+            d['mean_us'], d['p50_us'], d['p99_us'])
+    line("")
+    line("%-24s %8s %10s %10s %8s", "cache", "size", "hits", "misses",
+        "hit %")
+    for name, d in report['caches'].items():
+        line("%-24s %8d %10d %10d %8.1f", name, d['size'], d['hits'],
+            d['misses'], d['hit_rate'])
+    line("")
+    line("%-48s %8s %8s %8s", "builder", "builds", "p50 wait", "p90 wait")
+    for name, d in report['builders'].items():
+        line("%-48s %8d %8.1f %8.1f", name, d['builds'], d['wait']['p50'],
+            d['wait']['p90'])
+
+#
+# Change streams.
+#
+def load_changes_db(path, start, end):
+    """
+    Returns the changes recorded between start and end in a buildbot state
+    database.
+    """
+    conn = sqlite3.connect(path)
+    props = {}
+    for changeid, name, value in conn.execute(
+            "SELECT changeid, property_name, property_value "
+            "FROM change_properties"):
+        try:
+            props.setdefault(changeid, {})[name] = json.loads(value)[0]
+        except (ValueError, IndexError, TypeError):
+            continue
+
+    changes = []
+    for row in conn.execute(
+            "SELECT changeid, when_timestamp, category, branch, comments, "
+            "revision, project, repository, codebase FROM changes "
+            "WHERE when_timestamp >= ? AND when_timestamp < ? "
+            "ORDER BY changeid", (start, end)):
+        changes.append(SimChange(row[0], row[1], category=row[2] or "",
+            branch=row[3], comments=row[4] or "", revision=row[5],
+            properties=props.get(row[0]), project=row[6] or "",
+            repository=row[7] or "", codebase=row[8] or ""))
+    conn.close()
+
+    return changes
+
+def load_changes_json(path, start, end):
+    """
+    Returns the changes in a JSON lines file, one object per change with
+    the "when", "category", "branch", "comments", "revision" and
+    "properties" of the change.  The file may be gzip compressed, as are
+    the change archives written by dbmaint.py.
+    """
+    changes = []
+    numbers = set()
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'r') as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            if not start <= d['when'] < end:
+                continue
+            if 'number' in d:
+                if d['number'] in numbers:
+                    continue
+                numbers.add(d['number'])
+            changes.append(SimChange(d.get('number', number + 1), d['when'],
+                category=d.get('category', ""),
+                branch=d.get('branch', "master"),
+                comments=d.get('comments', ""),
+                revision=d.get('revision'),
+                properties=d.get('properties')))
+
+    return changes
+
+def synthetic_changes(config, start, days, prs, pushes, merges, rng):
+    """
+    Returns a synthetic stream of changes: prs pull requests of 1-5
+    commits, each pushed 1-pushes times during working hours, and merges
+    to master per day.  The categories are those github.py assigns.
+    """
+    pr_head = config.get('builders_pr_master', "")
+    pr_other = config.get('builders_pr_minimum', "")
+    push_master = config.get('builders_push_master', "")
+
+    def working_hours():
+        day = rng.randrange(days)
+        return start + day * 86400 + rng.uniform(8, 20) * 3600
+
+    pushes_list = []
+    for pr in range(1, prs + 1):
+        commits = rng.randint(1, 5)
+        for push in range(rng.randint(1, pushes)):
+            pushes_list.append((working_hours(), pr, commits))
+    for day in range(days):
+        for merge in range(merges):
+            pushes_list.append((start + day * 86400 +
+                rng.uniform(8, 20) * 3600, None, 1))
+    pushes_list.sort()
+
+    changes = []
+    number = 0
+    for when, pr, commits in pushes_list:
+        head = "%040x" % rng.getrandbits(160)
+        for part in range(1, commits + 1):
+            number += 1
+            revision = head if part == commits else \
+                "%040x" % rng.getrandbits(160)
+            if pr is None:
+                changes.append(SimChange(number, when, category=push_master,
+                    branch="master", comments="Merge\n", revision=revision,
+                    properties={'branch': "master"}))
+                continue
+
+            changes.append(SimChange(number, when,
+                category=pr_head if part == commits else pr_other,
+                branch="refs/pull/%d/head" % pr,
+                comments="Change\n\nPull-request: #%d part %d/%d\n" % (
+                pr, part, commits), revision=revision,
+                properties={'branch': "master", 'pr_number': pr,
+                'pr_head': head, 'pr_pushed': when}))
+
+    return changes
+
+#
+# Offline EC2 connection.  The EC2 latent slaves connect to EC2 when they're
+# created and look up their key pair, security group and image, the FreeBSD
+# images are resolved over HTTP first.  None of which is wanted, or possible
+# without credentials, when simulating.  Spot requests are fulfilled at once
+# with a running instance, which is enough for check_warm_pool() to start
+# and stop real slaves.
+#
+class SimEC2Image(object):
+    def __init__(self, ami):
+        self.id = ami
+        self.location = ami
+
+class SimEC2Output(object):
+    output = ""
+
+class SimEC2Instance(object):
+    def __init__(self, conn, instance_id, ami):
+        self.conn = conn
+        self.id = instance_id
+        self.image_id = ami
+        self.state = "running"
+        self.public_dns_name = instance_id + ".sim"
+
+    def update(self):
+        return self.state
+
+    def terminate(self):
+        self.state = "terminated"
+        self.conn.terminated.append(self.id)
+
+    def get_console_output(self):
+        return SimEC2Output()
+
+class SimEC2Reservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+class SimEC2SpotRequest(object):
+    class status(object):
+        code = "fulfilled"
+
+    def __init__(self, request_id, instance_id):
+        self.id = request_id
+        self.instance_id = instance_id
+
+class SimEC2Connection(object):
+    def __init__(self):
+        self.instances = {}
+        self.requests = {}
+        self.ready = []
+        self.terminated = []
+
+    def get_all_key_pairs(self, *args, **kwargs):
+        return [True]
+
+    def get_all_security_groups(self, *args, **kwargs):
+        return [True]
+
+    def get_all_addresses(self, addresses=None, *args, **kwargs):
+        return list(addresses or [])
+
+    def get_image(self, ami):
+        return SimEC2Image(ami)
+
+    def request_spot_instances(self, price, ami, **kwargs):
+        instance_id = "i-%08x" % (len(self.instances) + 1)
+        request_id = "sir-%08x" % (len(self.requests) + 1)
+        self.instances[instance_id] = SimEC2Instance(self, instance_id, ami)
+        self.requests[request_id] = SimEC2SpotRequest(request_id, instance_id)
+        return [self.requests[request_id]]
+
+    def get_all_spot_instance_requests(self, request_ids=(), **kwargs):
+        return [self.requests[request_id] for request_id in request_ids]
+
+    def get_all_instances(self, instance_ids=(), **kwargs):
+        return [SimEC2Reservation([self.instances[instance_id]
+            for instance_id in instance_ids])]
+
+    def get_instance_attribute(self, instance_id, attribute, **kwargs):
+        return {attribute: {}}
+
+    def modify_instance_attribute(self, *args, **kwargs):
+        return True
+
+    def create_tags(self, instance_id, tags, **kwargs):
+        # The last call made while starting an instance.
+        self.ready.append(instance_id)
+
+def offline_ec2():
+    """
+    Substitutes a SimEC2Connection for boto's, and a fixed AMI for the
+    AMIResolver lookups.  Returns the connection.
+    """
+    import boto
+    import boto.ec2
+    import buildslaves
+
+    conn = SimEC2Connection()
+    boto.connect_ec2 = lambda *args, **kwargs: conn
+    boto.ec2.connect_to_region = lambda *args, **kwargs: conn
+    buildslaves.AMIResolver.resolve = lambda self, region, abi, version: \
+        "ami-00000000"
+
+    return conn
+
+def load_config(path):
+    """
+    Executes master.cfg, returning its namespace.
+    """
+    basedir = os.path.dirname(os.path.abspath(path))
+    os.chdir(basedir)
+    sys.path.insert(0, basedir)
+    offline_ec2()
+
+    namespace = {'__file__': path, 'basedir': basedir}
+    execfile(os.path.basename(path), namespace)
+
+    return namespace
+
+#
+# Check of the WarmPoolPolicy with real slaves and the offline EC2
+# connection.  A pool of size slaves, with one more member, is activated:
+# exactly size instances must be started.  One build starts on a warm slave
+# after it waited 5 minutes, and once the policy is inactive every started
+# instance must be terminated.  Only the buildslave process connecting back
+# to the master is simulated, by completing the substantiation once the
+# instance is running.
+#
+class SimBotMaster(object):
+    def maybeStartBuildsForSlave(self, name):
+        pass
+
+class SimWarmSlaveBuilder(object):
+    builder_name = "warm pool check"
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout=30.0):
+    from twisted.internet import reactor, task
+
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for the slaves")
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+@defer.inlineCallbacks
+def check_warm_pool(size, boot_time=420.0):
+    conn = offline_ec2()
+    import buildslaves
+    from prometheus import registry
+
+    clock = SimClock(time.time())
+    buildslaves.time = clock
+
+    pool = buildslaves.WarmPoolPolicy("check", size=size, hours=(0, 24))
+    slaves = []
+    for i in range(size + 1):
+        slave = buildslaves.ZFSEC2TestSlave("warm-pool-check-%d" % i,
+            ami="ami-00000000", warm_pool=pool)
+        slave._poll_resolution = 0
+        slave.botmaster = SimBotMaster()
+        pool.members.append(slave)
+        slaves.append(slave)
+
+    yield pool.tick()
+    yield wait_for(lambda: len(conn.ready) >= size)
+    clock.now += boot_time
+    warm = [slave for slave in slaves if slave.instance is not None]
+    for slave in warm:
+        d, slave.substantiation_deferred = slave.substantiation_deferred, None
+        slave.substantiated = True
+        d.callback(True)
+
+    clock.now += 300
+    sb = SimWarmSlaveBuilder()
+    warm[0].buildStarted(sb)
+    clock.now += 3600
+    warm[0].buildFinished(sb)
+    clock.now += 600
+
+    pool.hours = None
+    yield pool.tick()
+    yield wait_for(lambda: len(conn.terminated) >= len(warm))
+    for slave in slaves:
+        slave._clearBuildWaitTimer()
+
+    rows = [
+        ("slaves in the pool", len(slaves)),
+        ("instances started", len(conn.instances)),
+        ("builds started warm", pool.hits),
+        ("time-to-first-step saved", "%.0fs" % pool.seconds_saved),
+        ("idle spot cost", "$%.2f" % pool.idle_cost),
+        ("instances terminated", len(conn.terminated)),
+    ]
+    for name, value in rows:
+        print("%-28s %s" % (name, value))
+    for line in registry.expose().splitlines():
+        if line.startswith("buildbot_warm_pool_"):
+            print(line)
+
+    if len(conn.instances) != size or pool.hits != 1 or \
+            sorted(conn.terminated) != sorted(conn.instances):
+        raise RuntimeError("the warm pool policy check failed")
+
+def stock_prioritize(master, builders):
+    """
+    The buildmaster's default builder order, by the oldest pending request.
+    """
+    return sorted(builders,
+        key=lambda b: min(request.submittedAt for request in b.pending))
+
+def parse_date(value):
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate the master's scheduling of a stream of changes.")
+    parser.add_argument("-c", "--config", default="master.cfg",
+        help="master configuration (default: %(default)s)")
+    parser.add_argument("--changes",
+        help="recorded changes, a state database (.sqlite) or JSON lines "
+        "(.jsonl, or .jsonl.gz as archived by dbmaint.py)")
+    parser.add_argument("--synthetic", action="store_true",
+        help="generate a synthetic change stream")
+    parser.add_argument("--start", default="2024-01-01",
+        help="first day simulated, YYYY-MM-DD UTC (default: %(default)s)")
+    parser.add_argument("--days", type=int, default=7,
+        help="days simulated (default: %(default)s)")
+    parser.add_argument("--prs", type=int, default=40,
+        help="synthetic pull requests (default: %(default)s)")
+    parser.add_argument("--pushes", type=int, default=4,
+        help="maximum synthetic pushes per pull request "
+        "(default: %(default)s)")
+    parser.add_argument("--merges", type=int, default=3,
+        help="synthetic merges to master per day (default: %(default)s)")
+    parser.add_argument("--boot-time", action="append", metavar="REGEX=SECS",
+        help="boot time of the matching slave classes or names")
+    parser.add_argument("--run-time", action="append", metavar="REGEX=MINS",
+        help="mean run time of the matching builders")
+    parser.add_argument("--price", action="append", metavar="REGEX=DOLLARS",
+        help="hourly price of the matching instance types, by default "
+        "the slave's max_spot_price")
+    parser.add_argument("--jitter", type=float, default=0.15,
+        help="log-normal sigma of the boot and run times "
+        "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed (default: %(default)s)")
+    parser.add_argument("--stock-priority", action="store_true",
+        help="order the builders by their oldest request, ignoring "
+        "c['prioritizeBuilders']")
+    parser.add_argument("--json", help="also write the report as JSON")
+    parser.add_argument("--warm-pool", type=int, metavar="SIZE",
+        help="only check a warm pool of SIZE slaves against the offline "
+        "EC2 connection")
+    args = parser.parse_args()
+
+    if args.warm_pool:
+        from twisted.internet import reactor
+
+        results = []
+        def check():
+            d = check_warm_pool(args.warm_pool)
+            d.addBoth(results.append)
+            d.addBoth(lambda _: reactor.stop())
+        reactor.callWhenRunning(check)
+        reactor.run()
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+        return
+
+    if not args.synthetic and not args.changes:
+        parser.error("one of --changes or --synthetic is required")
+
+    config = load_config(args.config)
+
+    # Builder priorities are computed using the simulated time.
+    clock = SimClock()
+    buildslaves = sys.modules.get('buildslaves')
+    if buildslaves is not None:
+        buildslaves.time = clock
+
+    start = parse_date(args.start)
+    end = start + args.days * 86400
+    rng = random.Random(args.seed)
+    if args.synthetic:
+        changes = synthetic_changes(config, start, args.days, args.prs,
+            args.pushes, args.merges, rng)
+    elif args.changes.endswith(".sqlite"):
+        changes = load_changes_db(args.changes, start, end)
+    else:
+        changes = load_changes_json(args.changes, start, end)
+
+    sim = Simulation(config, parse_overrides(args.boot_time),
+        parse_overrides(args.run_time), parse_overrides(args.price),
+        jitter=args.jitter, seed=args.seed, start=start)
+    sim.clock = clock
+    clock.now = start
+    if args.stock_priority:
+        sim.prioritize = stock_prioritize
+
+    cpu = time.clock()
+    sim.run(changes, start, end)
+    cpu = time.clock() - cpu
+
+    report = sim.report(start)
+    report['changes'] = len(changes)
+    report['cpu_seconds'] = round(cpu, 2)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
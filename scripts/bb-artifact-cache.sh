@@ -0,0 +1,89 @@
+#!/bin/sh
+#
+# Look up the packages for this build in the master's artifact cache.
+#
+# The cache key is a hash of everything which determines the packages: the
+# source revision, platform, kernel, install method and configure options.
+# On a hit the cached packages are extracted in to the current directory and
+# bb-build.sh installs them rather than building.  On a miss bb-build.sh
+# stores the packages it builds in ARTIFACT_CACHE_DIR for upload.
+#
+# The result is written to stdout for the master as:
+#
+#   artifact_cache=<hit|miss|disabled>
+#   artifact_key=<key>
+#
+
+if test -f /etc/buildslave; then
+	. /etc/buildslave
+fi
+
+ARTIFACT_CACHE_URL=${ARTIFACT_CACHE_URL:-""}
+ARTIFACT_CACHE_DIR=${ARTIFACT_CACHE_DIR:-"/var/tmp/artifact-cache"}
+CONFIG_OPTIONS=${CONFIG_OPTIONS:-""}
+INSTALL_METHOD=${INSTALL_METHOD:-"none"}
+MAKE_TARGETS_KMOD=${MAKE_TARGETS_KMOD:-"pkg-kmod pkg-utils"}
+MAKE_TARGETS_DKMS=${MAKE_TARGETS_DKMS:-"pkg-dkms pkg-utils"}
+
+disabled() {
+	echo "Artifact cache disabled: $1" >&2
+	echo "artifact_cache=disabled"
+	exit 0
+}
+
+# Only packages can be reused, and not when built against a custom kernel.
+case "$INSTALL_METHOD" in
+packages|kmod|pkg-kmod|dkms|dkms-kmod)
+	;;
+*)
+	disabled "install method $INSTALL_METHOD"
+	;;
+esac
+
+if [ "$LINUX_CUSTOM" = "yes" ]; then
+	disabled "custom kernel"
+fi
+
+if [ -z "$ARTIFACT_CACHE_URL" ]; then
+	disabled "no ARTIFACT_CACHE_URL"
+fi
+
+REVISION=$(git rev-parse HEAD 2>/dev/null)
+if [ -z "$REVISION" ] || [ -n "$(git status --porcelain 2>/dev/null)" ]; then
+	disabled "unknown or modified source tree"
+fi
+
+PLATFORM="$(echo $BB_NAME | cut -f1-3 -d'-')"
+KEY_INPUTS="revision=$REVISION
+platform=$PLATFORM
+kernel=$(uname -r)
+machine=$(uname -m)
+install=$INSTALL_METHOD
+config=$CONFIG_OPTIONS
+kmod=$MAKE_TARGETS_KMOD
+dkms=$MAKE_TARGETS_DKMS"
+
+if command -v sha256sum >/dev/null 2>&1; then
+	KEY=$(echo "$KEY_INPUTS" | sha256sum | cut -c1-40)
+else
+	KEY=$(echo "$KEY_INPUTS" | sha256 -q | cut -c1-40)
+fi
+
+echo "$KEY_INPUTS" >&2
+echo "artifact_key=$KEY"
+
+mkdir -p "$ARTIFACT_CACHE_DIR"
+ARCHIVE="$ARTIFACT_CACHE_DIR/$KEY.tar"
+rm -f "$ARCHIVE"
+
+if wget -q --tries=3 -O "$ARCHIVE" "$ARTIFACT_CACHE_URL$KEY.tar" && \
+    tar -tf "$ARCHIVE" >/dev/null 2>&1 && tar -xf "$ARCHIVE"; then
+	rm -f "$ARCHIVE"
+	echo "Artifact cache hit: $(ls *.rpm *.deb 2>/dev/null | wc -l) packages" >&2
+	echo "artifact_cache=hit"
+else
+	rm -f "$ARCHIVE"
+	echo "artifact_cache=miss"
+fi
+
+exit 0
@@ -0,0 +1,59 @@
+#!/bin/sh
+#
+# Prepare the artifacts in UPLOAD_DIR for upload to the master's artifact
+# store, see ArtifactStore in master/artifacts.py.
+#
+#   manifest - write the SHA-256, size, and path of every file to
+#              $UPLOAD_DIR/.manifest for the master.
+#   prune    - remove the files listed by the master in $UPLOAD_DIR/.present,
+#              which it already has, so they aren't uploaded again.
+#
+
+if test -f /etc/buildslave; then
+	. /etc/buildslave
+fi
+
+UPLOAD_DIR=${UPLOAD_DIR:-""}
+MANIFEST=".manifest"
+PRESENT=".present"
+
+if [ -z "$UPLOAD_DIR" ]; then
+	echo "Missing UPLOAD_DIR"
+	exit 1
+fi
+
+mkdir -p "$UPLOAD_DIR"
+cd "$UPLOAD_DIR" || exit 1
+
+if command -v sha256sum >/dev/null 2>&1; then
+	SHA256="sha256sum"
+else
+	SHA256="sha256 -r"
+fi
+
+case "$1" in
+manifest)
+	find . -type f ! -name "$MANIFEST" ! -name "$PRESENT" | \
+	    sed 's#^\./##' | while IFS= read -r file; do
+		digest=$($SHA256 "$file" | cut -f1 -d' ')
+		size=$(wc -c < "$file" | tr -d ' ')
+		echo "$digest $size $file"
+	done > "$MANIFEST"
+	echo "$(wc -l < "$MANIFEST" | tr -d ' ') files, $(du -sk . | cut -f1)K"
+	;;
+prune)
+	if [ -f "$PRESENT" ]; then
+		while IFS= read -r file; do
+			rm -f "./$file"
+		done < "$PRESENT"
+		echo "$(wc -l < "$PRESENT" | tr -d ' ') files already stored"
+	fi
+	rm -f "$MANIFEST" "$PRESENT"
+	;;
+*)
+	echo "Usage: $0 <manifest|prune>"
+	exit 1
+	;;
+esac
+
+exit 0
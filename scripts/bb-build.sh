@@ -30,6 +30,9 @@ MAKE_OPTIONS=${MAKE_OPTIONS:-"-j$NCPU"}
 MAKE_TARGETS_KMOD=${MAKE_TARGETS_KMOD:-"pkg-kmod pkg-utils"}
 MAKE_TARGETS_DKMS=${MAKE_TARGETS_DKMS:-"pkg-dkms pkg-utils"}
 INSTALL_METHOD=${INSTALL_METHOD:-"none"}
+ARTIFACT_CACHE=${ARTIFACT_CACHE:-""}
+ARTIFACT_CACHE_DIR=${ARTIFACT_CACHE_DIR:-"/var/tmp/artifact-cache"}
+ARTIFACT_KEY=${ARTIFACT_KEY:-""}
 
 CONFIG_LOG="configure.log"
 MAKE_LOG="make.log"
@@ -44,23 +47,37 @@ fi
 
 set -x
 
-./autogen.sh >>$CONFIG_LOG 2>&1 || exit 1
+# The packages were extracted from the artifact cache by bb-artifact-cache.sh.
+if [ "$ARTIFACT_CACHE" = "hit" ]; then
+	echo "Using cached packages $ARTIFACT_KEY" >>$MAKE_LOG
+else
+	./autogen.sh >>$CONFIG_LOG 2>&1 || exit 1
+fi
 
 case "$INSTALL_METHOD" in
 packages|kmod|pkg-kmod|dkms|dkms-kmod)
 
-	./configure $CONFIG_OPTIONS $LINUX_OPTIONS >>$CONFIG_LOG 2>&1 || exit 1
+	if [ "$ARTIFACT_CACHE" != "hit" ]; then
+		./configure $CONFIG_OPTIONS $LINUX_OPTIONS >>$CONFIG_LOG 2>&1 || exit 1
 
-	case "$INSTALL_METHOD" in
-	packages|kmod|pkg-kmod)
-		$MAKE $MAKE_TARGETS_KMOD >>$MAKE_LOG 2>&1 || exit 1
-		;;
-	dkms|pkg-dkms)
-		$MAKE $MAKE_TARGETS_DKMS >>$MAKE_LOG 2>&1 || exit 1
-		;;
-	esac
+		case "$INSTALL_METHOD" in
+		packages|kmod|pkg-kmod)
+			$MAKE $MAKE_TARGETS_KMOD >>$MAKE_LOG 2>&1 || exit 1
+			;;
+		dkms|pkg-dkms)
+			$MAKE $MAKE_TARGETS_DKMS >>$MAKE_LOG 2>&1 || exit 1
+			;;
+		esac
+
+		sudo -E rm *.src.rpm
 
-	sudo -E rm *.src.rpm
+		# Store the packages for upload to the artifact cache.
+		if [ "$ARTIFACT_CACHE" = "miss" ] && [ -n "$ARTIFACT_KEY" ]; then
+			mkdir -p "$ARTIFACT_CACHE_DIR"
+			tar -cf "$ARTIFACT_CACHE_DIR/$ARTIFACT_KEY.tar" \
+			    $(ls *.rpm *.deb 2>/dev/null)
+		fi
+	fi
 
 	# Preserve TEST and PERF packages which may be needed to investigate
 	# test failures.  BUILD packages are discarded.
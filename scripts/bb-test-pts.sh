@@ -27,6 +27,7 @@ cleanup()
 {
 	# Preserve the results directory for future analysis, as:
 	# <zfs-version>/<builder>/pts/pts-<date>.tar.xz
+	# <zfs-version>/<builder>/pts/pts-<date>.xml
 	if test -n "$UPLOAD_DIR"; then
 		BUILDER="$(echo $BB_NAME | cut -f1-3 -d'-')"
 		mkdir -p "$UPLOAD_DIR/$BUILDER/pts"
@@ -34,6 +35,14 @@ cleanup()
 		tar -C "$RESULTS_DIR" -cJ \
 	            -f "$UPLOAD_DIR/$BUILDER/pts/${TEST_RESULTS_NAME}.tar.xz" \
 		    "$TEST_RESULTS_NAME"
+
+		# The results are also uploaded uncompressed for the master's
+		# performance regression check, see perf.py.
+		COMPOSITE="$RESULTS_DIR/$TEST_RESULTS_NAME/composite.xml"
+		if test -f "$COMPOSITE"; then
+			cp "$COMPOSITE" \
+			    "$UPLOAD_DIR/$BUILDER/pts/${TEST_RESULTS_NAME}.xml"
+		fi
 	fi
 
 	sudo modprobe -r brd
@@ -36,6 +36,9 @@ cleanup()
             echo "" >> $SUMMARY_LOG
             awk '/\[FAIL\]|\[KILLED\]/{ show=1; print; next; }
                 /\[SKIP\]|\[PASS\]/{ show=0; } show' $FULL_LOG >> $SUMMARY_LOG
+            if [ -n "$TEST_ZFSTESTS_SHARD" ]; then
+                cat "$PWD/$SHARD_NAME.plan" >> $SUMMARY_LOG
+            fi
 
             # Preserve the results directory for future analysis, as:
             # <zfs-version>/<builder>/zts/zts-<runfile>-<date>.tar.xz
@@ -44,7 +47,7 @@ cleanup()
                 mkdir -p "$UPLOAD_DIR/$BUILDER/zts"
 
                 RESULTS_DATE=$(basename $RESULTS_DIR)
-                RESULTS_NAME="zts-$TEST_ZFSTESTS_RUNFILE-$RESULTS_DATE"
+                RESULTS_NAME="zts-$(basename "$TEST_ZFSTESTS_RUNFILE" .run)-$RESULTS_DATE"
                 RESULTS_DIRNAME=$(dirname $RESULTS_DIR)
 
                 # Rename the results to include the run file name and date.
@@ -74,6 +77,9 @@ DEFAULT_ZFSTESTS_RUNFILE=${DEFAULT_ZFSTESTS_RUNFILE:-""}
 DEFAULT_ZFSTESTS_DISKS=${DEFAULT_ZFSTESTS_DISKS:-""}
 DEFAULT_ZFSTESTS_DISKSIZE=${DEFAULT_ZFSTESTS_DISKSIZE:-""}
 DEFAULT_ZFSTESTS_TAGS=${DEFAULT_ZFSTESTS_TAGS:-"functional"}
+DEFAULT_ZFSTESTS_SHARD=${DEFAULT_ZFSTESTS_SHARD:-""}
+DEFAULT_ZFSTESTS_SHARD_SCRIPT=${DEFAULT_ZFSTESTS_SHARD_SCRIPT:-""}
+DEFAULT_ZFSTESTS_DURATIONS=${DEFAULT_ZFSTESTS_DURATIONS:-""}
 DEFAULT_ZFSTESTS_PERF_RUNTIME=${DEFAULT_ZFSTESTS_PERF_RUNTIME:-180}
 DEFAULT_ZFSTESTS_PERF_FS_OPTS=${DEFAULT_ZFSTESTS_PERF_FS_OPTS:-"-o recsize=1M -o compress=lz4"}
 
@@ -84,6 +90,9 @@ TEST_ZFSTESTS_ITERS=${TEST_ZFSTESTS_ITERS:-"1"}
 TEST_ZFSTESTS_OPTIONS=${TEST_ZFSTESTS_OPTIONS:-"-vxR"}
 TEST_ZFSTESTS_RUNFILE=${TEST_ZFSTESTS_RUNFILE:-"$DEFAULT_ZFSTESTS_RUNFILE"}
 TEST_ZFSTESTS_TAGS=${TEST_ZFSTESTS_TAGS:-"$DEFAULT_ZFSTESTS_TAGS"}
+TEST_ZFSTESTS_SHARD=${TEST_ZFSTESTS_SHARD:-"$DEFAULT_ZFSTESTS_SHARD"}
+TEST_ZFSTESTS_SHARD_SCRIPT=${TEST_ZFSTESTS_SHARD_SCRIPT:-"$DEFAULT_ZFSTESTS_SHARD_SCRIPT"}
+TEST_ZFSTESTS_DURATIONS=${TEST_ZFSTESTS_DURATIONS:-"$DEFAULT_ZFSTESTS_DURATIONS"}
 TEST_ZFSTESTS_PROFILE=${TEST_ZFSTESTS_PROFILE:-"No"}
 
 # Environment variables which control the performance test suite.
@@ -92,6 +101,56 @@ PERF_FS_OPTS=${TEST_ZFSTESTS_PERF_FS_OPTS:-"$DEFAULT_ZFSTESTS_PERF_FS_OPTS"}
 
 set +x
 
+RUNFILE_DIR=""
+for dir in "${ZFS_BUILD_DIR:-.}/tests/runfiles" /usr/share/zfs/runfiles; do
+    if [ -d "$dir" ]; then
+        RUNFILE_DIR="$dir"
+        break
+    fi
+done
+
+# The tags may be narrowed to the test areas modified by the change.  Run
+# the full functional tests rather than nothing if a tag isn't used by any
+# of the runfiles.
+if [ -n "$RUNFILE_DIR" ]; then
+    for tag in $(echo "$TEST_ZFSTESTS_TAGS" | tr ',' ' '); do
+        if ! cat "$RUNFILE_DIR"/*.run | grep -q "'$tag'"; then
+            echo "Unknown test tag '$tag', running all functional tests"
+            TEST_ZFSTESTS_TAGS="functional"
+            break
+        fi
+    done
+fi
+
+# When sharded only run this shard's part of the runfiles, as <n>/<count>.
+# The test groups are balanced between the shards by zts_shard.py using the
+# historic durations.  The results are combined by the master.
+if [ -n "$TEST_ZFSTESTS_SHARD" ]; then
+    SHARD_NAME="shard-$(echo $TEST_ZFSTESTS_SHARD | tr '/' '-')"
+    SHARD_RUNFILES=""
+    case $(uname) in
+    FreeBSD) SHARD_PLATFORM="freebsd.run" ;;
+    *)       SHARD_PLATFORM="linux.run" ;;
+    esac
+    for runfile in $(echo "${TEST_ZFSTESTS_RUNFILE:-common.run,$SHARD_PLATFORM}" | tr ',' ' '); do
+        if [ -f "$runfile" ]; then
+            SHARD_RUNFILES="$SHARD_RUNFILES $runfile"
+        else
+            SHARD_RUNFILES="$SHARD_RUNFILES $RUNFILE_DIR/$runfile"
+        fi
+    done
+
+    if ! runurl "$TEST_ZFSTESTS_SHARD_SCRIPT" -s "$TEST_ZFSTESTS_SHARD" \
+        -d "$TEST_ZFSTESTS_DURATIONS" -T "$TEST_ZFSTESTS_TAGS" \
+        $SHARD_RUNFILES >"$PWD/$SHARD_NAME.run" 2>"$PWD/$SHARD_NAME.plan"; then
+        cat "$PWD/$SHARD_NAME.plan"
+        echo "Unable to create the runfile for $TEST_ZFSTESTS_SHARD"
+        exit 1
+    fi
+    cat "$PWD/$SHARD_NAME.plan"
+    TEST_ZFSTESTS_RUNFILE="$PWD/$SHARD_NAME.run"
+fi
+
 case $(uname) in
 FreeBSD)
 	if ! kldstat -qn openzfs; then
@@ -6,9 +6,13 @@
 # of any observed failures.
 #
 
+SCRIPTDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
 OPENZFS_DIR="/home/buildbot/zfs-buildbot/master/*_TEST_"
+OPENZFS_INDEX="/home/buildbot/zfs-buildbot/master/known-issues.json.gz"
 OPENZFS_MTIME=30
-OPENZFS_MMIN=$((OPENZFS_MTIME*24*60))
+OPENZFS_KEEP=365
+OPENZFS_DURATIONS=""
 OPENZFS_PRS_INCLUDE="no"
 OPENZFS_ISSUES=$(curl -s https://api.github.com/search/issues?q=repo:openzfs/zfs+label:%22Test%20Suite%22)
 
@@ -37,7 +41,8 @@ STATUS_PR_TEXT=""
 usage() {
 cat << EOF
 USAGE:
-$0 [-h] [-d directory] [-e exceptions] [-m mtime]
+$0 [-h] [-d directory] [-e exceptions] [-i index] [-k keep] [-m mtime]
+    [-t durations]
 
 DESCRIPTION:
 	Dynamically generate HTML for the Known Issue Tracking page
@@ -48,18 +53,22 @@ OPTIONS:
 	-h		Show this message
 	-d directory	Directory containing the buildbot logs
 	-e exceptions	Exception file (using ZoL wiki if not specified)
+	-i index	Index of previously parsed test logs (zts_index.py)
+	-k keep		Keep N days of results in the index for trends
 	-m mtime	Include test logs from the last N days
 	-p		Include PR failures in report
+	-t durations	Write the test group durations for zts_shard.py
 
 EXAMPLE:
 
 $0 -d ~/zfs-buildbot/master/*_TEST_ -m 30 \\
+    -t ~/zfs-buildbot/master/public_html/zts-durations.json \\
     >~/zfs-buildbot/master/public_html/known-issues.html
 
 EOF
 }
 
-while getopts 'hd:e:m:p' OPTION; do
+while getopts 'hd:e:i:k:m:pt:' OPTION; do
 	case $OPTION in
 	h)
 		usage
@@ -71,9 +80,17 @@ while getopts 'hd:e:m:p' OPTION; do
 	e)
 		OPENZFS_EXCEPTIONS=$OPTARG
 		;;
+	i)
+		OPENZFS_INDEX=$OPTARG
+		;;
+	k)
+		OPENZFS_KEEP=$OPTARG
+		;;
+	t)
+		OPENZFS_DURATIONS=$OPTARG
+		;;
 	m)
 		OPENZFS_MTIME=$OPTARG
-		OPENZFS_MMIN=$((OPENZFS_MTIME*24*60))
 		;;
 	p)
 		OPENZFS_PRS_INCLUDE="yes"
@@ -104,7 +121,8 @@ cat << EOF
 	\$.fn.dataTable.enum( [ 'high', 'medium', 'low', '' ] );
 	\$('#maintable').DataTable( {
 		"columnDefs": [
-			{ "visible": false, "targets": 7 }
+			{ "visible": false, "targets": 7 },
+			{ "orderable": false, "targets": 10 }
 		],
 		"searching": true,
 		"order": [[ 7, 'asc' ]],
@@ -117,7 +135,7 @@ cat << EOF
 			api.column(7, {page:'current'} ).data().each( function ( group, i ) {
 				if ( last !== group ) {
 					\$(rows).eq( i ).before(
-					'<tr class="group"><td colspan="8">'+group+'</td></tr>'
+					'<tr class="group"><td colspan="10">'+group+'</td></tr>'
 					);
  
 				last = group;
@@ -211,95 +229,13 @@ issues observed during automated buildbot testing over the last
   <th>State</th>
   <th>Origin</th>
   <th>Severity</th>
+  <th>Trend</th>
+  <th>Flaky Since</th>
 </tr>
 </thead>
 <tbody>
 EOF
 
-# Unfortunately there's not enough information in the buildbot logs to
-# dynamically generate the encoded version of the builder name.
-# Therefore we're forced to implement this simple lookup function.
-function build_url()
-{
-	local name=$1
-	local nr=$2
-	local url="https://build.openzfs.org/builders"
-
-	case "$name" in
-	CentOS_7_x86_64__TEST_)
-		encoded_name="CentOS%207%20x86_64%20%28TEST%29"
-		;;
-	CentOS_8_x86_64__TEST_)
-		encoded_name="CentOS%208%20x86_64%20%28TEST%29"
-		;;
-	CentOS_Stream_8_x86_64__TEST_)
-		encoded_name="CentOS%20Stream%208%20x86_64%20%28TEST%29"
-		;;
-	CentOS_9_x86_64__TEST_)
-		encoded_name="CentOS%209%20x86_64%20%28TEST%29"
-		;;
-	Debian_10_x86_64__TEST_)
-		encoded_name="Debian%2010%20x86_64%20%28TEST%29"
-		;;
-	Fedora_37_x86_64__TEST_)
-		encoded_name="Fedora%2037%20x86_64%20%28TEST%29"
-		;;
-	Fedora_38_x86_64__TEST_)
-		encoded_name="Fedora%2038%20x86_64%20%28TEST%29"
-		;;
-	Fedora_39_x86_64__TEST_)
-		encoded_name="Fedora%2039%20x86_64%20%28TEST%29"
-		;;
-	FreeBSD_stable_12_amd64__TEST_)
-		encoded_name="FreeBSD%20stable%2F12%20amd64%20%28TEST%29"
-		;;
-	FreeBSD_stable_13_amd64__TEST_)
-		encoded_name="FreeBSD%20stable%2F13%20amd64%20%28TEST%29"
-		;;
-	FreeBSD_stable_14_amd64__TEST_)
-		encoded_name="FreeBSD%20stable%2F14%20amd64%20%28TEST%29"
-		;;
-	*)
-		encoded_named="unknown"
-		;;
-	esac
-
-	echo "<a href='$url/$encoded_name/builds/$nr'>$nr</a>"
-}
-export -f build_url
-
-check() {
-	local git_log="$1-log-git_zfs-stdio"
-	local test_log="$1-log-shell_4-tests.bz2"
-	local mode="$2"
-
-	# Ignore incomplete builds
-	[[ ! -e "$git_log" ]] && return 1
-	[[ ! -e "$test_log" ]] && return 1
-
-	nr=$(basename "$1" | cut -f1 -d' ')
-	name=$(basename "$(dirname "$1")")
-	test_url=$(build_url $name $nr)
-
-	# Ignore the coverage builder
-	[[ "$name" = "Ubuntu_18_04_x86_64_Coverage__TEST_" ]] && return 1
-
-	# Annotate pull requests vs branch commits
-	if grep -q "refs/pull" "$git_log"; then
-		origin=$(grep -m1 "git fetch" "$git_log" | \
-		    cut -f5 -d' ' | cut -d '/' -f3)
-	else
-		origin=$(grep -m1 "git clone --branch" "$git_log" | \
-		    cut -f4 -d' ')
-	fi
-
-	# Strip and print the failed test cases
-	bzgrep -e '\['"$mode"'\]' "$test_log" | \
-	    awk -F"zfs-tests/" '{print $2}' | cut -d' ' -f1 | \
-	    awk -v prefix="$test_url $origin " '{ print prefix $0; }'
-}
-export -f check
-
 # Get all exceptions and comments
 if [ -z ${OPENZFS_EXCEPTIONS+x} ]; then
 	OPENZFS_EXCEPTIONS=$(curl -s https://raw.githubusercontent.com/wiki/openzfs/zfs/ZTS-exceptions.md | awk '/---|---|---/{y=1;next}y')
@@ -307,42 +243,39 @@ else
 	OPENZFS_EXCEPTIONS=$(cat "$OPENZFS_EXCEPTIONS" | awk '/---|---|---/{y=1;next}y')
 fi
 
-# List of all tests which have passed
-OPENZFS_PASSES=$(find $OPENZFS_DIR -type f -mmin -$OPENZFS_MMIN \
-    -regex ".*/[0-9]*" -exec bash -c 'check "$0" "PASS"' {} \; | \
-    cut -f3- -d' ' | sort | uniq -c | sort -nr)
-
-# List of all tests which have failed
-OPENZFS_FAILURES=$(find $OPENZFS_DIR -type f -mmin -$OPENZFS_MMIN \
-    -regex ".*/[0-9]*" -exec bash -c 'check "$0" "FAIL"' {} \;)
-
-echo "$OPENZFS_FAILURES" | cut -f3- -d' ' | sort | uniq -c | sort -nr | \
-while read LINE1; do
+# Only the test logs for builds which completed since the last run are
+# parsed, the pass and fail counts for every test are generated from the
+# index.  Each line contains: fail, pass, origin, test name, failed builds,
+# the 95% confidence interval of the failure rate, the trend over the last
+# week, and the date and commit since which the test has been flaky.
+python3 "$SCRIPTDIR/zts_index.py" -i "$OPENZFS_INDEX" -m "$OPENZFS_MTIME" \
+    -k "$OPENZFS_KEEP" ${OPENZFS_DURATIONS:+-d "$OPENZFS_DURATIONS"} \
+    -r $OPENZFS_DIR | \
+while IFS=$'\t' read -r OPENZFS_FAIL OPENZFS_PASS OPENZFS_ORIGIN \
+    OPENZFS_NAME OPENZFS_BUILDS OPENZFS_CI_LOW OPENZFS_CI_HIGH \
+    OPENZFS_TREND OPENZFS_FLAKY_DATE OPENZFS_FLAKY_COMMIT; do
 	OPENZFS_ISSUE=""
-	OPENZFS_NAME=$(echo $LINE1 | cut -f3 -d' ')
-	OPENZFS_ORIGIN=$(echo $LINE1 | cut -f2 -d' ')
-	OPENZFS_FAIL=$(echo $LINE1 | cut -f1 -d' ')
 	OPENZFS_STATE=""
 	OPENZFS_STATUS=""
 
-	# Create links buildbot logs for all failed tests.
-	OPENZFS_BUILDS=$(echo "$OPENZFS_FAILURES" | \
-	    grep "$OPENZFS_ORIGIN $OPENZFS_NAME" | cut -f1-2 -d' ')
-
-	OPENZFS_PASS=$(echo "$OPENZFS_PASSES" | \
-	    grep "$OPENZFS_ORIGIN $OPENZFS_NAME" | \
-	    awk '{$1=$1;print}' | cut -f1 -d' ')
-
 	[[ "$OPENZFS_FAIL" =~ $NUMBER_REGEX ]] || OPENZFS_FAIL=0
-	[[ "$OPENZFS_PASS" =~ $NUMBER_REGEX ]] || OPENZFS_PASS=1
+	[[ "$OPENZFS_PASS" =~ $NUMBER_REGEX ]] || OPENZFS_PASS=0
 
-	OPENZFS_RATE=$(bc <<< "scale=2; ((100*$OPENZFS_FAIL) / \
-	    ($OPENZFS_PASS + $OPENZFS_FAIL))" | \
-	    awk '{printf "%.2f", $0}')
+	OPENZFS_RATE=$(awk -v f="$OPENZFS_FAIL" -v p="$OPENZFS_PASS" \
+	    'BEGIN { printf "%.2f", (100 * f) / (p + f) }')
 
-	# Ignore test results with few samples.
-	if [ "$OPENZFS_PASS" -lt 10 ]; then
-		continue
+	# Tests with few samples are reported with a wide confidence interval
+	# rather than being ignored.
+	OPENZFS_CI="$OPENZFS_CI_LOW-$OPENZFS_CI_HIGH%"
+
+	[[ "$OPENZFS_TREND" = "-" ]] && OPENZFS_TREND=""
+	if [[ "$OPENZFS_FLAKY_DATE" = "-" ]]; then
+		OPENZFS_FLAKY=""
+	elif [[ "$OPENZFS_FLAKY_COMMIT" = "-" ]]; then
+		OPENZFS_FLAKY="$OPENZFS_FLAKY_DATE"
+	else
+		commit="https://github.com/openzfs/zfs/commit/$OPENZFS_FLAKY_COMMIT"
+		OPENZFS_FLAKY="$OPENZFS_FLAKY_DATE <a href='$commit'>${OPENZFS_FLAKY_COMMIT:0:8}</a>"
 	fi
 
 	# Test failure was from an open pull request or branch.
@@ -426,7 +359,7 @@ while read LINE1; do
 	cat << EOF
 <tr class='$OPENZFS_STATUS'>
   <td>$OPENZFS_ISSUE</td>
-  <td>$OPENZFS_RATE%</td>
+  <td>$OPENZFS_RATE% <small>($OPENZFS_CI)</small></td>
   <td>$OPENZFS_PASS</td>
   <td>$OPENZFS_FAIL</td>
   <td class='td_faillist'>$OPENZFS_BUILDS</td>
@@ -434,6 +367,8 @@ while read LINE1; do
   <td>$OPENZFS_STATE</td>
   <td>$OPENZFS_ORIGIN</td>
   <td>$OPENZFS_STATUS_TEXT</td>
+  <td>$OPENZFS_TREND</td>
+  <td>$OPENZFS_FLAKY</td>
 </tr>
 EOF
 
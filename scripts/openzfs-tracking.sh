@@ -23,6 +23,8 @@
 # - 		isn't applicable to Linux
 # <commit>	ZoL commit
 #
+SCRIPTDIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+
 ZFSONLINUX_BRANCH="zfsonlinux/master"
 ZFSONLINUX_GIT="https://github.com/zfsonlinux/zfs/commit"
 ZFSONLINUX_DIR="."
@@ -71,7 +73,7 @@ STATUS_PENDING_TEXT="Pending"
 usage() {
 cat << EOF
 USAGE:
-$0 [-h] [-d directory] [-e exceptions]
+$0 [-h] [-d directory] [-e exceptions] [-i index]
 
 DESCRIPTION:
 	Dynamically generate HTML for the OpenZFS Commit Tracking page
@@ -84,6 +86,8 @@ OPTIONS:
 	-e exceptions	Exception file (using ZoL wiki if not specified)
 	-c file.txt	Write OpenZFS unmerged commits' hashes to file,
 	if specified (for openzfs-merge.sh)
+	-i index	Index of the ported OpenZFS issues (openzfs_index.py),
+	defaults to openzfs-tracking.json in the git directory
 
 EXAMPLE:
 
@@ -93,7 +97,7 @@ $0 -d ~/openzfs-tracking/zfs \\
 EOF
 }
 
-while getopts 'hd:c:e:' OPTION; do
+while getopts 'hd:c:e:i:' OPTION; do
 	case $OPTION in
 	h)
 		usage
@@ -108,6 +112,9 @@ while getopts 'hd:c:e:' OPTION; do
 	e)
 		ZFSONLINUX_EXCEPTIONS=$OPTARG
 		;;
+	i)
+		ZFSONLINUX_INDEX=$OPTARG
+		;;
 	esac
 done
 
@@ -232,6 +239,26 @@ else
 	ZFSONLINUX_EXCEPTIONS=$(cat "$ZFSONLINUX_EXCEPTIONS" | awk '/---|---|---/{y=1;next}y')
 fi
 git fetch --all >/dev/null
+
+# Map the OpenZFS issue numbers to the ZFS on Linux commits and open pull
+# requests which reference them.  The branch log is read once, and only
+# from the last indexed commit when the index already exists.
+if [ -z "$ZFSONLINUX_INDEX" ]; then
+	ZFSONLINUX_INDEX="$(git rev-parse --git-dir)/openzfs-tracking.json"
+fi
+declare -A ZFSONLINUX_COMMITS ZFSONLINUX_PULLS
+while IFS=$'\t' read -r TYPE ISSUE VALUE; do
+	case $TYPE in
+	commit)
+		ZFSONLINUX_COMMITS[$ISSUE]=$VALUE
+		;;
+	pull)
+		ZFSONLINUX_PULLS[$ISSUE]=$VALUE
+		;;
+	esac
+done < <(echo "$ZFSONLINUX_PRS" | python3 "$SCRIPTDIR/openzfs_index.py" \
+    -i "$ZFSONLINUX_INDEX" -b "$ZFSONLINUX_BRANCH" -p -)
+
 git log $OPENZFS_HASH_START..$OPENZFS_HASH_END --oneline $OPENZFS_BRANCH \
     -- $OPENZFS_PATHS | while read LINE1;
 do
@@ -247,11 +274,7 @@ do
 	fi
 
 	# Match issue against any open pull requests.
-	ZFSONLINUX_PR=$(echo $ZFSONLINUX_PRS | jq -r ".[] | select(.title | \
-	    contains(\"OpenZFS $OPENZFS_ISSUE \")) | { html_url: .html_url }" | \
-	    grep html_url | cut -f2- -d':' | tr -d ' "')
-	ZFSONLINUX_REGEX="^(openzfs|illumos)+.*[ #]+$OPENZFS_ISSUE([^0-9]|$)[ ,]+*.*"
-
+	ZFSONLINUX_PR=${ZFSONLINUX_PULLS[$OPENZFS_ISSUE]}
 
 	# Commit exceptions reference this Linux commit for an OpenZFS issue.
 	EXCEPTION=$(echo "$ZFSONLINUX_EXCEPTIONS" | grep -E "^$OPENZFS_ISSUE[^0-9]")
@@ -285,11 +308,7 @@ do
 			ZFSONLINUX_STATUS=$STATUS_PR
 			ZFSONLINUX_STATUS_TEXT=$STATUS_PR_TEXT
 	else
-		LINE2=$(git log --regexp-ignore-case --extended-regexp \
-		    --no-merges --oneline \
-		    --grep="$ZFSONLINUX_REGEX" $ZFSONLINUX_BRANCH)
-
-		MATCH=$(echo $LINE2 | cut -f1 -d' ')
+		MATCH=${ZFSONLINUX_COMMITS[$OPENZFS_ISSUE]}
 		if [ -n "$MATCH" ]; then
 			ZFSONLINUX_HASH="<a href='$ZFSONLINUX_GIT/$MATCH'>$MATCH</a>"
 			ZFSONLINUX_STATUS=$STATUS_APPLIED
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Maintain an index of the OpenZFS issues which have been ported to a
+# ZFS on Linux branch, for use by openzfs-tracking.sh.
+#
+# A ported commit mentions the OpenZFS (or illumos) issue number on a line
+# of its commit message starting with "OpenZFS" or "illumos", e.g.
+# "OpenZFS 8585 - improve batching done in zil_commit()".  Rather than
+# searching the branch history once for every OpenZFS commit, the branch log
+# is read once and every issue number found is mapped to the most recent
+# commit which mentions it.  The index is cached and later runs only read
+# the commits added to the branch since the last run.  If the previously
+# indexed commit is no longer part of the branch (e.g. it was rebased) the
+# index is rebuilt.
+#
+# The open pull requests are indexed the same way from their titles, e.g.
+# "OpenZFS 8585 - improve batching", using the GitHub API JSON.
+#
+# The output is tab separated, one line per issue:
+#
+#   commit <issue> <hash>
+#   pull <issue> <url>
+#
+# The index is stored as JSON:
+#
+#   { "branch": "<branch>", "head": "<sha>", "commits": { "<issue>": "<hash>" } }
+#
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+# Equivalent to the "git log --grep" expression previously used per issue:
+#   ^(openzfs|illumos)+.*[ #]+<issue>([^0-9]|$)
+LINE_PATTERN = re.compile(r'^(openzfs|illumos)', re.I)
+ISSUE_PATTERN = re.compile(r'[ #]([0-9]+)(?![0-9])')
+TITLE_PATTERN = re.compile(r'OpenZFS ([0-9]+) ')
+
+# Commits are separated by NUL, the abbreviated hash is separated from the
+# commit message by a newline.
+LOG_FORMAT = "--format=%h%n%B%x00"
+
+
+def git(*args):
+    return subprocess.run(("git",) + args, check=True,
+                          stdout=subprocess.PIPE).stdout.decode("utf-8",
+                                                                "replace")
+
+
+def is_ancestor(commit, branch):
+    return subprocess.run(("git", "merge-base", "--is-ancestor", commit,
+                           branch), stderr=subprocess.DEVNULL).returncode == 0
+
+
+def parse_issues(message):
+    """
+    Returns the set of OpenZFS issue numbers mentioned by a commit message.
+    """
+    issues = set()
+    for line in message.splitlines():
+        if LINE_PATTERN.match(line):
+            issues.update(ISSUE_PATTERN.findall(line))
+
+    return issues
+
+
+def parse_log(revisions):
+    """
+    Yields (hash, issues) for the commits in the range, newest first.
+    """
+    log = git("log", "--no-merges", LOG_FORMAT, revisions)
+    for entry in log.split("\0"):
+        commit, _, message = entry.lstrip("\n").partition("\n")
+        if commit:
+            yield (commit, parse_issues(message))
+
+
+def load_index(path, branch):
+    if path is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        index = json.load(f)
+
+    if index.get("branch") != branch:
+        return None
+
+    return index
+
+
+def save_index(index, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.rename(tmp_path, path)
+
+
+def update_index(index, branch):
+    """
+    Extend the index with the commits added to the branch since it was last
+    updated, or build it from scratch.  Returns the updated index and the
+    number of commits read.
+    """
+    head = git("rev-parse", branch).strip()
+    if index is not None and index["head"] == head:
+        return (index, 0)
+
+    if index is None or not is_ancestor(index["head"], branch):
+        index = {"branch": branch, "head": None, "commits": {}}
+        revisions = branch
+    else:
+        revisions = "%s..%s" % (index["head"], branch)
+
+    # The log is newest first, so the first commit seen for an issue is the
+    # most recent one.  Older commits already in the index are replaced.
+    found = {}
+    count = 0
+    for commit, issues in parse_log(revisions):
+        count += 1
+        for issue in issues:
+            found.setdefault(issue, commit)
+
+    index["commits"].update(found)
+    index["head"] = head
+
+    return (index, count)
+
+
+def index_pulls(pulls):
+    """
+    Returns a dict mapping OpenZFS issue numbers to the URL of the first
+    open pull request whose title references them.
+    """
+    result = {}
+    for pull in pulls:
+        for issue in TITLE_PATTERN.findall(pull.get("title") or ""):
+            result.setdefault(issue, pull.get("html_url"))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index the OpenZFS issues ported to a ZFS on Linux branch.")
+    parser.add_argument("-i", "--index",
+        help="index file, created if it doesn't exist")
+    parser.add_argument("-b", "--branch", required=True,
+        help="ZFS on Linux branch to index, e.g. zfsonlinux/master")
+    parser.add_argument("-p", "--pulls",
+        help="GitHub pull request JSON file, '-' for stdin")
+    args = parser.parse_args()
+
+    index, count = update_index(load_index(args.index, args.branch),
+                                args.branch)
+    if args.index is not None:
+        save_index(index, args.index)
+    sys.stderr.write("%s: %d issues indexed, %d new commits\n" % (
+        args.branch, len(index["commits"]), count))
+
+    pulls = {}
+    if args.pulls is not None:
+        if args.pulls == "-":
+            data = sys.stdin.read()
+        else:
+            with open(args.pulls) as f:
+                data = f.read()
+        try:
+            pulls = index_pulls(json.loads(data))
+        except (ValueError, AttributeError):
+            sys.stderr.write("%s: invalid pull request JSON\n" % args.pulls)
+
+    out = sys.stdout
+    for issue, commit in sorted(index["commits"].items()):
+        out.write("commit\t%s\t%s\n" % (issue, commit))
+    for issue, url in sorted(pulls.items()):
+        out.write("pull\t%s\t%s\n" % (issue, url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+#
+# Maintain an index of the ZFS Test Suite results recorded by the buildbot.
+#
+# Each finished build's test log is parsed once and reduced to a compact
+# record of the builder, build number, origin (branch name or pull request
+# number), and the result of every test case.  Later runs only parse the
+# builds which are new since the last run, and drop the builds which have
+# aged out of the window.  The report used by known-issues.sh is generated
+# from the index in a single pass.
+#
+# New logs are decompressed by a pool of worker processes.  Each log is read
+# incrementally and only up to the "Results Summary" section, so neither the
+# workers nor the parent ever hold a whole log in memory.  The --benchmark
+# option compares this to parsing every whole log serially, as was done
+# before, on a synthetic corpus of logs.
+#
+# The index is stored as gzip compressed JSON:
+#
+#   { "<builder>/<build>": { "mtime": <seconds>, "origin": "<origin>",
+#                            "revision": "<sha>",
+#                            "results": [ [ "<test>", "<result>", <secs> ] ] } }
+#
+
+import argparse
+import bz2
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from zts_stats import DAY, TestStats, wilson_interval
+
+BUILDBOT_URL = "https://build.openzfs.org/builders"
+
+# The builder directory name doesn't contain enough information to generate
+# the encoded version of the builder name, so it's looked up here.
+BUILDER_NAMES = {
+    "CentOS_7_x86_64__TEST_": "CentOS 7 x86_64 (TEST)",
+    "CentOS_8_x86_64__TEST_": "CentOS 8 x86_64 (TEST)",
+    "CentOS_Stream_8_x86_64__TEST_": "CentOS Stream 8 x86_64 (TEST)",
+    "CentOS_9_x86_64__TEST_": "CentOS 9 x86_64 (TEST)",
+    "Debian_10_x86_64__TEST_": "Debian 10 x86_64 (TEST)",
+    "Fedora_37_x86_64__TEST_": "Fedora 37 x86_64 (TEST)",
+    "Fedora_38_x86_64__TEST_": "Fedora 38 x86_64 (TEST)",
+    "Fedora_39_x86_64__TEST_": "Fedora 39 x86_64 (TEST)",
+    "FreeBSD_stable_12_amd64__TEST_": "FreeBSD stable/12 amd64 (TEST)",
+    "FreeBSD_stable_13_amd64__TEST_": "FreeBSD stable/13 amd64 (TEST)",
+    "FreeBSD_stable_14_amd64__TEST_": "FreeBSD stable/14 amd64 (TEST)",
+}
+
+# The sharded test builders are named for the platform they test, e.g.
+# "CentOS 9 x86_64 shard 1/4 (TEST)", for any number of zts_shards, see
+# shard_name() in shards.py.
+SHARD_PATTERN = re.compile(r'^(.*)_shard_(\d+)_(\d+)(__TEST_)$')
+
+# The coverage builder results are not representative.
+IGNORED_BUILDERS = ("Ubuntu_18_04_x86_64_Coverage__TEST_",)
+
+GIT_LOG = "%s-log-git_zfs-stdio"
+TEST_LOG = "%s-log-shell_4-tests.bz2"
+
+# Test: /usr/share/zfs/zfs-tests/tests/functional/acl/posix/setup (run as root) [00:00] [PASS]
+RESULT_PATTERN = re.compile(
+    r'zfs-tests/(\S+).*?(?:\[(\d+):(\d+)\])?\s*\[(PASS|FAIL|SKIP|KILLED)\]')
+BUILD_PATTERN = re.compile(r'^[0-9]+$')
+REVISION_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+SUMMARY_MARKER = "Results Summary"
+
+
+def builder_name(builder):
+    """
+    Returns the name of the builder for a builder directory, or None.
+    """
+    m = SHARD_PATTERN.match(builder)
+    if m is None:
+        return BUILDER_NAMES.get(builder)
+
+    name = BUILDER_NAMES.get(m.group(1) + m.group(4))
+    if name is None:
+        return None
+
+    return name.replace(" (TEST)", " shard %s/%s (TEST)" % (m.group(2),
+        m.group(3)))
+
+
+def build_url(builder, nr):
+    name = builder_name(builder)
+    if name is None:
+        encoded = "unknown"
+    else:
+        encoded = name.replace(" ", "%20").replace("/", "%2F") \
+            .replace("(", "%28").replace(")", "%29")
+
+    return "<a href='%s/%s/builds/%s'>%s</a>" % (BUILDBOT_URL, encoded, nr, nr)
+
+
+def parse_git_log(git_log):
+    """
+    Returns the pull request number or branch name the build tested, and
+    the revision reported by 'git rev-parse HEAD' (or None).
+    """
+    with open(git_log, errors="replace") as f:
+        lines = f.readlines()
+
+    origin = ""
+    if any("refs/pull" in line for line in lines):
+        for line in lines:
+            if "git fetch" in line:
+                fields = line.rstrip("\n").split(" ")
+                origin = fields[4].split("/")[2] if len(fields) > 4 else ""
+                break
+    else:
+        for line in lines:
+            if "git clone --branch" in line:
+                fields = line.rstrip("\n").split(" ")
+                origin = fields[3] if len(fields) > 3 else ""
+                break
+
+    revision = None
+    for line in lines:
+        if REVISION_PATTERN.match(line.strip()):
+            revision = line.strip()
+
+    return (origin, revision)
+
+
+def parse_results(test_log):
+    """
+    Returns a list of [test, result, seconds] for every test in the log.
+    """
+    results = []
+    with bz2.open(test_log, "rt", errors="replace") as f:
+        for line in f:
+            # Everything after the summary repeats the results above it.
+            if line.startswith(SUMMARY_MARKER):
+                break
+
+            m = RESULT_PATTERN.search(line)
+            if m is None:
+                continue
+
+            seconds = None
+            if m.group(2) is not None:
+                seconds = int(m.group(2)) * 60 + int(m.group(3))
+            results.append([m.group(1), m.group(4), seconds])
+
+    return results
+
+
+def parse_build(path):
+    """
+    Returns the index record for the build, or None if it's incomplete.
+    """
+    git_log = GIT_LOG % path
+    test_log = TEST_LOG % path
+    if not os.path.exists(git_log) or not os.path.exists(test_log):
+        return None
+
+    origin, revision = parse_git_log(git_log)
+
+    return {
+        "mtime": os.path.getmtime(path),
+        "origin": origin,
+        "revision": revision,
+        "results": parse_results(test_log),
+    }
+
+
+def _parse_build_job(item):
+    key, path = item
+    return (key, parse_build(path))
+
+
+def iter_builds(items, jobs=None):
+    """
+    Yields (key, record) for each (key, path) in items as the logs are
+    parsed by a pool of `jobs` worker processes (default: one per CPU).
+    The records are yielded in completion order, not input order.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        for item in items:
+            yield _parse_build_job(item)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap_unordered(_parse_build_job, items, 4):
+            yield result
+
+
+def iter_results(items, jobs=None):
+    """
+    Yields (builder, build, test, result) for every test case in the builds.
+    """
+    for key, record in iter_builds(items, jobs):
+        if record is None:
+            continue
+
+        builder, nr = key.split("/")
+        for test, result, seconds in record["results"]:
+            yield (builder, int(nr), test, result)
+
+
+def find_builds(dirs, since):
+    """
+    Yields (key, path) for every build in dirs modified since the given time.
+    """
+    for pattern in dirs:
+        for directory in glob.glob(pattern):
+            builder = os.path.basename(os.path.normpath(directory))
+            if builder in IGNORED_BUILDERS:
+                continue
+
+            for entry in os.listdir(directory):
+                if not BUILD_PATTERN.match(entry):
+                    continue
+
+                path = os.path.join(directory, entry)
+                if os.path.getmtime(path) >= since:
+                    yield ("%s/%s" % (builder, entry), path)
+
+
+def load_index(path):
+    if path is None or not os.path.exists(path):
+        return {}
+
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+def save_index(index, path):
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.rename(tmp_path, path)
+
+
+def update_index(index, dirs, days, jobs=None):
+    """
+    Add any new builds to the index and drop the builds outside the window.
+    Returns the number of builds which were added.
+    """
+    since = time.time() - days * DAY
+
+    for key in [k for k, v in index.items() if v["mtime"] < since]:
+        del index[key]
+
+    items = [(key, path) for key, path in find_builds(dirs, since)
+             if key not in index]
+
+    added = 0
+    for key, record in iter_builds(items, jobs):
+        if record is not None:
+            index[key] = record
+            added += 1
+
+    return added
+
+
+def report(index, out, days):
+    """
+    Write a line for each (origin, test) which failed in the last `days`,
+    ordered by the number of failures:
+
+      <fail> <pass> <origin> <test> <builds> <ci-low> <ci-high> <trend>
+      <flaky-since> <flaky-revision>
+
+    The fields are tab separated.  Builds is the space separated list of
+    links to the failed builds.  The confidence interval bounds and trend
+    (the change in failure rate over the last week) are percentages.  The
+    flaky fields give the date and commit where a run of passes was broken
+    during the window.  Empty fields are '-'.
+    """
+    now = time.time()
+    since = now - days * DAY
+    passes = {}
+    failures = {}
+
+    for key in sorted(index, key=lambda k: (k.split("/")[0],
+                                            int(k.split("/")[1]))):
+        record = index[key]
+        if record["mtime"] < since:
+            continue
+
+        builder, nr = key.split("/")
+        for test, result, seconds in record["results"]:
+            if result == "PASS":
+                key = (record["origin"], test)
+                passes[key] = passes.get(key, 0) + 1
+            elif result == "FAIL":
+                failures.setdefault((record["origin"], test), []).append(
+                    build_url(builder, nr))
+
+    # The statistics are only needed for the tests which failed, which are
+    # a small fraction of all of the results in the index.
+    stats = TestStats.from_index(index, tests=set(
+        (test, origin) for origin, test in failures))
+
+    rows = sorted(failures.items(), key=lambda item: (-len(item[1]), item[0]))
+    for (origin, test), builds in rows:
+        npass = passes.get((origin, test), 0)
+        low, high = wilson_interval(len(builds), npass + len(builds))
+        trend = stats.trend(test, origin, now, window_days=days)
+        flaky = stats.flaky_since(test, origin, since=since)
+
+        out.write("%d\t%d\t%s\t%s\t%s\t%.2f\t%.2f\t%s\t%s\t%s\n" % (
+            len(builds), npass, origin, test, " ".join(builds),
+            100.0 * low, 100.0 * high,
+            "-" if trend is None else "%+.2f" % (100.0 * trend),
+            "-" if flaky is None else time.strftime("%Y-%m-%d",
+                time.gmtime(flaky[0])),
+            "-" if flaky is None or flaky[1] is None else flaky[1]))
+
+
+def durations(index):
+    """
+    Returns the mean duration in seconds of each test group (the directory
+    containing the test), for balancing the shards with zts_shard.py.
+    """
+    totals = {}
+    for record in index.values():
+        for test, result, seconds in record["results"]:
+            if seconds is None or result not in ("PASS", "FAIL"):
+                continue
+
+            total = totals.setdefault(test, [0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    groups = {}
+    for test, (seconds, count) in totals.items():
+        group = os.path.dirname(test)
+        groups[group] = groups.get(group, 0.0) + float(seconds) / count
+
+    return groups
+
+
+def save_durations(index, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(durations(index), f, indent=0, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def synthetic_build(path, rng, tests, origin):
+    """
+    Writes the git and test logs of a synthetic build.
+    """
+    open(path, "w").close()
+    with open(GIT_LOG % path, "w") as f:
+        f.write("git clone --branch %s https://github.com/openzfs/zfs\n" %
+            origin)
+        f.write("%040x\n" % rng.getrandbits(160))
+
+    lines = []
+    for test in tests:
+        result = "FAIL" if rng.random() < 0.01 else "PASS"
+        lines.append("Test: /usr/share/zfs/zfs-tests/tests/%s (run as root) "
+            "[%02d:%02d] [%s]\n" % (test, rng.randint(0, 3),
+            rng.randint(0, 59), result))
+        for i in range(rng.randint(0, 4)):
+            lines.append("%s: zpool create -f testpool loop%d\n" % (
+                time.strftime("%H:%M:%S"), i))
+
+    with bz2.open(TEST_LOG % path, "wt") as f:
+        f.writelines(lines)
+        f.write("\n%s\n\nPASS\t%d\n\n" % (SUMMARY_MARKER, len(tests)))
+        # The log of each failed test follows the summary.
+        f.writelines(lines)
+
+
+def parse_whole_build(path):
+    """
+    Returns the index record for a build, parsing the whole test log.
+    """
+    origin, revision = parse_git_log(GIT_LOG % path)
+    results = []
+    with bz2.open(TEST_LOG % path, "rt", errors="replace") as f:
+        for line in f:
+            m = RESULT_PATTERN.search(line)
+            if m is not None:
+                results.append([m.group(1), m.group(4), None])
+
+    return {"mtime": os.path.getmtime(path), "origin": origin,
+        "revision": revision, "results": results}
+
+
+def benchmark(builds, jobs=None):
+    rng = random.Random(0)
+    tests = ["functional/area%d/test_%03d_pos" % (i // 20, i)
+             for i in range(1500)]
+    workdir = tempfile.mkdtemp(prefix="zts_index-")
+    try:
+        directory = os.path.join(workdir, "Fedora_38_x86_64__TEST_")
+        os.mkdir(directory)
+        for nr in range(1, builds + 1):
+            synthetic_build(os.path.join(directory, str(nr)), rng, tests,
+                rng.choice(["master", "zfs-2.2-release"]))
+
+        rows = []
+        start = time.time()
+        for key, path in find_builds([directory], 0):
+            parse_whole_build(path)
+        rows.append(("serial, whole logs", time.time() - start))
+
+        indexes = []
+        for name, n in (("serial, up to the summary", 1),
+                        ("parallel, %d jobs" % (jobs or os.cpu_count() or 1), jobs)):
+            index = {}
+            start = time.time()
+            update_index(index, [directory], 1, n)
+            rows.append((name, time.time() - start))
+            indexes.append(index)
+
+        assert indexes[0] == indexes[1], "indexes differ"
+
+        with open(os.devnull, "w") as out:
+            start = time.time()
+            report(indexes[0], out, 1)
+            rows.append(("report", time.time() - start))
+
+        print("%d builds of %d tests" % (builds, len(tests)))
+        for name, seconds in rows:
+            print("%-28s %7.2fs" % (name, seconds))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index the ZFS Test Suite results from the buildbot logs.")
+    parser.add_argument("-i", "--index",
+        help="index file, created if it doesn't exist")
+    parser.add_argument("-m", "--mtime", type=int, default=30,
+        help="include test logs from the last N days")
+    parser.add_argument("-k", "--keep", type=int, default=None,
+        help="keep N days of results for statistics (default: mtime)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-r", "--report", action="store_true",
+        help="write the known issues report to stdout")
+    parser.add_argument("-d", "--durations",
+        help="write the mean duration of each test group to a JSON file")
+    parser.add_argument("--benchmark", type=int, metavar="BUILDS",
+        help="benchmark indexing a synthetic corpus of BUILDS logs")
+    parser.add_argument("dirs", nargs="*",
+        help="directories (or patterns) containing the buildbot logs")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.jobs)
+        return
+
+    if args.index is None:
+        parser.error("the following arguments are required: -i/--index")
+
+    index = load_index(args.index)
+    keep = max(args.mtime, args.keep or 0)
+    added = update_index(index, args.dirs, keep, args.jobs)
+    save_index(index, args.index)
+    sys.stderr.write("%s: %d builds indexed, %d new\n" % (args.index,
+        len(index), added))
+
+    if args.durations:
+        save_durations(index, args.durations)
+
+    if args.report:
+        report(index, sys.stdout, args.mtime)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+#
+# Write the part of the ZFS Test Suite runfiles to be run by one shard.
+#
+# The test groups (runfile sections) are divided between the shards so each
+# shard takes roughly the same amount of time.  The expected duration of
+# each group comes from the historic results published by zts_index.py, the
+# groups are assigned longest first to the shard with the least work.  A
+# group without history is assumed to take the median time.  Groups are
+# never split since they share setup and cleanup scripts.
+#
+# Every shard must compute the same partition, so the result depends only
+# on the runfiles and durations.  A digest of the partition is written to
+# stderr to allow the shards to be compared.
+#
+# Usage: zts_shard.py -s 2/4 [-d durations] [-T tags] common.run linux.run
+#
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+import urllib.request
+
+SECTION_PATTERN = re.compile(r'^\[(.+)\]\s*$')
+TAGS_PATTERN = re.compile(r'^tags\s*=\s*\[(.*)\]')
+DEFAULT_DURATION = 60.0
+
+
+class Section(object):
+    def __init__(self, name):
+        self.name = name
+        self.lines = []
+        self.tags = None
+
+    @property
+    def group(self):
+        # Platform specific sections are named "<group>:<platform>".
+        return self.name.split(":")[0]
+
+
+def parse_runfile(path):
+    """
+    Returns the list of Sections in the runfile, including DEFAULT.
+    """
+    sections = []
+    section = None
+    with open(path) as f:
+        for line in f:
+            m = SECTION_PATTERN.match(line)
+            if m is not None:
+                section = Section(m.group(1))
+                sections.append(section)
+            elif section is None:
+                continue
+
+            if not line.endswith("\n"):
+                line += "\n"
+
+            m = TAGS_PATTERN.match(line)
+            if m is not None:
+                section.tags = set(tag.strip().strip("'\"")
+                                   for tag in m.group(1).split(","))
+            section.lines.append(line)
+
+    return sections
+
+
+def load_durations(location):
+    """
+    Returns the dict of expected durations, in seconds, for each group.
+    """
+    if not location:
+        return {}
+
+    try:
+        if "://" in location:
+            with urllib.request.urlopen(location, timeout=60) as f:
+                return json.loads(f.read().decode("utf-8"))
+        with open(location) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Unable to load durations '%s': %s\n" % (location, e))
+        return {}
+
+
+def partition(groups, durations, shards):
+    """
+    Returns a list of the groups assigned to each shard, and a list of the
+    expected duration of each shard.
+    """
+    known = sorted(durations[g] for g in groups if g in durations)
+    default = known[len(known) // 2] if known else DEFAULT_DURATION
+
+    weighted = sorted(((durations.get(g, default), g) for g in groups),
+                      key=lambda item: (-item[0], item[1]))
+
+    result = [[] for i in range(shards)]
+    loads = [0.0] * shards
+    for duration, group in weighted:
+        shard = min(range(shards), key=lambda i: (loads[i], i))
+        result[shard].append(group)
+        loads[shard] += duration
+
+    return (result, loads)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write the ZFS Test Suite runfile for one shard.")
+    parser.add_argument("-s", "--shard", required=True,
+        help="the shard to write, as <n>/<count>, numbered from 1")
+    parser.add_argument("-d", "--durations",
+        help="group durations file or URL (zts_index.py -d)")
+    parser.add_argument("-T", "--tags",
+        help="only include groups with these comma separated tags")
+    parser.add_argument("runfiles", nargs="+")
+    args = parser.parse_args()
+
+    shard, shards = [int(x) for x in args.shard.split("/")]
+    if shards < 1 or shard < 1 or shard > shards:
+        parser.error("invalid shard '%s'" % args.shard)
+
+    tags = set(args.tags.split(",")) if args.tags else None
+    default = None
+    sections = []
+    for runfile in args.runfiles:
+        for section in parse_runfile(runfile):
+            if section.name == "DEFAULT":
+                if default is None:
+                    default = section
+                continue
+
+            section_tags = section.tags
+            if section_tags is None and default is not None:
+                section_tags = default.tags
+            if tags is not None and not (tags & (section_tags or set())):
+                continue
+
+            sections.append(section)
+
+    groups = sorted(set(section.group for section in sections))
+    assigned, loads = partition(groups, load_durations(args.durations), shards)
+
+    digest = hashlib.sha1(json.dumps(assigned).encode("utf-8")).hexdigest()
+    sys.stderr.write("Shard %d/%d: %d of %d groups, %.0f of %.0f seconds, "
+                     "plan %s\n" % (shard, shards, len(assigned[shard - 1]),
+                     len(groups), loads[shard - 1], sum(loads), digest[:12]))
+
+    selected = set(assigned[shard - 1])
+    out = sys.stdout
+    if default is not None:
+        out.writelines(default.lines)
+        out.write("\n")
+    for section in sections:
+        if section.group in selected:
+            out.writelines(section.lines)
+
+
+if __name__ == "__main__":
+    main()
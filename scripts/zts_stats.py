@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+# Failure rate statistics for the ZFS Test Suite results in a zts_index.py
+# index.
+#
+# The pass and fail counts for every (test, builder, origin) are bucketed by
+# day and stored as cumulative sums, so the counts for any time range are a
+# pair of binary searches regardless of how much history the index holds.
+# On top of this the module provides:
+#
+#   - Wilson score confidence intervals for the failure rate, which remain
+#     meaningful for tests with only a handful of results.
+#   - The trend of the failure rate over the most recent days compared to
+#     the rest of the window.
+#   - Detection of tests which became flaky: the first failure after a long
+#     run of passes, and the commit which was being tested at the time.
+#
+
+import bisect
+import math
+
+DAY = 24 * 60 * 60
+
+
+def wilson_interval(failures, total, z=1.96):
+    """
+    Returns the (low, high) bounds of the failure rate at ~95% confidence.
+    """
+    if total == 0:
+        return (0.0, 1.0)
+
+    p = float(failures) / total
+    denom = 1.0 + z * z / total
+    centre = p + z * z / (2.0 * total)
+    margin = z * math.sqrt(p * (1.0 - p) / total + z * z / (4.0 * total * total))
+
+    return (max(0.0, (centre - margin) / denom),
+            min(1.0, (centre + margin) / denom))
+
+
+class ResultSeries(object):
+    """
+    Daily pass and fail counts, and the ordered results, for one
+    (test, builder, origin).
+    """
+    def __init__(self):
+        self.daily = {}
+        self.results = []
+        self.days = None
+        self.passes = None
+        self.fails = None
+
+    def add(self, when, result, revision=None):
+        counts = self.daily.setdefault(int(when // DAY), [0, 0])
+        if result == "PASS":
+            counts[0] += 1
+        elif result == "FAIL":
+            counts[1] += 1
+        else:
+            return
+
+        self.results.append((when, result == "PASS", revision))
+        self.days = None
+
+    def _aggregate(self):
+        # Cumulative sums over the sorted days, with a leading zero.
+        self.days = sorted(self.daily)
+        self.passes = [0]
+        self.fails = [0]
+        for day in self.days:
+            p, f = self.daily[day]
+            self.passes.append(self.passes[-1] + p)
+            self.fails.append(self.fails[-1] + f)
+        self.results.sort(key=lambda r: r[0])
+
+    def counts(self, start=None, end=None):
+        """
+        Returns the (pass, fail) counts for results in [start, end).
+        """
+        if self.days is None:
+            self._aggregate()
+
+        lo = 0 if start is None else bisect.bisect_left(self.days, start // DAY)
+        hi = len(self.days) if end is None else \
+            bisect.bisect_left(self.days, end // DAY)
+
+        return (self.passes[hi] - self.passes[lo], self.fails[hi] - self.fails[lo])
+
+    def flaky_since(self, min_streak=20, min_failures=2):
+        """
+        Returns the (time, revision) of the first failure after the most
+        recent run of at least min_streak passes, provided it was followed
+        by at least min_failures failures.  Otherwise None.
+        """
+        if self.days is None:
+            self._aggregate()
+
+        streak = 0
+        candidate = None
+        failures = 0
+        for when, passed, revision in self.results:
+            if passed:
+                streak += 1
+                continue
+
+            if streak >= min_streak:
+                candidate = (when, revision)
+                failures = 0
+            failures += 1
+            streak = 0
+
+        if candidate is not None and failures >= min_failures:
+            return candidate
+
+        return None
+
+
+class TestStats(object):
+    """
+    The ResultSeries for every (test, builder, origin) in an index.
+    """
+    def __init__(self):
+        self.series = {}
+        self.by_test = {}
+
+    @classmethod
+    def from_index(cls, index, tests=None):
+        """
+        Returns the TestStats of an index, only for the (test, origin) pairs
+        in tests when provided.
+        """
+        stats = cls()
+        for key, record in index.items():
+            builder = key.split("/")[0]
+            origin = record["origin"]
+            revision = record.get("revision")
+            for test, result, seconds in record["results"]:
+                if tests is not None and (test, origin) not in tests:
+                    continue
+                stats.add(test, builder, origin, record["mtime"], result,
+                          revision)
+
+        return stats
+
+    def add(self, test, builder, origin, when, result, revision=None):
+        key = (test, builder, origin)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = ResultSeries()
+            self.by_test.setdefault((test, origin), []).append(key)
+        series.add(when, result, revision)
+
+    def matching(self, test=None, builder=None, origin=None):
+        if test is not None and origin is not None:
+            keys = self.by_test.get((test, origin), [])
+        else:
+            keys = self.series
+
+        for key in keys:
+            series = self.series[key]
+            if test is not None and key[0] != test:
+                continue
+            if builder is not None and key[1] != builder:
+                continue
+            if origin is not None and key[2] != origin:
+                continue
+            yield key, series
+
+    def counts(self, test=None, builder=None, origin=None, start=None,
+               end=None):
+        """
+        Returns the total (pass, fail) counts of the matching series.
+        """
+        passes = fails = 0
+        for key, series in self.matching(test, builder, origin):
+            p, f = series.counts(start, end)
+            passes += p
+            fails += f
+
+        return (passes, fails)
+
+    def trend(self, test, origin, now, recent_days=7, window_days=30):
+        """
+        Returns the change in the failure rate over the recent days compared
+        to the rest of the window, or None if either period has no results.
+        """
+        split = now - recent_days * DAY
+        p1, f1 = self.counts(test=test, origin=origin,
+                             start=now - window_days * DAY, end=split)
+        p2, f2 = self.counts(test=test, origin=origin, start=split)
+        if p1 + f1 == 0 or p2 + f2 == 0:
+            return None
+
+        return float(f2) / (p2 + f2) - float(f1) / (p1 + f1)
+
+    def flaky_since(self, test, origin, since=None, **kwargs):
+        """
+        Returns the earliest (time, revision) at which the test became flaky
+        on any builder for the origin, or None.
+        """
+        result = None
+        for key, series in self.matching(test=test, origin=origin):
+            flaky = series.flaky_since(**kwargs)
+            if flaky is None or (since is not None and flaky[0] < since):
+                continue
+            if result is None or flaky[0] < result[0]:
+                result = flaky
+
+        return result